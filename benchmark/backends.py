@@ -0,0 +1,210 @@
+"""
+Search backends with a common interface, so that the same workload can be run against LanceDB or
+Elasticsearch, either in-process through their Python clients or over HTTP through the FastAPI apps
+"""
+import http.client
+import json
+import threading
+from abc import ABC, abstractmethod
+from typing import Any
+from urllib.parse import urlencode, urlsplit
+
+# Custom types
+JsonBlob = dict[str, Any]
+
+SOURCE_FIELDS = ["id", "title", "description", "country", "variety", "price", "points"]
+
+
+class SearchBackend(ABC):
+    """Run a single FTS or vector search query and return the top 10 results"""
+
+    name = "base"
+
+    def __init__(self, search: str, model_checkpoint: str | None = None) -> None:
+        assert search in ["fts", "vector"], "Please specify a valid search type: 'fts' or 'vector'"
+        self.search_type = search
+        self.model = None
+        if search == "vector" and model_checkpoint is not None:
+            # Imported lazily so that FTS runs never pay for importing torch
+            from sentence_transformers import SentenceTransformer
+
+            self.model = SentenceTransformer(model_checkpoint)
+
+    def search(self, query: str) -> list[JsonBlob]:
+        if self.search_type == "fts":
+            return self.fts_search(query)
+        return self.vector_search(query)
+
+    @abstractmethod
+    def fts_search(self, query: str) -> list[JsonBlob]:
+        """Run a full-text search query"""
+
+    @abstractmethod
+    def vector_search(self, query: str) -> list[JsonBlob]:
+        """Encode a query and run a vector search with it"""
+
+    def config(self) -> JsonBlob:
+        """Backend parameters to record alongside the results"""
+        return {}
+
+    def close(self) -> None:
+        pass
+
+
+class LanceDBBackend(SearchBackend):
+    name = "lancedb"
+
+    def __init__(
+        self,
+        search: str,
+        model_checkpoint: str,
+        db_dir: str,
+        table: str = "wines",
+        nprobes: int = 20,
+        refine_factor: int = 0,
+    ) -> None:
+        import lancedb
+
+        super().__init__(search, model_checkpoint)
+        self.db_dir = db_dir
+        self.table = lancedb.connect(db_dir).open_table(table)
+        self.nprobes = nprobes
+        self.refine_factor = refine_factor
+
+    def fts_search(self, query: str) -> list[JsonBlob]:
+        search_query = self.table.search(query, query_type="fts").select(SOURCE_FIELDS).limit(10)
+        return search_query.to_arrow().to_pylist()
+
+    def vector_search(self, query: str) -> list[JsonBlob]:
+        query_vector = self.model.encode(query.lower())
+        search_query = (
+            self.table.search(query_vector, vector_column_name="vector")
+            .metric("cosine")
+            .nprobes(self.nprobes)
+            .select(SOURCE_FIELDS)
+            .limit(10)
+        )
+        if self.refine_factor > 0:
+            search_query = search_query.refine_factor(self.refine_factor)
+        return search_query.to_arrow().to_pylist()
+
+    def config(self) -> JsonBlob:
+        return {"db_dir": self.db_dir, "nprobes": self.nprobes, "refine_factor": self.refine_factor}
+
+
+class ElasticsearchBackend(SearchBackend):
+    name = "elasticsearch"
+
+    def __init__(
+        self,
+        search: str,
+        model_checkpoint: str,
+        url: str,
+        username: str,
+        password: str,
+        index: str = "wines",
+        vector_search_mode: str = "script_score",
+    ) -> None:
+        from elasticsearch import Elasticsearch
+
+        super().__init__(search, model_checkpoint)
+        self.client = Elasticsearch(
+            url,
+            basic_auth=(username, password),
+            request_timeout=300,
+            max_retries=3,
+            retry_on_timeout=True,
+            verify_certs=False,
+        )
+        self.url = url
+        self.index = index
+        self.vector_search_mode = vector_search_mode
+
+    def _search(self, **search_query) -> list[JsonBlob]:
+        response = self.client.search(
+            index=self.index,
+            size=10,
+            _source=SOURCE_FIELDS,
+            filter_path=["hits.hits._source"],
+            **search_query,
+        )
+        return [item["_source"] for item in response.body.get("hits", {}).get("hits", [])]
+
+    def fts_search(self, query: str) -> list[JsonBlob]:
+        return self._search(query={"match": {"description": {"query": query}}})
+
+    def vector_search(self, query: str) -> list[JsonBlob]:
+        query_vector = self.model.encode(query.lower()).tolist()
+        if self.vector_search_mode == "knn":
+            return self._search(
+                knn={
+                    "field": "vector",
+                    "query_vector": query_vector,
+                    "k": 10,
+                    "num_candidates": 100,
+                }
+            )
+        return self._search(
+            query={
+                "script_score": {
+                    "query": {"match_all": {}},
+                    "script": {
+                        "source": "cosineSimilarity(params.queryVector, 'vector') + 1.0",
+                        "params": {"queryVector": query_vector},
+                    },
+                }
+            }
+        )
+
+    def config(self) -> JsonBlob:
+        return {"url": self.url, "vector_search_mode": self.vector_search_mode}
+
+    def close(self) -> None:
+        self.client.close()
+
+
+class HTTPBackend(SearchBackend):
+    """Query the search endpoints of either FastAPI app, with one keep-alive connection per thread"""
+
+    name = "http"
+
+    def __init__(self, search: str, url: str) -> None:
+        # The app encodes vector queries itself, so no model is loaded here
+        super().__init__(search)
+        self.url = url
+        self.netloc = urlsplit(url).netloc
+        self.path = f"{urlsplit(url).path.rstrip('/')}/{search}_search"
+        self._local = threading.local()
+
+    def _get_connection(self) -> http.client.HTTPConnection:
+        if not hasattr(self._local, "connection"):
+            self._local.connection = http.client.HTTPConnection(self.netloc, timeout=300)
+        return self._local.connection
+
+    def fts_search(self, query: str) -> list[JsonBlob]:
+        return self._get(query)
+
+    def vector_search(self, query: str) -> list[JsonBlob]:
+        return self._get(query)
+
+    def _get(self, query: str) -> list[JsonBlob]:
+        """Send the query to the endpoint of this backend's search type"""
+        connection = self._get_connection()
+        try:
+            connection.request("GET", f"{self.path}?{urlencode({'query': query})}")
+            response = connection.getresponse()
+            body = response.read()
+        except (http.client.HTTPException, OSError):
+            # Reconnect on the next request, since the connection is in an unknown state
+            connection.close()
+            del self._local.connection
+            raise
+        if response.status == 404:
+            # The apps respond with a 404 when a query has no results
+            return []
+        if response.status != 200:
+            raise RuntimeError(f"HTTP {response.status}: {body[:200]!r}")
+        return json.loads(body)
+
+    def config(self) -> JsonBlob:
+        return {"url": self.url}
@@ -0,0 +1,149 @@
+"""
+Run this script to generate FTS and vector search query workloads from the wine reviews dataset
+
+Distinct queries are built from the dataset's own vocabulary and review text:
+
+* FTS queries are single terms, pairs of terms (`+oak +vanilla`) or pairs of adjacent terms in
+  quotes (`"crisp acidity"`), in the syntax of `benchmark_queries/keyword_terms.txt`. Both terms
+  of each query appear in the same review, so that every query has at least one match. The `+`
+  and quotes are only syntax: both databases match any of the terms and rank matches by BM25.
+* Vector search queries are short phrases taken from the reviews themselves.
+
+A workload is then sampled from the distinct queries with Zipfian popularity: the query of rank `r`
+is sampled with probability proportional to `1 / r^s`, where `s` is the skew (0 is uniform). Ranks
+are assigned at random. The workload is written one query per line, so the benchmarks' random
+sampling from the file preserves the Zipfian distribution.
+"""
+import argparse
+import random
+import re
+from collections import Counter
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import srsly
+
+# Custom types
+JsonBlob = dict[str, Any]
+
+STOPWORDS = set(
+    """
+    a about above after again all almost also although am an and any are around as at be because
+    been before being below both but by can could did do does doing down drink during each either
+    even few for from further had has have having here how however if in into is it its itself
+    just least less like made make many may more most much must near nearly no nor not now of off
+    offers on once one only or other our out over own quite rather really same several shows should
+    so some still such than that the their them then there these they this those through to too
+    toward under until up very was well were what when where which while who why will with within
+    without would wine wines yet you your
+    """.split()
+)
+WORD = re.compile(r"[a-z]+")
+CLAUSE_SEPARATORS = re.compile(r"[.,;:!?()]")
+
+
+def get_descriptions(data_dir: Path, filename: str) -> list[str]:
+    data = srsly.read_gzip_jsonl(data_dir / filename)
+    return [item["description"] for item in data if item.get("description")]
+
+
+def content_words(text: str) -> list[str]:
+    return [word for word in WORD.findall(text.lower()) if len(word) > 2 and word not in STOPWORDS]
+
+
+def fts_query(description: str, rng: random.Random) -> str | None:
+    words = content_words(description)
+    distinct_words = sorted(set(words))
+    if len(distinct_words) < 2:
+        return None
+    kind = rng.random()
+    if kind < 0.2:
+        return rng.choice(words)
+    if kind < 0.6:
+        first, second = rng.sample(distinct_words, 2)
+        return f"+{first} +{second}"
+    # Adjacent content words in the review, as the quoted two-word queries of keyword_terms.txt
+    i = rng.randrange(len(words) - 1)
+    return f'"{words[i]} {words[i + 1]}"'
+
+
+def vector_query(description: str, rng: random.Random) -> str | None:
+    clauses = [clause.lower().split() for clause in CLAUSE_SEPARATORS.split(description)]
+    clauses = [clause for clause in clauses if len(clause) >= MIN_WORDS]
+    if not clauses:
+        return None
+    clause = rng.choice(clauses)
+    # Long clauses are cut down to a random window of words within them
+    start = rng.randrange(max(1, len(clause) - MAX_WORDS + 1))
+    return " ".join(clause[start : start + MAX_WORDS])
+
+
+def get_distinct_queries(descriptions: list[str], search: str, rng: random.Random) -> list[str]:
+    make_query = fts_query if search == "fts" else vector_query
+    queries: dict[str, None] = {}
+    # Give up after many more attempts than queries, if the dataset can't produce enough of them
+    for _ in range(NUM_DISTINCT * 20):
+        query = make_query(rng.choice(descriptions), rng)
+        if query is not None:
+            queries[query] = None
+        if len(queries) == NUM_DISTINCT:
+            break
+    assert queries, f"Could not build any {search} queries from the descriptions in the dataset"
+    return list(queries)
+
+
+def sample_zipf(queries: list[str], num_queries: int, skew: float, seed: int) -> list[str]:
+    """Sample queries with the probability of the query of rank r proportional to 1 / r^skew"""
+    weights = 1.0 / np.arange(1, len(queries) + 1) ** skew
+    rng = np.random.default_rng(seed)
+    ranks = rng.choice(len(queries), size=num_queries, p=weights / weights.sum())
+    return [queries[rank] for rank in ranks]
+
+
+def main():
+    descriptions = get_descriptions(DATA_DIR, FILENAME)
+    rng = random.Random(SEED)
+    for search, name in [("fts", "keyword_terms"), ("vector", "vector_terms")]:
+        queries = get_distinct_queries(descriptions, search, rng)
+        # Popularity ranks are assigned at random, independently of how the queries were built
+        rng.shuffle(queries)
+        workload = sample_zipf(queries, NUM_QUERIES, SKEW, SEED)
+        counts = Counter(workload).most_common()
+        print(
+            f"{search}: {len(queries)} distinct queries, {len(counts)} of them sampled, "
+            f"the most popular {counts[0][1] / len(workload):.2%} of the {len(workload)} queries"
+        )
+        for output_dir in OUTPUT_DIRS:
+            output = Path(output_dir) / f"{PREFIX}_{name}.txt"
+            output.write_text("\n".join(workload) + "\n")
+            print(f"Wrote {output}")
+
+
+if __name__ == "__main__":
+    # fmt: off
+    parser = argparse.ArgumentParser("Generate FTS and vector search query workloads from the dataset")
+    parser.add_argument("--seed", type=int, default=37, help="Seed for random number generator")
+    parser.add_argument("--filename", type=str, default="winemag-data-130k-v2.jsonl.gz", help="Name of the JSONL zip file to use")
+    parser.add_argument("--num-distinct", type=int, default=5000, help="Number of distinct queries of each type")
+    parser.add_argument("--num-queries", type=int, default=100000, help="Number of queries in each workload")
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent of query popularity (0 samples distinct queries uniformly)")
+    parser.add_argument("--min-words", type=int, default=3, help="Minimum number of words in a vector search query")
+    parser.add_argument("--max-words", type=int, default=10, help="Maximum number of words in a vector search query")
+    parser.add_argument("--prefix", type=str, default="generated", help="Prefix of the output file names, e.g., generated_keyword_terms.txt")
+    parser.add_argument("--output-dirs", type=str, nargs="+", default=["../lancedb/benchmark_queries", "../elasticsearch/benchmark_queries"], help="Directories to write the workloads to")
+    args = parser.parse_args()
+    # fmt: on
+
+    SEED = args.seed
+    DATA_DIR = Path(__file__).parents[1] / "data"
+    FILENAME = args.filename
+    NUM_DISTINCT = args.num_distinct
+    NUM_QUERIES = args.num_queries
+    SKEW = args.skew
+    MIN_WORDS = args.min_words
+    MAX_WORDS = args.max_words
+    PREFIX = args.prefix
+    OUTPUT_DIRS = args.output_dirs
+
+    main()
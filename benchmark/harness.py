@@ -0,0 +1,193 @@
+"""
+Run this script to benchmark FTS or vector search on any backend with the same seeded workload
+
+Backends are LanceDB and Elasticsearch, queried in-process through their Python clients, or either
+FastAPI app queried over HTTP. Each query is timed individually, and the latency percentiles, QPS
+and error count are printed and written to a JSON file.
+"""
+import argparse
+import json
+import os
+import random
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any
+
+from backends import ElasticsearchBackend, HTTPBackend, LanceDBBackend, SearchBackend
+from dotenv import load_dotenv
+from load import LoadResult, run_closed_loop, run_open_loop
+from rich import progress
+from stats import format_summary, summarize
+
+BACKENDS = ["lancedb", "elasticsearch", "http"]
+
+
+def get_query_terms(path: Path) -> list[str]:
+    with open(path, "r") as f:
+        queries = [query.strip() for query in f.readlines()]
+    queries = [query for query in queries if query]
+    assert queries, f"No queries found in {path}"
+    return queries
+
+
+def get_backend() -> SearchBackend:
+    if args.backend == "lancedb":
+        return LanceDBBackend(
+            args.search,
+            args.model,
+            db_dir=args.db_dir,
+            nprobes=args.nprobes,
+            refine_factor=args.refine_factor,
+        )
+    if args.backend == "elasticsearch":
+        # Reuse the credentials of the Elasticsearch workflow
+        load_dotenv(Path(__file__).parents[1] / "elasticsearch" / ".env")
+        return ElasticsearchBackend(
+            args.search,
+            args.model,
+            url=args.url or f"http://localhost:{os.environ.get('ELASTIC_PORT', 9200)}",
+            username=os.environ.get("ELASTIC_USER", "elastic"),
+            password=os.environ.get("ELASTIC_PASSWORD", ""),
+            vector_search_mode=args.vector_search_mode,
+        )
+    return HTTPBackend(args.search, url=args.url or "http://localhost:8000")
+
+
+def run_serial(backend: SearchBackend, queries: list[str]) -> LoadResult:
+    """Run the queries one after another, with a progress bar"""
+    latencies, errors = [], Counter()
+    with progress.Progress(
+        "[progress.description]{task.description}",
+        progress.BarColumn(),
+        "[progress.percentage]{task.percentage:>3.0f}%",
+        progress.TimeElapsedColumn(),
+    ) as prog:
+        task = prog.add_task(f"Performing {args.search} search", total=len(queries))
+        run_start = time.perf_counter()
+        for query in queries:
+            start = time.perf_counter()
+            try:
+                backend.search(query)
+            except Exception as e:
+                errors[type(e).__name__] += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+            prog.update(task, advance=1)
+        elapsed = time.perf_counter() - run_start
+    return latencies, latencies, errors, elapsed
+
+
+def run(backend: SearchBackend, queries: list[str], qps: float | None = None) -> dict[str, Any]:
+    """Run a workload in the configured mode (at a target `qps` in open-loop mode) and summarize it"""
+    # A seeded generator makes the workload identical across backends and runs
+    rng = random.Random(SEED)
+    num_queries = int(qps * DURATION) if qps is not None and DURATION > 0 else LIMIT
+    workload = [rng.choice(queries) for _ in range(num_queries)]
+    if MODE == "serial":
+        latencies, service_times, errors, elapsed = run_serial(backend, workload)
+    elif MODE == "closed":
+        latencies, service_times, errors, elapsed = run_closed_loop(backend, workload, CONCURRENCY)
+    else:
+        print(f"Sending {num_queries} queries at {qps} QPS ({ARRIVAL} arrivals)")
+        latencies, service_times, errors, elapsed = run_open_loop(
+            backend, workload, qps, ARRIVAL, CONCURRENCY, rng
+        )
+
+    summary = summarize(latencies, sum(errors.values()), elapsed)
+    print(format_summary(summary))
+    if errors:
+        print(f"Errors by type: {dict(errors)}")
+    if qps is not None:
+        summary = {"target_qps": qps, **summary}
+    # Service times exclude the time spent waiting for a free worker in open-loop mode
+    summary["service_latency_ms"] = summarize(service_times, 0, elapsed)["latency_ms"]
+    summary["errors_by_type"] = dict(errors)
+    summary["distinct_queries"] = len(set(workload))
+    return summary
+
+
+def print_sweep(runs: list[dict[str, Any]]) -> None:
+    """Print the throughput-latency curve of an open-loop sweep over target QPS"""
+    print(
+        f"{'target QPS':>11} {'QPS':>8} {'p50 ms':>9} {'p99 ms':>9} {'p99.9 ms':>9} "
+        f"{'errors':>7}"
+    )
+    for summary in runs:
+        latency = summary["latency_ms"] or dict.fromkeys(["p50", "p99", "p99.9"], float("nan"))
+        print(
+            f"{summary['target_qps']:>11g} {summary['qps']:>8.1f} {latency['p50']:>9.3f} "
+            f"{latency['p99']:>9.3f} {latency['p99.9']:>9.3f} {summary['errors']:>7}"
+        )
+
+
+def main():
+    terms_file = "keyword_terms.txt" if args.search == "fts" else "vector_terms.txt"
+    queries_path = (
+        args.queries or Path(__file__).parents[1] / "lancedb/benchmark_queries" / terms_file
+    )
+    queries = get_query_terms(queries_path)
+
+    backend = get_backend()
+    try:
+        for query in random.Random(SEED).choices(queries, k=args.warmup):
+            backend.search(query)
+        if MODE == "open":
+            runs = [run(backend, queries, qps) for qps in QPS]
+        else:
+            runs = [run(backend, queries)]
+    finally:
+        backend.close()
+    if len(runs) > 1:
+        print_sweep(runs)
+
+    result = {
+        "backend": args.backend,
+        "search": args.search,
+        "mode": MODE,
+        "seed": SEED,
+        "concurrency": CONCURRENCY if MODE != "serial" else 1,
+        "arrival": ARRIVAL if MODE == "open" else None,
+        "queries_file": str(queries_path),
+        "backend_config": backend.config(),
+        "runs": runs,
+    }
+    output = Path(args.output or f"results/{args.backend}_{args.search}_{MODE}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2))
+    print(f"Wrote results to {output}")
+
+
+if __name__ == "__main__":
+    # fmt: off
+    parser = argparse.ArgumentParser("Benchmark search latency and throughput on any backend")
+    parser.add_argument("--backend", type=str, default="lancedb", choices=BACKENDS, help="Backend to run the queries on")
+    parser.add_argument("--search", type=str, default="fts", choices=["fts", "vector"], help="Specify whether to do FTS or vector search")
+    parser.add_argument("--seed", type=int, default=37, help="Seed for random number generator")
+    parser.add_argument("--limit", "-l", type=int, default=1000, help="Number of search terms to randomly generate")
+    parser.add_argument("--mode", type=str, default="serial", choices=["serial", "closed", "open"], help="Run queries one at a time, from N concurrent workers (closed loop) or at a fixed arrival rate (open loop)")
+    parser.add_argument("--concurrency", "-c", type=int, default=8, help="Number of workers (closed loop) or maximum queries in flight (open loop)")
+    parser.add_argument("--qps", type=float, nargs="+", default=[50], help="Target arrival rates to sweep over in open-loop mode")
+    parser.add_argument("--arrival", type=str, default="poisson", choices=["poisson", "constant"], help="Distribution of the gaps between arrivals in open-loop mode")
+    parser.add_argument("--duration", type=float, default=0, help="Seconds to run each open-loop rate for (0 sends --limit queries at each rate)")
+    parser.add_argument("--warmup", type=int, default=10, help="Number of untimed queries to run first")
+    parser.add_argument("--queries", type=Path, default=None, help="File with one query per line (defaults to the benchmark_queries terms)")
+    parser.add_argument("--output", "-o", type=str, default=None, help="Path of the JSON results file (defaults to results/<backend>_<search>_<mode>.json)")
+    parser.add_argument("--url", type=str, default=None, help="URL of the FastAPI app (http backend) or Elasticsearch (elasticsearch backend)")
+    parser.add_argument("--model", type=str, default="BAAI/bge-small-en-v1.5", help="Embedding model checkpoint for in-process vector search")
+    parser.add_argument("--db-dir", type=str, default=str(Path(__file__).parents[1] / "lancedb" / "winemag"), help="LanceDB directory (lancedb backend)")
+    parser.add_argument("--nprobes", type=int, default=20, help="Number of IVF partitions to search (lancedb backend)")
+    parser.add_argument("--refine-factor", type=int, default=0, help="Re-rank refine_factor * k vector search candidates (lancedb backend)")
+    parser.add_argument("--vector-search-mode", type=str, default="script_score", choices=["knn", "script_score"], help="Vector search mode (elasticsearch backend)")
+    args = parser.parse_args()
+    # fmt: on
+
+    LIMIT = args.limit
+    SEED = args.seed
+    MODE = args.mode
+    CONCURRENCY = args.concurrency
+    QPS = args.qps
+    ARRIVAL = args.arrival
+    DURATION = args.duration
+
+    main()
@@ -0,0 +1,102 @@
+"""
+Closed-loop and open-loop load generation on a search backend
+
+In a closed loop, each of N workers sends its next query as soon as the previous one returns, so
+the offered load adapts to the backend and a slow backend is never pushed past its capacity. In an
+open loop, queries are sent at a fixed arrival rate regardless of how fast the backend responds,
+which is how independent users behave. Open-loop latencies are measured from the time that each
+query was scheduled to be sent rather than the time that it was actually sent, so that queries
+delayed behind a slow one are charged for their wait (correcting for "coordinated omission").
+"""
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from backends import SearchBackend
+
+# Latencies (sec), service times (sec), errors by type and wall time (sec) of a run
+LoadResult = tuple[list[float], list[float], Counter, float]
+
+
+def get_send_times(num_queries: int, qps: float, arrival: str, rng: random.Random) -> list[float]:
+    """Offsets (sec) from the start of the run at which to send each query"""
+    if arrival == "constant":
+        return [i / qps for i in range(num_queries)]
+    # Poisson arrivals have exponentially distributed gaps with a mean of 1 / qps
+    send_times, offset = [], 0.0
+    for _ in range(num_queries):
+        send_times.append(offset)
+        offset += rng.expovariate(qps)
+    return send_times
+
+
+def run_closed_loop(backend: SearchBackend, queries: list[str], concurrency: int) -> LoadResult:
+    latencies, errors = [], Counter()
+    lock = threading.Lock()
+    remaining = iter(queries)
+
+    def worker() -> None:
+        while True:
+            with lock:
+                query = next(remaining, None)
+            if query is None:
+                return
+            start = time.perf_counter()
+            try:
+                backend.search(query)
+            except Exception as e:
+                with lock:
+                    errors[type(e).__name__] += 1
+            else:
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+
+    run_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+    elapsed = time.perf_counter() - run_start
+    # Every query is sent as soon as a worker is free, so latency and service time are the same
+    return latencies, latencies, errors, elapsed
+
+
+def run_open_loop(
+    backend: SearchBackend,
+    queries: list[str],
+    qps: float,
+    arrival: str,
+    concurrency: int,
+    rng: random.Random,
+) -> LoadResult:
+    """Send queries at `qps` on average, with at most `concurrency` of them in flight at once"""
+    send_times = get_send_times(len(queries), qps, arrival, rng)
+    latencies, service_times, errors = [], [], Counter()
+    lock = threading.Lock()
+
+    def send(query: str, scheduled: float) -> None:
+        start = time.perf_counter()
+        try:
+            backend.search(query)
+        except Exception as e:
+            with lock:
+                errors[type(e).__name__] += 1
+            return
+        end = time.perf_counter()
+        with lock:
+            latencies.append(end - scheduled)
+            service_times.append(end - start)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        run_start = time.perf_counter()
+        for query, offset in zip(queries, send_times):
+            scheduled = run_start + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            # When all workers are busy, the query waits in the executor's queue, and that wait
+            # counts towards its latency
+            executor.submit(send, query, scheduled)
+    elapsed = time.perf_counter() - run_start
+    return latencies, service_times, errors, elapsed
@@ -0,0 +1,42 @@
+"""
+Summarize per-query latencies into the percentiles, throughput and error counts of a run
+"""
+from typing import Any
+
+import numpy as np
+
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict[str, Any]:
+    """Summarize the latencies (in seconds) of the successful queries of a run of `elapsed` seconds"""
+    summary: dict[str, Any] = {
+        "queries": len(latencies) + errors,
+        "errors": errors,
+        "elapsed_sec": elapsed,
+        "qps": len(latencies) / elapsed if elapsed > 0 else 0.0,
+    }
+    if not latencies:
+        summary["latency_ms"] = None
+        return summary
+    latencies_ms = np.array(latencies) * 1000
+    summary["latency_ms"] = {
+        "mean": float(latencies_ms.mean()),
+        **{
+            f"p{p:g}": float(v)
+            for p, v in zip(PERCENTILES, np.percentile(latencies_ms, PERCENTILES))
+        },
+        "max": float(latencies_ms.max()),
+    }
+    return summary
+
+
+def format_summary(summary: dict[str, Any]) -> str:
+    lines = [
+        f"Queries: {summary['queries']}, errors: {summary['errors']}, "
+        f"elapsed: {summary['elapsed_sec']:.4f} sec, QPS: {summary['qps']:.1f}"
+    ]
+    if summary["latency_ms"] is not None:
+        latency = "  ".join(f"{k}={v:.3f}" for k, v in summary["latency_ms"].items())
+        lines.append(f"Latency (ms): {latency}")
+    return "\n".join(lines)
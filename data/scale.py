@@ -0,0 +1,167 @@
+"""
+Run this script to scale the wine reviews dataset up to millions of rows for scaling benchmarks
+
+The dataset is repeated as many times as needed to reach the requested number of rows. The first
+copy is the original data, and each further copy varies it in a controlled way:
+
+* Ids are offset by the copy number times the largest id, so that they stay unique
+* A fraction of the words in each description are replaced by words drawn from the whole dataset
+* Prices are scaled by a random factor around 1
+
+Two output formats are supported:
+
+* `jsonl`: A .jsonl.gz file in the same format as the original, read from this directory, which
+  can be ingested with `index.py --filename` in either database directory
+* `arrow`: An Arrow IPC file in the schema of the LanceDB table, read from an existing table that
+  has already been indexed (with `lancedb/index.py`). The vectors of each copy are the stored
+  vectors plus Gaussian noise, so that no sentences need to be encoded, no matter the size.
+"""
+import argparse
+import gzip
+import random
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import srsly
+from rich import progress
+
+
+def get_source_table() -> pa.Table:
+    if FORMAT == "jsonl":
+        return pa.Table.from_pylist(list(srsly.read_gzip_jsonl(Path(__file__).parent / FILENAME)))
+    import lancedb
+
+    return lancedb.connect(DB_DIR).open_table("wines").to_lance().to_table()
+
+
+def vary_descriptions(
+    descriptions: pa.Array, vocabulary: list[str], rng: random.Random
+) -> pa.Array:
+    """Replace a fraction of the words in each description with words from the vocabulary"""
+    varied = []
+    for description in descriptions.to_pylist():
+        if description is None:
+            varied.append(None)
+            continue
+        words = description.split()
+        for i in range(len(words)):
+            if rng.random() < TEXT_VARIATION:
+                words[i] = rng.choice(vocabulary)
+        varied.append(" ".join(words))
+    return pa.array(varied, type=pa.string())
+
+
+def vary_vectors(vectors: pa.FixedSizeListArray, np_rng: np.random.Generator) -> pa.Array:
+    """Add Gaussian noise of relative magnitude VECTOR_NOISE to each vector, keeping its norm"""
+    dim = vectors.type.list_size
+    values = vectors.values.to_numpy(zero_copy_only=False).reshape(-1, dim)
+    norms = np.linalg.norm(values, axis=1, keepdims=True)
+    noise = np_rng.normal(scale=VECTOR_NOISE / np.sqrt(dim), size=values.shape) * norms
+    varied = values + noise
+    varied *= norms / np.linalg.norm(varied, axis=1, keepdims=True)
+    return pa.FixedSizeListArray.from_arrays(pa.array(varied.ravel(), type=pa.float32()), dim)
+
+
+def make_copy(
+    source: pa.Table,
+    copy: int,
+    id_stride: int,
+    vocabulary: list[str],
+    rng: random.Random,
+    np_rng: np.random.Generator,
+) -> pa.Table:
+    if copy == 0:
+        return source
+    table = source.set_column(
+        source.schema.get_field_index("id"), "id", pc.add(source["id"], copy * id_stride)
+    )
+    description = vary_descriptions(source["description"].combine_chunks(), vocabulary, rng)
+    table = table.set_column(
+        table.schema.get_field_index("description"), "description", description
+    )
+    factors = pa.array(np_rng.uniform(1 - PRICE_VARIATION, 1 + PRICE_VARIATION, len(table)))
+    price = pc.round(pc.multiply(table["price"].cast(pa.float64()), factors))
+    table = table.set_column(table.schema.get_field_index("price"), "price", price)
+    if "to_vectorize" in table.column_names:
+        # Keep the text to vectorize in line with the varied description, as in the Wine model
+        to_vectorize = pc.binary_join_element_wise(
+            table["variety"], table["title"], table["description"], " ", null_handling="skip"
+        )
+        table = table.set_column(
+            table.schema.get_field_index("to_vectorize"), "to_vectorize", to_vectorize
+        )
+    if "vector" in table.column_names:
+        vector = vary_vectors(source["vector"].combine_chunks(), np_rng)
+        table = table.set_column(table.schema.get_field_index("vector"), "vector", vector)
+    # Restore the original types, nullability and metadata of the replaced columns
+    return table.cast(source.schema)
+
+
+def main():
+    source = get_source_table()
+    print(f"Scaling {source.num_rows} rows up to {NUM_ROWS} rows")
+    id_stride = pc.max(source["id"]).as_py()
+    vocabulary = " ".join(filter(None, source["description"].to_pylist())).split()
+    rng = random.Random(SEED)
+    np_rng = np.random.default_rng(SEED)
+    num_copies = -(-NUM_ROWS // source.num_rows)
+
+    output = Path(__file__).parent / OUTPUT
+    if FORMAT == "arrow":
+        writer = pa.ipc.new_file(output, source.schema)
+    else:
+        writer = gzip.open(output, "wt")
+    num_written = 0
+    with progress.Progress(
+        "[progress.description]{task.description}",
+        progress.BarColumn(),
+        "[progress.percentage]{task.percentage:>3.0f}%",
+        progress.TimeElapsedColumn(),
+    ) as prog:
+        task = prog.add_task("Writing copies of the dataset...", total=num_copies)
+        for copy in range(num_copies):
+            table = make_copy(source, copy, id_stride, vocabulary, rng, np_rng)
+            table = table.slice(0, NUM_ROWS - num_written)
+            if FORMAT == "arrow":
+                writer.write_table(table, max_chunksize=CHUNKSIZE)
+            else:
+                for item in table.to_pylist():
+                    writer.write(srsly.json_dumps(item) + "\n")
+            num_written += table.num_rows
+            prog.update(task, advance=1)
+    writer.close()
+    print(f"Wrote {num_written} rows to {output}")
+
+
+if __name__ == "__main__":
+    # fmt: off
+    parser = argparse.ArgumentParser("Scale the wine reviews dataset up to a given number of rows")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="Number of rows to generate")
+    parser.add_argument("--format", type=str, default="arrow", choices=["arrow", "jsonl"], help="Write an Arrow file with vectors (from the LanceDB table) or a JSONL file without them")
+    parser.add_argument("--seed", type=int, default=37, help="Seed for random number generator")
+    parser.add_argument("--filename", type=str, default="winemag-data-130k-v2.jsonl.gz", help="Name of the JSONL zip file to scale (jsonl format)")
+    parser.add_argument("--db-dir", type=str, default="../lancedb/winemag", help="LanceDB directory with the indexed wines table to scale (arrow format)")
+    parser.add_argument("--output", "-o", type=str, default=None, help="Name of the output file (defaults to winemag-data-<rows>.arrow or .jsonl.gz)")
+    parser.add_argument("--text-variation", type=float, default=0.1, help="Fraction of description words to replace in each copy")
+    parser.add_argument("--price-variation", type=float, default=0.2, help="Maximum relative change of the price in each copy")
+    parser.add_argument("--vector-noise", type=float, default=0.1, help="Relative magnitude of the noise added to vectors in each copy")
+    parser.add_argument("--chunksize", type=int, default=100_000, help="Maximum number of rows per record batch in the Arrow file")
+    args = parser.parse_args()
+    # fmt: on
+
+    NUM_ROWS = args.rows
+    FORMAT = args.format
+    SEED = args.seed
+    FILENAME = args.filename
+    DB_DIR = args.db_dir
+    OUTPUT = (
+        args.output or f"winemag-data-{NUM_ROWS}.{'arrow' if FORMAT == 'arrow' else 'jsonl.gz'}"
+    )
+    TEXT_VARIATION = args.text_variation
+    PRICE_VARIATION = args.price_variation
+    VECTOR_NOISE = args.vector_noise
+    CHUNKSIZE = args.chunksize
+
+    main()
@@ -1,17 +1,54 @@
 """
 FastAPI app to serve search endpoints
 """
+import asyncio
+import threading
+import time
+import tracemalloc
 from collections.abc import AsyncGenerator
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from functools import lru_cache
+from typing import Any, Literal
 
 from config import Settings
+from facets import Facets, build_aggregations, parse_aggregations
 from fastapi import FastAPI, HTTPException, Query, Request
-from schemas.wine import SearchResult
-from sentence_transformers import SentenceTransformer
+from fastapi.responses import PlainTextResponse, Response
+from memory import MemoryTracker, get_parameters_mb
+from metrics import Counter, RequestTimingMiddleware, StageMetrics
+from profiling import ProfileStore, ProfilingMiddleware, StackSampler, to_folded
+from pydantic import TypeAdapter
+from schemas.wine import FacetResult, SearchResult, SimilarResult, Wine
+from singleflight import SingleFlight, normalize_query
+from startup import StartupTimer
 
 from elasticsearch import AsyncElasticsearch
 
+executor = ThreadPoolExecutor(max_workers=4)
+metrics = StageMetrics()
+deduplicated = Counter(
+    "search_deduplicated_requests_total",
+    "Requests that shared the result of an identical in-flight query",
+)
+singleflight = SingleFlight()
+search_results_adapter = TypeAdapter(list[SearchResult])
+similar_results_adapter = TypeAdapter(list[SimilarResult])
+wine_adapter = TypeAdapter(dict[str, Any])
+wines_adapter = TypeAdapter(list[dict[str, Any]])
+SEARCH_FIELDS = ["id", "title", "description", "country", "variety", "price", "points"]
+WINE_FIELDS = list(Wine.model_fields)
+# Only the fields that the app reads are sent back by Elasticsearch, to cut bytes and parse time
+SEARCH_FILTER_PATH = ["hits.hits._source"]
+# Errors are kept so that a failed search isn't mistaken for one without hits
+MSEARCH_FILTER_PATH = ["responses.hits.hits._source", "responses.error"]
+MGET_FILTER_PATH = ["docs._source"]
+FACETS_FILTER_PATH = ["hits.total", "aggregations"]
+startup_timer = StartupTimer()
+startup_timer.mark("Interpreter and module imports")
+memory_tracker = MemoryTracker()
+memory_tracker.mark("Interpreter and module imports")
+
 
 @lru_cache()
 def get_settings():
@@ -19,11 +56,24 @@ def get_settings():
     return Settings()
 
 
+if get_settings().trace_memory:
+    tracemalloc.start()
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     """Async context manager for Elasticsearch connection."""
+    startup_timer.mark("Server startup")
     settings = get_settings()
-    app.model = SentenceTransformer(settings.embedding_model_checkpoint)
+    app.model = None
+    if settings.enable_vector_search:
+        # Imported lazily because sentence_transformers pulls in torch, which dominates startup
+        from sentence_transformers import SentenceTransformer
+
+        startup_timer.mark("Import sentence_transformers")
+        app.model = SentenceTransformer(settings.embedding_model_checkpoint)
+        startup_timer.mark("Load embedding model")
+        memory_tracker.mark("Embedding model")
 
     username = settings.elastic_user
     password = settings.elastic_password
@@ -36,9 +86,16 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
         max_retries=3,
         retry_on_timeout=True,
         verify_certs=False,
+        # Size the connection pool to the concurrency the app is expected to serve
+        connections_per_node=settings.elastic_connections,
+        http_compress=settings.elastic_http_compress,
     )
     app.client = elastic_client
+    startup_timer.mark("Create Elasticsearch client")
+    memory_tracker.mark("Elasticsearch client")
     print("Successfully connected to Elasticsearch")
+    print(startup_timer.report())
+    print(memory_tracker.report())
     yield
     await elastic_client.close()
     print("Successfully closed Elasticsearch connection")
@@ -52,6 +109,17 @@ app = FastAPI(
     version="0.1.0",
     lifespan=lifespan,
 )
+app.add_middleware(RequestTimingMiddleware)
+profile_store = None
+if get_settings().enable_profiling:
+    profile_store = ProfileStore(get_settings().profile_dir, get_settings().profile_max_files)
+    app.add_middleware(
+        ProfilingMiddleware,
+        store=profile_store,
+        sampler=StackSampler(get_settings().profile_interval),
+        sample_rate=get_settings().profile_sample_rate,
+        header=get_settings().profile_header,
+    )
 
 # --- app ---
 
@@ -63,37 +131,96 @@ async def root():
     }
 
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics() -> PlainTextResponse:
+    content = metrics.render() + deduplicated.render()
+    return PlainTextResponse(content, media_type="text/plain; version=0.0.4")
+
+
+@app.get("/memory", include_in_schema=False)
+async def get_memory(request: Request) -> dict:
+    """Memory used by each component of the app, as loaded at startup, and since then by serving"""
+    result = memory_tracker.snapshot(rest="Serving (connections, executor threads and requests)")
+    result["model_parameters_mb"] = get_parameters_mb(request.app.model)
+    result["threads"] = threading.active_count()
+    return result
+
+
+def _get_profile_store() -> ProfileStore:
+    if profile_store is None:
+        raise HTTPException(
+            status_code=404, detail="Profiling is disabled on this server (ENABLE_PROFILING=false)"
+        )
+    return profile_store
+
+
+@app.get("/profiles", include_in_schema=False)
+async def list_profiles(limit: int = Query(default=20, ge=1)) -> list[dict]:
+    """List the slowest recently profiled requests, with the frames most of their samples hit"""
+    return _get_profile_store().slowest(limit)
+
+
+@app.get("/profiles/{profile_id}", include_in_schema=False)
+async def get_profile(profile_id: str) -> PlainTextResponse:
+    """Return the stacks of a profile in the folded format, which flame graph tools can load"""
+    profile = _get_profile_store().get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"No profile with id '{profile_id}' found")
+    return PlainTextResponse(to_folded(profile))
+
+
 # --- Search functions ---
 
 
+def _get_sources(body: dict) -> list[dict]:
+    # filter_path drops the `hits` key altogether when there are no hits
+    return [item["_source"] for item in body.get("hits", {}).get("hits", [])]
+
+
 async def _fts_search(request: Request, query: str) -> list[SearchResult] | None:
-    response = await request.app.client.search(
-        index="wines",
-        size=10,
-        query={
-            "match": {
-                "description": {
-                    "query": query,
+    metrics.observe("fts_search", "queue_wait", time.perf_counter() - request.state.received)
+    with metrics.time("fts_search", "search"):
+        response = await request.app.client.search(
+            index="wines",
+            size=10,
+            query={
+                "match": {
+                    "description": {
+                        "query": query,
+                    }
                 }
-            }
-        },
-        _source=["id", "title", "description", "country", "variety", "price", "points"],
-    )
-    result = response["hits"].get("hits")
+            },
+            _source=SEARCH_FIELDS,
+            filter_path=SEARCH_FILTER_PATH,
+        )
+    with metrics.time("fts_search", "convert"):
+        result = search_results_adapter.validate_python(_get_sources(response.body))
     if result:
-        return [item["_source"] for item in result]
+        return result
     else:
         return None
 
 
-async def _vector_search(request: Request, query: str) -> list[SearchResult] | None:
-    query_vector = request.app.model.encode(query.lower()).tolist()
-    response = await request.app.client.search(
-        index="wines",
-        size=10,
-        query={
+def _vector_query(query_vector: list[float], exclude_id: str | None = None) -> dict:
+    """The search body of a vector search, leaving out the document `exclude_id` if it's given"""
+    settings = get_settings()
+    exclude = {"bool": {"must_not": {"ids": {"values": [exclude_id]}}}}
+    if settings.vector_search_mode == "knn":
+        # Approximate search on the HNSW index declared in mapping.json
+        knn = {
+            "field": "vector",
+            "query_vector": query_vector,
+            "k": settings.knn_k,
+            "num_candidates": settings.knn_num_candidates,
+        }
+        if exclude_id is not None:
+            knn["filter"] = exclude
+        return {"knn": knn}
+    # Exact search that scores every document with a Painless script
+    return {
+        "query": {
             "script_score": {
-                "query": {"match_all": {}},
+                "query": {"match_all": {}} if exclude_id is None else exclude,
                 "script": {
                     "source": "cosineSimilarity(params.queryVector, 'vector') + 1.0",
                     "params": {
@@ -101,16 +228,160 @@ async def _vector_search(request: Request, query: str) -> list[SearchResult] | N
                     },
                 },
             }
-        },
-        _source=["id", "title", "description", "country", "variety", "price", "points"],
-    )
-    result = response["hits"].get("hits")
+        }
+    }
+
+
+def _encode(request: Request, query: str) -> list[float]:
+    # Runs in the executor, so queue wait includes time spent waiting for a free worker thread
+    metrics.observe("vector_search", "queue_wait", time.perf_counter() - request.state.received)
+    with metrics.time("vector_search", "encode"):
+        return request.app.model.encode(query.lower()).tolist()
+
+
+async def _vector_search(request: Request, query: str) -> list[SearchResult] | None:
+    loop = asyncio.get_running_loop()
+    query_vector = await loop.run_in_executor(executor, _encode, request, query)
+    with metrics.time("vector_search", "search"):
+        response = await request.app.client.search(
+            index="wines",
+            size=10,
+            **_vector_query(query_vector),
+            _source=SEARCH_FIELDS,
+            filter_path=SEARCH_FILTER_PATH,
+        )
+    with metrics.time("vector_search", "convert"):
+        result = search_results_adapter.validate_python(_get_sources(response.body))
     if result:
-        return [item["_source"] for item in result]
+        return result
     else:
         return None
 
 
+async def _similar(request: Request, wine_ids: list[int]) -> dict[int, list[SearchResult]]:
+    """
+    Find the wines most similar to each wine in `wine_ids`, by searching with its stored vector,
+    so that nothing is encoded. Wines that aren't in the index are left out of the result.
+    """
+    metrics.observe("similar", "queue_wait", time.perf_counter() - request.state.received)
+    with metrics.time("similar", "lookup"):
+        # Documents are stored with the wine id as their _id, so this is a multi-get by key
+        response = await request.app.client.mget(
+            index="wines", ids=[str(i) for i in dict.fromkeys(wine_ids)], _source=["vector"]
+        )
+    docs = [doc for doc in response["docs"] if doc.get("found")]
+    if not docs:
+        return {}
+    searches = []
+    for doc in docs:
+        body = _vector_query(doc["_source"]["vector"], exclude_id=doc["_id"])
+        searches += [{}, {"size": 10, "_source": SEARCH_FIELDS, **body}]
+    with metrics.time("similar", "search"):
+        # One round trip for the searches of all wines
+        response = await request.app.client.msearch(
+            index="wines", searches=searches, filter_path=MSEARCH_FILTER_PATH
+        )
+    errors = [body["error"] for body in response["responses"] if "error" in body]
+    if errors:
+        reason = errors[0].get("reason", errors[0].get("type"))
+        raise HTTPException(
+            status_code=502,
+            detail=f"{len(errors)} of {len(docs)} similarity searches failed: {reason}",
+        )
+    with metrics.time("similar", "convert"):
+        return {
+            int(doc["_id"]): search_results_adapter.validate_python(_get_sources(body))
+            for doc, body in zip(docs, response["responses"])
+        }
+
+
+def _get_fields(fields: list[str] | None) -> list[str]:
+    """The fields to look up, which always include `id`, rejecting fields that wines don't have"""
+    if not fields:
+        return WINE_FIELDS
+    unknown = sorted(set(fields) - set(WINE_FIELDS))
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown fields: {', '.join(unknown)}")
+    return ["id"] + [field for field in dict.fromkeys(fields) if field != "id"]
+
+
+async def _get_wines(request: Request, wine_ids: list[int], fields: list[str]) -> list[dict]:
+    """Look up wines by id with a multi-get, in the order of the (distinct) ids"""
+    metrics.observe("wines", "queue_wait", time.perf_counter() - request.state.received)
+    with metrics.time("wines", "lookup"):
+        # Documents are stored with the wine id as their _id, so this is a multi-get by key
+        response = await request.app.client.mget(
+            index="wines",
+            ids=[str(i) for i in dict.fromkeys(wine_ids)],
+            _source=fields,
+            filter_path=MGET_FILTER_PATH,
+        )
+    # filter_path leaves an empty object for each missing wine, or no `docs` if all are missing
+    return [doc["_source"] for doc in response.body.get("docs", []) if "_source" in doc]
+
+
+async def _search_once(request: Request, endpoint: str, search_func, query: str):
+    """Run `search_func`, sharing its result with concurrent requests for the same query"""
+    if not get_settings().dedupe_concurrent_queries:
+        return await search_func(request, query)
+    key = (endpoint, normalize_query(query))
+    result, shared = await singleflight.do(key, lambda: search_func(request, query))
+    if shared:
+        deduplicated.inc(endpoint)
+    return result
+
+
+async def _facets(
+    request: Request, query: str | None, search: str, limit: int, size: int
+) -> Facets:
+    aggs = build_aggregations(size)
+    if query is None:
+        response = await request.app.client.search(
+            index="wines",
+            size=0,
+            track_total_hits=True,
+            aggs=aggs,
+            filter_path=FACETS_FILTER_PATH,
+        )
+        return parse_aggregations(response["aggregations"], response["hits"]["total"]["value"])
+    if search == "fts":
+        # Sample the `limit` top-scoring matches (per shard), to be in line with vector search
+        response = await request.app.client.search(
+            index="wines",
+            size=0,
+            query={"match": {"description": {"query": query}}},
+            aggs={"top_hits": {"sampler": {"shard_size": limit}, "aggs": aggs}},
+            filter_path=["aggregations"],
+        )
+        sample = response["aggregations"]["top_hits"]
+        return parse_aggregations(sample, sample["doc_count"])
+    loop = asyncio.get_running_loop()
+    query_vector = await loop.run_in_executor(executor, request.app.model.encode, query.lower())
+    response = await request.app.client.search(
+        index="wines",
+        size=0,
+        knn={
+            "field": "vector",
+            "query_vector": query_vector.tolist(),
+            "k": limit,
+            "num_candidates": max(limit, 100),
+        },
+        aggs=aggs,
+        filter_path=FACETS_FILTER_PATH,
+    )
+    return parse_aggregations(response["aggregations"], response["hits"]["total"]["value"])
+
+
+def _serialize(
+    request: Request, endpoint: str, result: list, adapter: TypeAdapter = search_results_adapter
+) -> Response:
+    """Serialize results to JSON here rather than in FastAPI, so that the cost can be measured"""
+    with metrics.time(endpoint, "serialize"):
+        content = adapter.dump_json(result)
+    metrics.observe(endpoint, "total", time.perf_counter() - request.state.received)
+    return Response(content=content, media_type="application/json")
+
+
 # --- Endpoints ---
 
 
@@ -124,15 +395,15 @@ async def fts_search(
     query: str = Query(
         description="Specify terms to search for in the variety, title and description"
     ),
-) -> list[SearchResult] | None:
-    result = await _fts_search(request, query)
+) -> Response:
+    result = await _search_once(request, "fts_search", _fts_search, query)
 
     if not result:
         raise HTTPException(
             status_code=404,
             detail=f"No wine with the provided terms '{query}' found in database - please try again",
         )
-    return result
+    return _serialize(request, "fts_search", result)
 
 
 @app.get(
@@ -145,11 +416,116 @@ async def vector_search(
     query: str = Query(
         description="Specify terms to search for in the variety, title and description"
     ),
-) -> list[SearchResult] | None:
-    result = await _vector_search(request, query)
+) -> Response:
+    if request.app.model is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Vector search is disabled on this server (ENABLE_VECTOR_SEARCH=false)",
+        )
+    result = await _search_once(request, "vector_search", _vector_search, query)
     if not result:
         raise HTTPException(
             status_code=404,
             detail=f"No wine with the provided terms '{query}' found in database - please try again",
         )
+    return _serialize(request, "vector_search", result)
+
+
+@app.get(
+    "/similar/{wine_id}",
+    response_model=list[SearchResult],
+    response_description="Find the wines most similar to a wine, without encoding any text",
+)
+async def similar(request: Request, wine_id: int) -> Response:
+    result = (await _similar(request, [wine_id])).get(wine_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"No wine with id {wine_id} found in database")
+    return _serialize(request, "similar", result)
+
+
+@app.get(
+    "/similar",
+    response_model=list[SimilarResult],
+    response_description="Find the wines most similar to each of a batch of wines",
+)
+async def similar_batch(
+    request: Request,
+    ids: list[int] = Query(description="Ids of the wines to find similar wines for (up to 100)"),
+) -> Response:
+    if len(ids) > 100:
+        raise HTTPException(status_code=422, detail="Up to 100 ids can be looked up at once")
+    found = await _similar(request, ids)
+    # Wines that aren't in the index are left out, and repeated ids are returned once
+    result = [
+        SimilarResult(id=wine_id, similar=found[wine_id])
+        for wine_id in dict.fromkeys(ids)
+        if wine_id in found
+    ]
+    return _serialize(request, "similar", result, similar_results_adapter)
+
+
+@app.get(
+    "/wines/{wine_id}",
+    response_model=dict[str, Any],
+    response_description="Look up a wine by id",
+)
+async def get_wine(
+    request: Request,
+    wine_id: int,
+    fields: list[str] | None = Query(
+        default=None, description="Only return these fields (the id is always returned)"
+    ),
+) -> Response:
+    result = await _get_wines(request, [wine_id], _get_fields(fields))
+    if not result:
+        raise HTTPException(status_code=404, detail=f"No wine with id {wine_id} found in database")
+    return _serialize(request, "wines", result[0], wine_adapter)
+
+
+@app.get(
+    "/wines",
+    response_model=list[dict[str, Any]],
+    response_description="Look up a batch of wines by id",
+)
+async def get_wines(
+    request: Request,
+    ids: list[int] = Query(description="Ids of the wines to look up (up to 1000)"),
+    fields: list[str] | None = Query(
+        default=None, description="Only return these fields (the id is always returned)"
+    ),
+) -> Response:
+    if len(ids) > 1000:
+        raise HTTPException(status_code=422, detail="Up to 1000 ids can be looked up at once")
+    # Wines that aren't in the index are left out, and repeated ids are returned once
+    result = await _get_wines(request, ids, _get_fields(fields))
+    return _serialize(request, "wines", result, wines_adapter)
+
+
+@app.get(
+    "/facets",
+    response_model=FacetResult,
+    response_description="Count wines by country, variety, taster and price bucket",
+)
+async def facets(
+    request: Request,
+    query: str | None = Query(
+        default=None, description="Only count wines in the result set of this query"
+    ),
+    search: Literal["fts", "vector"] = Query(
+        default="fts", description="Search type used to find the result set of the query"
+    ),
+    limit: int = Query(
+        default=1000, ge=1, le=10000, description="Maximum size of the result set of the query"
+    ),
+    size: int = Query(
+        default=20, ge=1, description="Number of most frequent values to return for each field"
+    ),
+) -> FacetResult:
+    if query is not None and search == "vector" and request.app.model is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Vector search is disabled on this server (ENABLE_VECTOR_SEARCH=false)",
+        )
+    with metrics.time("facets", "search"):
+        result = await _facets(request, query, search, limit, size)
     return result
@@ -0,0 +1,146 @@
+"""
+Run this script to benchmark the latency of looking up wines by id, for each batch size, as the
+app's `/wines` endpoints do
+
+Each lookup is one multi-get of a batch of random ids, which Elasticsearch serves from the `_id`
+of each document (the wine id) without running a query. With `--compare-search`, the same lookups
+are also run as an `ids` query through the search API, which adds a query and a fetch phase.
+"""
+import argparse
+import random
+import time
+from functools import lru_cache
+
+import numpy as np
+from config import Settings
+from dotenv import load_dotenv
+from rich import progress
+from schemas.wine import Wine
+
+from elasticsearch import Elasticsearch, helpers
+
+load_dotenv()
+
+WINE_FIELDS = list(Wine.model_fields)
+
+
+@lru_cache()
+def get_settings():
+    # Use lru_cache to avoid loading .env file for every request
+    return Settings()
+
+
+def get_elastic_client(settings) -> Elasticsearch:
+    # Get environment variables
+    USERNAME = settings.elastic_user
+    PASSWORD = settings.elastic_password
+    PORT = settings.elastic_port
+    ELASTIC_URL = settings.elastic_url
+    # Connect to ElasticSearch
+    elastic_client = Elasticsearch(
+        f"http://{ELASTIC_URL}:{PORT}",
+        basic_auth=(USERNAME, PASSWORD),
+        request_timeout=300,
+        max_retries=3,
+        retry_on_timeout=True,
+        verify_certs=False,
+        http_compress=settings.elastic_http_compress,
+    )
+    return elastic_client
+
+
+def get_all_ids(client: Elasticsearch) -> list[int]:
+    """The ids of all the wines in the index, read from the document ids without their sources"""
+    hits = helpers.scan(client, index="wines", query={"_source": False}, size=10000)
+    return [int(hit["_id"]) for hit in hits]
+
+
+def lookup(client: Elasticsearch, ids: list[int], fields: list[str], mode: str) -> int:
+    """Look up the wines with these ids, returning the number of wines found"""
+    if mode == "mget":
+        response = client.mget(
+            index="wines",
+            ids=[str(i) for i in ids],
+            _source=fields,
+            filter_path=["docs._source"],
+        )
+        return sum("_source" in doc for doc in response.body.get("docs", []))
+    response = client.search(
+        index="wines",
+        query={"ids": {"values": [str(i) for i in ids]}},
+        size=len(ids),
+        _source=fields,
+        filter_path=["hits.hits._source"],
+    )
+    return len(response.body.get("hits", {}).get("hits", []))
+
+
+def main():
+    client = get_elastic_client(get_settings())
+    assert client.ping()
+    all_ids = get_all_ids(client)
+    fields = ["id"] + [field for field in FIELDS if field != "id"] if FIELDS else WINE_FIELDS
+    modes = ["mget", "search"] if COMPARE_SEARCH else ["mget"]
+
+    results = []
+    with progress.Progress(
+        "[progress.description]{task.description}",
+        progress.BarColumn(),
+        "[progress.percentage]{task.percentage:>3.0f}%",
+        progress.TimeElapsedColumn(),
+    ) as prog:
+        for batch_size in BATCH_SIZES:
+            batches = [
+                random.sample(all_ids, min(batch_size, len(all_ids))) for _ in range(ITERATIONS)
+            ]
+            for mode in modes:
+                task = prog.add_task(f"{mode} {batch_size}", total=ITERATIONS)
+                # Warm the connection and the caches, so that the first lookup isn't an outlier
+                lookup(client, batches[0], fields, mode)
+                latencies = []
+                for ids in batches:
+                    start = time.perf_counter()
+                    found = lookup(client, ids, fields, mode)
+                    latencies.append(time.perf_counter() - start)
+                    assert found == len(ids), f"Found {found} of {len(ids)} ids"
+                    prog.update(task, advance=1)
+                results.append((mode, len(batches[0]), np.array(latencies) * 1000))
+    client.close()
+
+    print(
+        f"Lookup latency over {ITERATIONS} batches of random ids from {len(all_ids)} wines, "
+        f"returning {len(fields)} fields"
+    )
+    print(
+        f"{'mode':>6} {'batch':>6} {'mean ms':>9} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'ms/id':>8} {'ids/s':>9}"
+    )
+    for mode, batch_size, latencies in results:
+        p50, p99 = np.percentile(latencies, [50, 99])
+        per_id = latencies.mean() / batch_size
+        print(
+            f"{mode:>6} {batch_size:>6} {latencies.mean():>9.3f} {p50:>8.3f} {p99:>8.3f} "
+            f"{per_id:>8.4f} {1000 / per_id:>9.0f}"
+        )
+
+
+if __name__ == "__main__":
+    # fmt: off
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, default=37, help="Seed for random number generator")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 100, 1000], help="Numbers of ids to look up at once")
+    parser.add_argument("--iterations", type=int, default=100, help="Number of lookups to time per batch size")
+    parser.add_argument("--fields", type=str, nargs="+", default=None, help="Only return these fields (defaults to all the fields of a wine)")
+    parser.add_argument("--compare-search", action="store_true", help="Also time the lookups as an ids query through the search API")
+    args = parser.parse_args()
+    # fmt: on
+
+    SEED = args.seed
+    BATCH_SIZES = args.batch_sizes
+    ITERATIONS = args.iterations
+    FIELDS = args.fields
+    COMPARE_SEARCH = args.compare_search
+    random.seed(SEED)
+    assert not FIELDS or set(FIELDS) <= set(WINE_FIELDS), f"Fields must be in {WINE_FIELDS}"
+
+    main()
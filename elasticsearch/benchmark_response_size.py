@@ -0,0 +1,129 @@
+"""
+Run this script to measure the size of Elasticsearch search responses and the time taken to parse
+them in Python, with and without `filter_path` and HTTP compression
+
+Requests are sent with urllib3 directly (rather than through the Elasticsearch client) so that the
+raw response bytes can be measured as they arrive on the wire, before any decompression.
+"""
+import argparse
+import gzip
+import json
+import random
+import time
+from functools import lru_cache
+from pathlib import Path
+
+import urllib3
+from config import Settings
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SOURCE_FIELDS = ["id", "title", "description", "country", "variety", "price", "points"]
+# Each variant is a (name, filter_path, compress) tuple
+VARIANTS = [
+    ("full", None, False),
+    ("full+gzip", None, True),
+    ("filter_path", "hits.hits._source", False),
+    ("filter_path+gzip", "hits.hits._source", True),
+]
+
+
+@lru_cache()
+def get_settings():
+    # Use lru_cache to avoid loading .env file for every request
+    return Settings()
+
+
+def get_query_terms(filename: str) -> list[str]:
+    assert filename.endswith(".txt")
+    query_terms_file = Path("./benchmark_queries") / filename
+    with open(query_terms_file, "r") as f:
+        queries = f.readlines()
+    assert queries
+    result = [query.strip() for query in queries]
+    return result
+
+
+def get_search_body(query: str) -> dict:
+    if args.search == "fts":
+        search_query = {"query": {"match": {"description": {"query": query}}}}
+    else:
+        search_query = {
+            "knn": {
+                "field": "vector",
+                "query_vector": MODEL.encode(query.lower()).tolist(),
+                "k": 10,
+                "num_candidates": 100,
+            }
+        }
+    return {"size": args.size, "_source": SOURCE_FIELDS, **search_query}
+
+
+def fetch(
+    http: urllib3.PoolManager, body: dict, filter_path: str | None, compress: bool
+) -> tuple[int, int, float]:
+    """Return the bytes on the wire, the bytes after decompression and the time taken to parse"""
+    settings = get_settings()
+    url = f"http://{settings.elastic_url}:{settings.elastic_port}/wines/_search"
+    if filter_path is not None:
+        url += f"?filter_path={filter_path}"
+    headers = urllib3.make_headers(
+        basic_auth=f"{settings.elastic_user}:{settings.elastic_password}",
+        accept_encoding="gzip" if compress else None,
+    )
+    headers["Content-Type"] = "application/json"
+    response = http.request(
+        "POST", url, body=json.dumps(body), headers=headers, decode_content=False
+    )
+    assert response.status == 200, response.data
+    raw = response.data
+    wire_bytes = len(raw)
+
+    start = time.perf_counter()
+    if response.headers.get("Content-Encoding") == "gzip":
+        raw = gzip.decompress(raw)
+    json.loads(raw)
+    parse_time = time.perf_counter() - start
+    return wire_bytes, len(raw), parse_time
+
+
+def main():
+    default_file = "keyword_terms.txt" if args.search == "fts" else "vector_terms.txt"
+    queries = get_query_terms(args.queries_file or default_file)
+    bodies = [get_search_body(random.choice(queries)) for _ in range(LIMIT)]
+
+    http = urllib3.PoolManager()
+    print(f"Response sizes and parse times over {LIMIT} {args.search} queries of size {args.size}")
+    print(f"{'variant':>17} {'wire bytes':>11} {'json bytes':>11} {'parse ms':>9}")
+    for name, filter_path, compress in VARIANTS:
+        results = [fetch(http, body, filter_path, compress) for body in bodies]
+        wire_bytes, json_bytes, parse_time = (sum(column) / LIMIT for column in zip(*results))
+        print(f"{name:>17} {wire_bytes:>11.0f} {json_bytes:>11.0f} {parse_time * 1000:>9.3f}")
+
+
+if __name__ == "__main__":
+    # fmt: off
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, default=37, help="Seed for random number generator")
+    parser.add_argument("--limit", "-l", type=int, default=100, help="Number of search terms to randomly generate")
+    parser.add_argument("--search", type=str, default="fts", help="Specify whether to do FTS or vector search")
+    parser.add_argument("--queries-file", type=str, default=None, help="File in benchmark_queries to sample queries from (defaults to keyword_terms.txt or vector_terms.txt)")
+    parser.add_argument("--size", type=int, default=10, help="Number of hits to return per query")
+    args = parser.parse_args()
+    # fmt: on
+
+    LIMIT = args.limit
+    SEED = args.seed
+    random.seed(SEED)
+
+    # Assert that the search type is only one of "fts" or "vector"
+    assert args.search in ["fts", "vector"], "Please specify a valid search type: 'fts' or 'vector'"
+
+    if args.search == "vector":
+        # Imported lazily so that FTS runs never pay for importing torch
+        from sentence_transformers import SentenceTransformer
+
+        MODEL = SentenceTransformer(get_settings().embedding_model_checkpoint)
+
+    main()
@@ -3,16 +3,17 @@ Run this script to benchmark the serial search performance of FTS and vector sea
 """
 import argparse
 import random
+import time
 from functools import lru_cache
 from pathlib import Path
 from typing import Any
 
+import numpy as np
 from codetiming import Timer
 from config import Settings
 from dotenv import load_dotenv
 from rich import progress
 from schemas.wine import SearchResult
-from sentence_transformers import SentenceTransformer
 
 from elasticsearch import Elasticsearch
 
@@ -51,36 +52,31 @@ def get_elastic_client(settings) -> Elasticsearch:
         max_retries=3,
         retry_on_timeout=True,
         verify_certs=False,
+        http_compress=settings.elastic_http_compress,
     )
     return elastic_client
 
 
-def fts_search(client: Elasticsearch, query: str) -> list[SearchResult] | None:
-    response = client.search(
-        index="wines",
-        size=10,
-        query={
-            "match": {
-                "description": {
-                    "query": query,
-                }
-            }
-        },
-        _source=["id", "title", "description", "country", "variety", "price", "points"],
-    )
-    result = response["hits"].get("hits")
-    if result:
-        return [item["_source"] for item in result]
-    else:
-        return None
+def get_fts_query(query: str) -> JsonBlob:
+    return {"query": {"match": {"description": {"query": query}}}}
 
 
-def vector_search(model, client: Elasticsearch, query: str) -> list[SearchResult] | None:
-    query_vector = model.encode(query.lower()).tolist()
-    response = client.search(
-        index="wines",
-        size=10,
-        query={
+def get_vector_query(
+    query_vector: list[float], mode: str = "script_score", k: int = 10, num_candidates: int = 100
+) -> JsonBlob:
+    if mode == "knn":
+        # Approximate search on the HNSW index declared in mapping.json
+        return {
+            "knn": {
+                "field": "vector",
+                "query_vector": query_vector,
+                "k": k,
+                "num_candidates": num_candidates,
+            }
+        }
+    # Exact search that scores every document with a Painless script
+    return {
+        "query": {
             "script_score": {
                 "query": {"match_all": {}},
                 "script": {
@@ -90,23 +86,111 @@ def vector_search(model, client: Elasticsearch, query: str) -> list[SearchResult
                     },
                 },
             }
-        },
+        }
+    }
+
+
+def run_search(client: Elasticsearch, search_query: JsonBlob) -> list[JsonBlob]:
+    response = client.search(
+        index="wines",
+        size=10,
+        **search_query,
         _source=["id", "title", "description", "country", "variety", "price", "points"],
+        filter_path=["hits.hits._source"],
     )
-    result = response["hits"].get("hits")
+    # filter_path drops the `hits` key altogether when there are no hits
+    return [item["_source"] for item in response.body.get("hits", {}).get("hits", [])]
+
+
+def fts_search(client: Elasticsearch, query: str) -> list[SearchResult] | None:
+    result = run_search(client, get_fts_query(query))
     if result:
-        return [item["_source"] for item in result]
+        return result
     else:
         return None
 
 
+def vector_search(
+    model,
+    client: Elasticsearch,
+    query: str,
+    mode: str = "script_score",
+    k: int = 10,
+    num_candidates: int = 100,
+) -> list[SearchResult] | None:
+    query_vector = model.encode(query.lower()).tolist()
+    return search_vector(client, query_vector, mode, k, num_candidates)
+
+
+def search_vector(
+    client: Elasticsearch,
+    query_vector: list[float],
+    mode: str = "script_score",
+    k: int = 10,
+    num_candidates: int = 100,
+) -> list[SearchResult] | None:
+    """Vector search with an already encoded query vector"""
+    result = run_search(client, get_vector_query(query_vector, mode, k, num_candidates))
+    if result:
+        return result
+    else:
+        return None
+
+
+def time_stages(
+    client: Elasticsearch, query: str, mode: str, query_vector: list[float] | None = None
+) -> dict[str, float]:
+    """Run a query and return the time taken by each of its stages, in seconds"""
+    stages = {}
+    if args.search == "fts":
+        search_query = get_fts_query(query)
+    else:
+        if query_vector is None:
+            start = time.perf_counter()
+            query_vector = MODEL.encode(query.lower()).tolist()
+            stages["encode"] = time.perf_counter() - start
+        search_query = get_vector_query(query_vector, mode, args.k, args.num_candidates)
+    # The search stage includes the round trip to Elasticsearch and decoding the JSON response
+    start = time.perf_counter()
+    sources = run_search(client, search_query)
+    stages["search"] = time.perf_counter() - start
+    start = time.perf_counter()
+    _ = [SearchResult(**source) for source in sources]
+    stages["convert"] = time.perf_counter() - start
+    return stages
+
+
+def print_stages(stage_timings: list[dict[str, float]]) -> None:
+    """Print the latency distribution of each stage, and its share of the total time"""
+    total = sum(sum(stages.values()) for stages in stage_timings)
+    print(f"{'stage':>8} {'mean ms':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'share':>7}")
+    for stage in stage_timings[0]:
+        latencies = np.array([stages[stage] for stages in stage_timings]) * 1000
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        share = latencies.sum() / 1000 / total
+        print(
+            f"{stage:>8} {latencies.mean():>9.3f} {p50:>8.3f} {p90:>8.3f} {p99:>8.3f} {share:>7.1%}"
+        )
+
+
+def get_knn_recall(client: Elasticsearch, queries: list[str]) -> float:
+    """Mean recall of the kNN results against the exact (script_score) results of each query"""
+    recalls = []
+    for query in queries:
+        exact = vector_search(MODEL, client, query, "script_score") or []
+        approximate = vector_search(MODEL, client, query, "knn", args.k, args.num_candidates) or []
+        exact_ids = {item["id"] for item in exact}
+        recalls.append(len(exact_ids.intersection(item["id"] for item in approximate)) / 10)
+    return sum(recalls) / len(recalls)
+
+
 def main():
     if args.search == "fts":
         URL = "http://localhost:8000/fts_search"
-        queries = get_query_terms("keyword_terms.txt")
+        queries = get_query_terms(args.queries_file or "keyword_terms.txt")
     else:
         URL = "http://localhost:8000/vector_search"
-        queries = get_query_terms("vector_terms.txt")
+        queries = get_query_terms(args.queries_file or "vector_terms.txt")
 
     random_choice_queries = [random.choice(queries) for _ in range(LIMIT)]
 
@@ -114,24 +198,59 @@ def main():
     elastic_client = get_elastic_client(get_settings())
     assert elastic_client.ping()
 
+    if args.search == "fts":
+        modes = ["fts"]
+    elif args.mode == "both":
+        modes = ["script_score", "knn"]
+    else:
+        modes = [args.mode]
+
+    query_vectors = {}
+    if args.search == "vector" and args.precomputed_vectors:
+        # Encode each distinct query up front, so that the timed runs replay the query vectors
+        with Timer(name="Encode queries", text="Encoded query vectors in {:.4f} sec"):
+            query_vectors = {
+                query: MODEL.encode(query.lower()).tolist() for query in set(random_choice_queries)
+            }
+
     # Run the search directly on the Elasticsearch DB
-    with Timer(name="Serial search", text="Finished search in {:.4f} sec"):
-        # Add rich progress bar
-        with progress.Progress(
-            "[progress.description]{task.description}",
-            progress.BarColumn(),
-            "[progress.percentage]{task.percentage:>3.0f}%",
-            progress.TimeElapsedColumn(),
-        ) as prog:
-            overall_progress_task = prog.add_task(
-                f"Performing {args.search} search", total=len(random_choice_queries)
-            )
-            for query in random_choice_queries:
-                if args.search == "fts":
-                    _ = fts_search(elastic_client, query)
-                else:
-                    _ = vector_search(MODEL, elastic_client, query)
-                prog.update(overall_progress_task, advance=1)
+    for mode in modes:
+        stage_timings = []
+        with Timer(name=f"Serial {mode} search", text=f"Finished {mode} search in {{:.4f}} sec"):
+            # Add rich progress bar
+            with progress.Progress(
+                "[progress.description]{task.description}",
+                progress.BarColumn(),
+                "[progress.percentage]{task.percentage:>3.0f}%",
+                progress.TimeElapsedColumn(),
+            ) as prog:
+                overall_progress_task = prog.add_task(
+                    f"Performing {mode} search", total=len(random_choice_queries)
+                )
+                for query in random_choice_queries:
+                    if args.stages:
+                        stages = time_stages(elastic_client, query, mode, query_vectors.get(query))
+                        stage_timings.append(stages)
+                    elif args.search == "fts":
+                        _ = fts_search(elastic_client, query)
+                    elif query in query_vectors:
+                        _ = search_vector(
+                            elastic_client, query_vectors[query], mode, args.k, args.num_candidates
+                        )
+                    else:
+                        _ = vector_search(
+                            MODEL, elastic_client, query, mode, args.k, args.num_candidates
+                        )
+                    prog.update(overall_progress_task, advance=1)
+        if args.stages:
+            print_stages(stage_timings)
+
+    if args.search == "vector" and "knn" in modes:
+        recall = get_knn_recall(elastic_client, sorted(set(random_choice_queries)))
+        print(
+            f"Recall@10 of knn (k={args.k}, num_candidates={args.num_candidates}) "
+            f"against script_score: {recall:.4f}"
+        )
 
 
 if __name__ == "__main__":
@@ -140,18 +259,29 @@ if __name__ == "__main__":
     parser.add_argument("--seed", type=int, default=37, help="Seed for random number generator")
     parser.add_argument("--limit", "-l", type=int, default=10, help="Number of search terms to randomly generate")
     parser.add_argument("--search", type=str, default="fts", help="Specify whether to do FTS or vector search")
+    parser.add_argument("--queries-file", type=str, default=None, help="File in benchmark_queries to sample queries from (defaults to keyword_terms.txt or vector_terms.txt)")
+    parser.add_argument("--mode", type=str, default="both", choices=["knn", "script_score", "both"], help="Vector search mode: approximate kNN, exact script_score, or both")
+    parser.add_argument("--k", type=int, default=10, help="Number of nearest neighbors for kNN vector search")
+    parser.add_argument("--num-candidates", type=int, default=100, help="Number of candidates per shard for kNN vector search")
+    parser.add_argument("--stages", action="store_true", help="Time the encode, search and convert stages of each query separately")
+    parser.add_argument("--precomputed-vectors", action="store_true", help="Encode the vector search queries before the timed run and replay their vectors")
     args = parser.parse_args()
     # fmt: on
 
     LIMIT = args.limit
     SEED = args.seed
+    random.seed(SEED)
 
     # Assert that the search type is only one of "fts" or "vector"
     assert args.search in ["fts", "vector"], "Please specify a valid search type: 'fts' or 'vector'"
 
-    # Load a sentence transformer model for semantic similarity from a specified checkpoint
-    model_id = get_settings().embedding_model_checkpoint
-    assert model_id, "Invalid embedding model checkpoint specified in .env file"
-    MODEL = SentenceTransformer(model_id)
+    if args.search == "vector":
+        # Imported lazily so that FTS runs never pay for importing torch
+        from sentence_transformers import SentenceTransformer
+
+        # Load a sentence transformer model for semantic similarity from a specified checkpoint
+        model_id = get_settings().embedding_model_checkpoint
+        assert model_id, "Invalid embedding model checkpoint specified in .env file"
+        MODEL = SentenceTransformer(model_id)
 
     main()
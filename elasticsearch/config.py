@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -15,3 +17,26 @@ class Settings(BaseSettings):
     kibana_port: int
     elastic_url: str
     embedding_model_checkpoint: str
+    # Set to false to serve FTS only, without loading the embedding model (or torch)
+    enable_vector_search: bool = True
+    # Concurrent requests for the same normalized query share a single search
+    dedupe_concurrent_queries: bool = True
+    # "knn" runs an approximate search on the HNSW index, "script_score" an exact brute-force scan
+    vector_search_mode: Literal["knn", "script_score"] = "script_score"
+    knn_k: int = 10
+    knn_num_candidates: int = 100
+    # Connections kept open to each Elasticsearch node, sized to the expected request concurrency
+    elastic_connections: int = 10
+    # Gzip request and response bodies, which trades CPU for bytes on the wire
+    elastic_http_compress: bool = False
+    # Profile a sampled fraction of requests, and every request sent with the profiling header
+    enable_profiling: bool = False
+    profile_sample_rate: float = 0.01
+    profile_header: str = "x-profile"
+    # Seconds between stack samples of a profiled request
+    profile_interval: float = 0.001
+    # Directory of the on-disk ring buffer of profiles, and the number of profiles kept in it
+    profile_dir: str = "profiles"
+    profile_max_files: int = 200
+    # Trace the Python heap with tracemalloc, which the /memory endpoint breaks down (slow)
+    trace_memory: bool = False
@@ -0,0 +1,41 @@
+"""
+Count wines by country, variety, taster and price bucket via Elasticsearch aggregations
+"""
+from typing import Any
+
+FACET_FIELDS = ["country", "variety", "taster_name"]
+# Price buckets as (label, lower bound inclusive, upper bound exclusive)
+PRICE_BUCKETS = [
+    ("0-10", 0, 10),
+    ("10-25", 10, 25),
+    ("25-50", 25, 50),
+    ("50-100", 50, 100),
+    ("100+", 100, None),
+]
+
+Facets = dict[str, Any]
+
+
+def build_aggregations(size: int) -> dict[str, Any]:
+    """Terms aggregations on the keyword sub-field of each facet field, and a price range"""
+    aggs: dict[str, Any] = {
+        field: {"terms": {"field": f"{field}.raw", "size": size}} for field in FACET_FIELDS
+    }
+    ranges = []
+    for label, lower, upper in PRICE_BUCKETS:
+        price_range = {"key": label, "from": lower}
+        if upper is not None:
+            price_range["to"] = upper
+        ranges.append(price_range)
+    aggs["price"] = {"range": {"field": "price", "keyed": True, "ranges": ranges}}
+    return aggs
+
+
+def parse_aggregations(aggregations: dict[str, Any], total: int) -> Facets:
+    facets: Facets = {"total": total}
+    for field in FACET_FIELDS:
+        buckets = aggregations[field]["buckets"]
+        facets[field] = {bucket["key"]: bucket["doc_count"] for bucket in buckets}
+    buckets = aggregations["price"]["buckets"]
+    facets["price"] = {label: buckets[label]["doc_count"] for label, _, _ in PRICE_BUCKETS}
+    return facets
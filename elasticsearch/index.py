@@ -1,5 +1,7 @@
 import argparse
+import gzip
 from functools import lru_cache
+from itertools import islice
 from pathlib import Path
 from typing import Any, Iterator
 
@@ -7,9 +9,9 @@ import srsly
 from codetiming import Timer
 from config import Settings
 from dotenv import load_dotenv
+from ingest_report import IngestReport
 from rich import progress
 from schemas.wine import Wine
-from sentence_transformers import SentenceTransformer
 
 from elasticsearch import Elasticsearch, helpers
 
@@ -17,6 +19,9 @@ load_dotenv()
 # Custom types
 JsonBlob = dict[str, Any]
 
+# Number of lines decompressed at a time before they're parsed
+READ_BATCH_SIZE = 10000
+
 
 class FileNotFoundError(Exception):
     pass
@@ -36,17 +41,25 @@ def chunk_iterable(item_list: list[JsonBlob], chunksize: int) -> Iterator[tuple[
         yield tuple(item_list[i : i + chunksize])
 
 
-def get_json_data(data_dir: Path, filename: str) -> list[JsonBlob]:
+def get_json_data(data_dir: Path, filename: str, report: IngestReport) -> list[JsonBlob]:
     """Get all line-delimited json files (.jsonl) from a directory with a given prefix"""
     file_path = data_dir / filename
     if not file_path.is_file():
-        # File may not have been uncompressed yet so try to do that first
-        data = srsly.read_gzip_jsonl(file_path)
-        # This time if it isn't there it really doesn't exist
-        if not file_path.is_file():
-            raise FileNotFoundError(f"No valid .jsonl file found in `{data_dir}`")
-    else:
-        data = srsly.read_gzip_jsonl(file_path)
+        raise FileNotFoundError(f"No valid .jsonl file found in `{data_dir}`")
+    # Lines are decompressed and parsed in batches, so that reading and parsing are timed as
+    # separate stages without holding the whole decompressed file in memory
+    data = []
+    with gzip.open(file_path, "rb") as f:
+        while True:
+            with report.stage("read"):
+                lines = list(islice(f, READ_BATCH_SIZE))
+            if not lines:
+                break
+            with report.stage("parse"):
+                batch = [srsly.json_loads(line) for line in lines if line.strip()]
+            report.add_rows("read", len(lines))
+            report.add_rows("parse", len(batch))
+            data += batch
     return data
 
 
@@ -101,53 +114,146 @@ def create_index(client: Elasticsearch, index: str, mappings_path: Path) -> None
         print(f"Found index {index} in db, skipping index creation...\n")
 
 
-def add_vectors_to_index(data_chunk: tuple[JsonBlob, ...], index: str) -> None:
-    elastic_client = get_elastic_client(get_settings())
-    assert elastic_client.ping()
+def get_next_index_name(client: Elasticsearch, alias: str) -> tuple[str, list[str]]:
+    """Return the name `<alias>-N` for a new index, after the highest N in use, and the indices
+    that the alias currently points to"""
+    current_indices = []
+    if client.indices.exists_alias(name=alias):
+        current_indices = list(client.indices.get_alias(name=alias).keys())
+    numbers = [0]
+    for name in client.indices.get(index=f"{alias}-*").keys():
+        suffix = name.rsplit("-", 1)[-1]
+        if suffix.isdigit():
+            numbers.append(int(suffix))
+    return f"{alias}-{max(numbers) + 1}", current_indices
+
+
+def create_bulk_load_index(client: Elasticsearch, index_name: str, mappings_path: Path) -> None:
+    """Create an index that isn't refreshed or replicated until the bulk load is finished"""
+    elastic_config = dict(srsly.read_json(mappings_path))
+    mappings = elastic_config.get("mappings")
+    settings = {
+        **elastic_config.get("settings", {}),
+        "refresh_interval": "-1",
+        "number_of_replicas": 0,
+    }
+    client.indices.create(index=index_name, mappings=mappings, settings=settings)
+    print(f"Created index {index_name} for bulk loading\n")
+
+
+def finish_bulk_load(
+    client: Elasticsearch, index_name: str, old_indices: list[str], mappings_path: Path
+) -> None:
+    """Restore the index settings, refresh and force-merge the index, then point the alias to it"""
+    elastic_config = dict(srsly.read_json(mappings_path))
+    settings = elastic_config.get("settings", {})
+    with Timer(
+        name="Restore settings", text="Restored refresh interval and replicas in {:.4f} sec"
+    ):
+        with REPORT.stage("restore_settings"):
+            # A null value resets a setting to its default, unless mapping.json specifies one
+            client.indices.put_settings(
+                index=index_name,
+                settings={
+                    "refresh_interval": settings.get("refresh_interval"),
+                    "number_of_replicas": settings.get("number_of_replicas"),
+                },
+            )
+    with Timer(name="Refresh", text="Refreshed index in {:.4f} sec"):
+        with REPORT.stage("refresh"):
+            client.indices.refresh(index=index_name)
+    with Timer(name="Force-merge", text="Force-merged index in {:.4f} sec"):
+        # Merging segments also merges their HNSW graphs, so this is where most of the vector
+        # index build time of a bulk load goes
+        with REPORT.stage("force_merge"):
+            client.options(request_timeout=3600).indices.forcemerge(
+                index=index_name, max_num_segments=MAX_NUM_SEGMENTS
+            )
+    num_segments = len(client.cat.segments(index=index_name, format="json"))
+    print(f"Index {index_name} has {num_segments} segments across all shards")
+
+    # Move the alias in a single atomic request, so that searches never see a missing index
+    actions = [{"remove": {"index": old, "alias": INDEX_ALIAS}} for old in old_indices]
+    actions.append({"add": {"index": index_name, "alias": INDEX_ALIAS}})
+    with Timer(name="Alias swap", text="Switched alias in {:.4f} sec"):
+        with REPORT.stage("alias_swap"):
+            client.indices.update_aliases(actions=actions)
+    print(f"Alias {INDEX_ALIAS} now points to {index_name} instead of {old_indices}")
+    if DELETE_OLD:
+        for old in old_indices:
+            client.indices.delete(index=old)
+            print(f"Deleted index {old}")
+
+
+@lru_cache()
+def get_embedding_model():
+    # Imported lazily so that `--help` and other cheap commands don't pay for importing torch
+    from sentence_transformers import SentenceTransformer
+
     # Load a sentence transformer model for semantic similarity from a specified checkpoint
     model_id = get_settings().embedding_model_checkpoint
     assert model_id, "Invalid embedding model checkpoint specified in .env file"
-    MODEL = SentenceTransformer(model_id)
-
-    to_vectorize = [text.pop("to_vectorize") for text in data_chunk]
-    vectors = [list(MODEL.encode(sentence.lower())) for sentence in to_vectorize]
-    data_batch = [{**d, "vector": vector} for d, vector in zip(data_chunk, vectors)]
-    for success, info in helpers.streaming_bulk(
-        elastic_client,
-        data_batch,
-        index=index,
-    ):
-        if not success:
-            print("A document failed:", info)
+    return SentenceTransformer(model_id)
+
+
+def add_vectors_to_index(data_chunk: tuple[JsonBlob, ...], index: str) -> None:
+    elastic_client = get_elastic_client(get_settings())
+    assert elastic_client.ping()
+    MODEL = get_embedding_model()
+
+    with REPORT.stage("embed", rows=len(data_chunk)):
+        to_vectorize = [text.pop("to_vectorize") for text in data_chunk]
+        vectors = [list(MODEL.encode(sentence.lower())) for sentence in to_vectorize]
+        data_batch = [{**d, "vector": vector} for d, vector in zip(data_chunk, vectors)]
+    with REPORT.stage("bulk", rows=len(data_batch)):
+        for success, info in helpers.streaming_bulk(
+            elastic_client,
+            data_batch,
+            index=index,
+        ):
+            if not success:
+                print("A document failed:", info)
 
 
 def main(data: list[JsonBlob]) -> None:
     elastic_client = get_elastic_client(get_settings())
     assert elastic_client.ping()
-    create_index(elastic_client, INDEX_ALIAS, Path("mapping/mapping.json"))
+    mappings_path = Path("mapping/mapping.json")
+    if BULK_LOAD:
+        # Load into a new index and only switch the alias to it once it's refreshed and merged
+        index_name, old_indices = get_next_index_name(elastic_client, INDEX_ALIAS)
+        create_bulk_load_index(elastic_client, index_name, mappings_path)
+    else:
+        index_name = INDEX_ALIAS
+        create_index(elastic_client, INDEX_ALIAS, mappings_path)
 
     # Validate data and chunk it for ingesting in batches
     with Timer(
         name="Data validation in pydantic",
         text="Validated data using Pydantic in {:.4f} sec",
     ):
-        validated_data = validate(data, exclude_none=False)
+        with REPORT.stage("validate", rows=len(data)):
+            validated_data = validate(data, exclude_none=False)
 
     chunked_data = chunk_iterable(validated_data, CHUNKSIZE)
 
     # Add rich progress bar
-    with progress.Progress(
-        "[progress.description]{task.description}",
-        progress.BarColumn(),
-        "[progress.percentage]{task.percentage:>3.0f}%",
-        progress.TimeElapsedColumn(),
-    ) as prog:
-        overall_progress_task = prog.add_task(
-            "Vectorizing the required data...", total=len(validated_data) // CHUNKSIZE
-        )
-        for chunk in chunked_data:
-            add_vectors_to_index(chunk, INDEX_ALIAS)
-            prog.update(overall_progress_task, advance=1)
+    with Timer(name="Ingest", text="Vectorized and ingested data in {:.4f} sec"):
+        with progress.Progress(
+            "[progress.description]{task.description}",
+            progress.BarColumn(),
+            "[progress.percentage]{task.percentage:>3.0f}%",
+            progress.TimeElapsedColumn(),
+        ) as prog:
+            overall_progress_task = prog.add_task(
+                "Vectorizing the required data...", total=len(validated_data) // CHUNKSIZE
+            )
+            for chunk in chunked_data:
+                add_vectors_to_index(chunk, index_name)
+                prog.update(overall_progress_task, advance=1)
+
+    if BULK_LOAD:
+        finish_bulk_load(elastic_client, index_name, old_indices, mappings_path)
 
     # Close Elasticsearch client
     elastic_client.close()
@@ -159,6 +265,11 @@ if __name__ == "__main__":
     parser.add_argument("--limit", "-l", type=int, default=0, help="Limit the size of the dataset to load for testing purposes")
     parser.add_argument("--chunksize", type=int, default=1000, help="Size of each chunk to break the dataset into before processing")
     parser.add_argument("--filename", type=str, default="winemag-data-130k-v2.jsonl.gz", help="Name of the JSONL zip file to use")
+    parser.add_argument("--bulk-load", action="store_true", help="Load into a new index with refresh and replicas disabled, then force-merge it and switch the alias to it")
+    parser.add_argument("--max-num-segments", type=int, default=1, help="Number of segments per shard to force-merge the new index into in bulk-load mode")
+    parser.add_argument("--delete-old", action="store_true", help="Delete the indices that the alias pointed to before a bulk load")
+    parser.add_argument("--report", type=str, default="ingest_report.json", help="Path of the JSON report of the time, rows per second and peak RSS of each ingest stage")
+    parser.add_argument("--trace-memory", action="store_true", help="Also record the RSS and Python heap (with tracemalloc, which slows ingest down) of each ingest stage")
     args = vars(parser.parse_args())
     # fmt: on
 
@@ -166,15 +277,27 @@ if __name__ == "__main__":
     DATA_DIR = Path(__file__).parents[1] / "data"
     FILENAME = args["filename"]
     CHUNKSIZE = args["chunksize"]
+    BULK_LOAD = args["bulk_load"]
+    MAX_NUM_SEGMENTS = args["max_num_segments"]
+    DELETE_OLD = args["delete_old"]
+    REPORT = IngestReport("elasticsearch", trace_memory=args["trace_memory"])
 
     # Specify an alias to index the data under
     INDEX_ALIAS = get_settings().elastic_index_alias
     assert INDEX_ALIAS
 
-    data = list(get_json_data(DATA_DIR, FILENAME))
+    data = list(get_json_data(DATA_DIR, FILENAME, REPORT))
     if LIMIT > 0:
         data = data[:LIMIT]
 
     with Timer(name="Indexing data", text="Indexed data in {:.4f} sec"):
         if data:
             main(data)
+    REPORT.write(
+        Path(args["report"]),
+        rows=len(data),
+        filename=FILENAME,
+        chunksize=CHUNKSIZE,
+        bulk_load=BULK_LOAD,
+        max_num_segments=MAX_NUM_SEGMENTS,
+    )
@@ -0,0 +1,114 @@
+"""
+Lightweight latency histograms for each stage of a search request, exposed in the Prometheus text
+exposition format via the `/metrics` endpoint
+"""
+import bisect
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+# Bucket upper bounds (in seconds), spanning sub-millisecond conversions up to multi-second encodes
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)  # fmt: skip
+
+
+class Histogram:
+    "Fixed-bucket histogram whose `observe` is a bisect and two additions under a lock"
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.buckets = buckets
+        # One count per bucket, plus a final count for the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+
+
+class StageMetrics:
+    "Latency histograms for each stage of a request, labeled by endpoint"
+
+    def __init__(
+        self,
+        name: str = "search_stage_latency_seconds",
+        description: str = "Latency of each stage of a search request",
+    ) -> None:
+        self.name = name
+        self.description = description
+        self.histograms: dict[tuple[str, str], Histogram] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint: str, stage: str, seconds: float) -> None:
+        histogram = self.histograms.get((endpoint, stage))
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault((endpoint, stage), Histogram())
+        histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, endpoint: str, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(endpoint, stage, time.perf_counter() - start)
+
+    def render(self) -> str:
+        """Render all histograms in the Prometheus text exposition format"""
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for (endpoint, stage), histogram in sorted(self.histograms.items()):
+            labels = f'endpoint="{endpoint}",stage="{stage}"'
+            with histogram._lock:
+                counts = list(histogram.counts)
+                total = histogram.sum
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter:
+    "Monotonically increasing count, labeled by endpoint"
+
+    def __init__(self, name: str, description: str) -> None:
+        self.name = name
+        self.description = description
+        self.counts: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, endpoint: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + amount
+
+    def render(self) -> str:
+        """Render the counts in the Prometheus text exposition format"""
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        for endpoint, count in sorted(self.counts.items()):
+            lines.append(f'{self.name}{{endpoint="{endpoint}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+class RequestTimingMiddleware:
+    """
+    Pure ASGI middleware that stamps each HTTP request with its arrival time, so that the time it
+    spends queued (on the event loop or in an executor) can be measured once work actually starts
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "http":
+            scope.setdefault("state", {})["received"] = time.perf_counter()
+        await self.app(scope, receive, send)
@@ -0,0 +1,33 @@
+"""
+Deduplicate identical concurrent queries, so that a burst of the same query is encoded and searched
+only once while the remaining requests await the shared result
+"""
+import asyncio
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any
+
+
+def normalize_query(query: str) -> str:
+    """Case and whitespace differences don't change the results, so they shouldn't change the key"""
+    return " ".join(query.lower().split())
+
+
+class SingleFlight:
+    "Share one in-flight computation between all concurrent callers that use the same key"
+
+    def __init__(self) -> None:
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> tuple[Any, bool]:
+        """
+        Await `func()`, or the computation already running for `key`. Returns the result and
+        whether it was shared with an earlier caller.
+        """
+        task = self._inflight.get(key)
+        shared = task is not None
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shield the shared task, so that one client disconnecting doesn't cancel it for the others
+        return await asyncio.shield(task), shared
@@ -2,19 +2,59 @@
 FastAPI app to serve search endpoints
 """
 import asyncio
+import threading
+import time
+import tracemalloc
 from collections.abc import AsyncGenerator
 from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from functools import lru_cache
+from typing import Any, Literal
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 from config import Settings
+from facets import FACET_COLUMNS, Facets, compute_facets, read_facets, truncate_facets
 from fastapi import FastAPI, HTTPException, Query, Request
-from schemas.wine import SearchResult
-from sentence_transformers import SentenceTransformer
+from fastapi.responses import PlainTextResponse, Response
+from flat_index import FlatIndex, build_flat_index
+from memory import MemoryTracker, get_parameters_mb
+from metrics import Counter, RequestTimingMiddleware, StageMetrics
+from neighbors import read_neighbors
+from profiling import ProfileStore, ProfilingMiddleware, StackSampler, to_folded
+from pydantic import TypeAdapter
+from reduction import REDUCED_VECTOR_COLUMN, Projection, read_projection, rescore
+from schemas.wine import FacetResult, SearchResult, SimilarResult, Wine
+from shards import Layout, read_layout, shards_for_country, shards_for_ids
+from singleflight import SingleFlight, normalize_query
+from startup import StartupTimer
+from table_version import get_published_version
 
 import lancedb
+from lancedb.db import AsyncConnection
+from lancedb.table import AsyncTable
+
+DB_NAME = "./winemag"
+TABLE = "wines"
+SEARCH_COLUMNS = ["id", "title", "description", "country", "variety", "price", "points"]
+WINE_COLUMNS = list(Wine.model_fields)
 
 executor = ThreadPoolExecutor(max_workers=4)
+metrics = StageMetrics()
+deduplicated = Counter(
+    "search_deduplicated_requests_total",
+    "Requests that shared the result of an identical in-flight query",
+)
+singleflight = SingleFlight()
+search_results_adapter = TypeAdapter(list[SearchResult])
+similar_results_adapter = TypeAdapter(list[SimilarResult])
+wine_adapter = TypeAdapter(dict[str, Any])
+wines_adapter = TypeAdapter(list[dict[str, Any]])
+startup_timer = StartupTimer()
+startup_timer.mark("Interpreter and module imports")
+memory_tracker = MemoryTracker()
+memory_tracker.mark("Interpreter and module imports")
 
 
 @lru_cache()
@@ -23,17 +63,205 @@ def get_settings():
     return Settings()
 
 
+if get_settings().trace_memory:
+    tracemalloc.start()
+
+
+# --- Table versions ---
+
+
+async def _open_serving_table(db: AsyncConnection) -> tuple[AsyncTable, int]:
+    """Open a new handle on the published table version (or the latest, if none is published)"""
+    table = await db.open_table(TABLE, index_cache_size=get_settings().index_cache_size)
+    version = get_published_version(DB_NAME, TABLE)
+    if version is not None and version != await table.version():
+        await table.checkout(version)
+    return table, await table.version()
+
+
+async def _load_facets(table: AsyncTable, version: int) -> Facets:
+    """Read the facets precomputed at index time, or compute them if they're missing or stale"""
+    facets = read_facets(DB_NAME, TABLE, version)
+    if facets is None:
+        num_rows = await table.count_rows()
+        data = await table.query().select(FACET_COLUMNS).limit(num_rows).to_arrow()
+        facets = compute_facets(data)
+    return facets
+
+
+def _load_projection(version: int) -> Projection | None:
+    """Read the projection of the reduced vectors of this table version, if they're searched"""
+    if not get_settings().reduced_vector_search:
+        return None
+    projection = read_projection(DB_NAME, TABLE, version)
+    if projection is None:
+        print(
+            f"Warning: No projection found for version {version} of LanceDB table '{TABLE}', "
+            "searching the full vectors instead"
+        )
+    return projection
+
+
+async def _load_flat_index(table: AsyncTable, version: int) -> FlatIndex | None:
+    """Memory-map the flat index of this table version, if it's searched, building it if missing"""
+    if get_settings().vector_search_engine != "flat":
+        return None
+    flat_index = FlatIndex.open(DB_NAME, TABLE, version)
+    if flat_index is None:
+        num_rows = await table.count_rows()
+        data = await table.query().select(["id", "vector"]).limit(num_rows).to_arrow()
+        flat_index = await asyncio.to_thread(build_flat_index, DB_NAME, TABLE, version, data)
+    return flat_index
+
+
+async def _warm_table(table: AsyncTable) -> None:
+    """Run one query of each type so that index metadata is loaded before serving traffic"""
+    schema = await table.schema()
+    dim = schema.field("vector").type.list_size
+    await table.query().nearest_to_text("wine", columns="to_vectorize").limit(10).to_arrow()
+    await (
+        table.query()
+        .nearest_to([1.0] * dim)
+        .column("vector")
+        .distance_type("cosine")
+        .nprobes(20)
+        .limit(10)
+        .to_arrow()
+    )
+
+
+def _close_later(tables: list[AsyncTable]) -> None:
+    """Close replaced table handles (and release their index caches) after a grace period"""
+
+    def close() -> None:
+        for table in tables:
+            table.close()
+
+    asyncio.get_running_loop().call_later(get_settings().table_close_grace_period, close)
+
+
+async def _watch_table_versions(app: FastAPI, db: AsyncConnection, interval: float) -> None:
+    """
+    Poll for new table versions and move new requests onto them. Each request reads `app.table`
+    once, so in-flight requests finish on the handle (and version) they started with, which is
+    closed once they've had a grace period to do so.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        published = get_published_version(DB_NAME, TABLE)
+        if published is None:
+            # Without a published version, stay on the version opened at startup rather than
+            # following the latest one, which a writer may still be building
+            continue
+        if published == app.table_version:
+            if not app.neighbors:
+                # Neighbors are precomputed by neighbors.py once a version has been published
+                app.neighbors = read_neighbors(DB_NAME, TABLE, app.table_version) or {}
+            continue
+        try:
+            table, version = await _open_serving_table(db)
+            if version == app.table_version:
+                table.close()
+                continue
+            await _warm_table(table)
+            facets = await _load_facets(table, version)
+            projection = _load_projection(version)
+            flat_index = await _load_flat_index(table, version)
+            neighbors = read_neighbors(DB_NAME, TABLE, version) or {}
+            _close_later([app.table])
+            app.table, app.table_version, app.facets = table, version, facets
+            app.projection, app.flat_index, app.neighbors = projection, flat_index, neighbors
+            print(f"Switched to version {version} of LanceDB table '{TABLE}'")
+        except Exception as e:
+            print(f"Warning: Did not reload LanceDB table '{TABLE}' due to exception {e}")
+
+
+# --- Shards ---
+
+
+async def _open_shards(db: AsyncConnection, layout: Layout) -> list[AsyncTable]:
+    """Open a handle on the indexed version of each shard table listed in the layout"""
+    index_cache_size = get_settings().index_cache_size
+    shards = []
+    for shard in layout["shards"]:
+        table = await db.open_table(shard["table"], index_cache_size=index_cache_size)
+        await table.checkout(shard["version"])
+        shards.append(table)
+    return shards
+
+
+async def _load_shard_facets(shards: list[AsyncTable]) -> Facets:
+    """Compute the facets of all shards combined"""
+    data = []
+    for table in shards:
+        num_rows = await table.count_rows()
+        data.append(await table.query().select(FACET_COLUMNS).limit(num_rows).to_arrow())
+    return compute_facets(pa.concat_tables(data))
+
+
+async def _watch_shard_layout(app: FastAPI, db: AsyncConnection, interval: float) -> None:
+    """Poll for a new shard layout and move new requests onto its shards, as for table versions"""
+    while True:
+        await asyncio.sleep(interval)
+        layout = read_layout(DB_NAME, TABLE)
+        if layout is None or layout == app.shard_layout:
+            continue
+        try:
+            shards = await _open_shards(db, layout)
+            await asyncio.gather(*(_warm_table(table) for table in shards))
+            facets = await _load_shard_facets(shards)
+            _close_later(app.shards)
+            app.shards, app.shard_layout, app.facets = shards, layout, facets
+            print(f"Switched to a new layout of {len(shards)} shards of LanceDB table '{TABLE}'")
+        except Exception as e:
+            print(f"Warning: Did not reload shards of LanceDB table '{TABLE}' due to exception {e}")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     """Async context manager for lancedb connection."""
+    startup_timer.mark("Server startup")
     settings = get_settings()
-    model_checkpoint = settings.embedding_model_checkpoint
-    app.model = SentenceTransformer(model_checkpoint)
-    # Define LanceDB client
-    db = lancedb.connect("./winemag")
-    app.table = db.open_table("wines")
+    app.model = None
+    if settings.enable_vector_search:
+        # Imported lazily because sentence_transformers pulls in torch, which dominates startup
+        from sentence_transformers import SentenceTransformer
+
+        startup_timer.mark("Import sentence_transformers")
+        app.model = SentenceTransformer(settings.embedding_model_checkpoint)
+        startup_timer.mark("Load embedding model")
+        memory_tracker.mark("Embedding model")
+    # Define async LanceDB client, so that searches are awaited directly on the event loop
+    db = await lancedb.connect_async(DB_NAME)
+    app.shard_layout = None
+    app.projection = app.flat_index = None
+    app.neighbors = {}
+    if settings.sharded:
+        assert settings.vector_search_engine == "ann", "Sharded tables only support ANN search"
+        app.shard_layout = read_layout(DB_NAME, TABLE)
+        assert app.shard_layout, f"No shards of table '{TABLE}' found, run index.py with --shards"
+        app.shards = await _open_shards(db, app.shard_layout)
+        app.facets = await _load_shard_facets(app.shards)
+    else:
+        app.table, app.table_version = await _open_serving_table(db)
+        app.facets = await _load_facets(app.table, app.table_version)
+        app.projection = _load_projection(app.table_version)
+        app.flat_index = await _load_flat_index(app.table, app.table_version)
+        app.neighbors = read_neighbors(DB_NAME, TABLE, app.table_version) or {}
+    startup_timer.mark("Open LanceDB table")
+    memory_tracker.mark("LanceDB table and facets")
     print("Successfully connected to LanceDB")
+    print(startup_timer.report())
+    print(memory_tracker.report())
+    watcher = None
+    if settings.table_refresh_interval > 0:
+        watch = _watch_shard_layout if settings.sharded else _watch_table_versions
+        watcher = asyncio.create_task(watch(app, db, settings.table_refresh_interval))
     yield
+    if watcher is not None:
+        watcher.cancel()
+    for table in app.shards if settings.sharded else [app.table]:
+        table.close()
     print("Successfully closed LanceDB connection and released resources")
 
 
@@ -45,6 +273,17 @@ app = FastAPI(
     version="0.1.0",
     lifespan=lifespan,
 )
+app.add_middleware(RequestTimingMiddleware)
+profile_store = None
+if get_settings().enable_profiling:
+    profile_store = ProfileStore(get_settings().profile_dir, get_settings().profile_max_files)
+    app.add_middleware(
+        ProfilingMiddleware,
+        store=profile_store,
+        sampler=StackSampler(get_settings().profile_interval),
+        sample_rate=get_settings().profile_sample_rate,
+        header=get_settings().profile_header,
+    )
 
 # --- app ---
 
@@ -56,39 +295,345 @@ async def root():
     }
 
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics() -> PlainTextResponse:
+    content = metrics.render() + deduplicated.render()
+    return PlainTextResponse(content, media_type="text/plain; version=0.0.4")
+
+
+@app.get("/memory", include_in_schema=False)
+async def get_memory(request: Request) -> dict:
+    """Memory used by each component of the app, as loaded at startup, and since then by serving"""
+    result = memory_tracker.snapshot(rest="Serving (index caches, executor threads and requests)")
+    result["model_parameters_mb"] = get_parameters_mb(request.app.model)
+    result["threads"] = threading.active_count()
+    return result
+
+
+def _get_profile_store() -> ProfileStore:
+    if profile_store is None:
+        raise HTTPException(
+            status_code=404, detail="Profiling is disabled on this server (ENABLE_PROFILING=false)"
+        )
+    return profile_store
+
+
+@app.get("/profiles", include_in_schema=False)
+async def list_profiles(limit: int = Query(default=20, ge=1)) -> list[dict]:
+    """List the slowest recently profiled requests, with the frames most of their samples hit"""
+    return _get_profile_store().slowest(limit)
+
+
+@app.get("/profiles/{profile_id}", include_in_schema=False)
+async def get_profile(profile_id: str) -> PlainTextResponse:
+    """Return the stacks of a profile in the folded format, which flame graph tools can load"""
+    profile = _get_profile_store().get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"No profile with id '{profile_id}' found")
+    return PlainTextResponse(to_folded(profile))
+
+
 # --- Search functions ---
 
 
-def _fts_search(request: Request, terms: str) -> list[SearchResult] | None:
+def _get_tables(app: FastAPI, country: str | None) -> list[AsyncTable]:
+    """The table, or the shards that can hold wines from `country` (every shard if it's None)"""
+    if app.shard_layout is None:
+        return [app.table]
+    # Read both attributes before any await, as the watcher swaps them together
+    shards, layout = app.shards, app.shard_layout
+    return [shards[shard] for shard in shards_for_country(layout, country)]
+
+
+def _get_tables_for_ids(app: FastAPI, ids: list[int]) -> list[AsyncTable]:
+    """The table, or the shards that can hold wines with these ids"""
+    if app.shard_layout is None:
+        return [app.table]
+    shards, layout = app.shards, app.shard_layout
+    return [shards[shard] for shard in shards_for_ids(layout, ids)]
+
+
+def _country_filter(country: str) -> str:
+    return "country = '{}'".format(country.replace("'", "''"))
+
+
+async def _search_tables(tables: list[AsyncTable], build_query, limit: int, score: str) -> pa.Table:
+    """
+    Run a query on each table concurrently, and merge the results into the top `limit` results by
+    `score`, which is `_score` (higher is better) for FTS and `_distance` (lower is better) for
+    vector search. BM25 scores are computed from the term statistics of each shard, which are close
+    to those of the whole table when rows are hash-partitioned.
+    """
+    results = await asyncio.gather(
+        *(build_query(table).limit(limit).to_arrow() for table in tables)
+    )
+    if len(results) == 1:
+        return results[0]
+    order = "descending" if score == "_score" else "ascending"
+    return pa.concat_tables(results).sort_by([(score, order)]).slice(0, limit)
+
+
+async def _fts_search(
+    request: Request, terms: str, country: str | None = None
+) -> list[SearchResult] | None:
+    metrics.observe("fts_search", "queue_wait", time.perf_counter() - request.state.received)
+    tables = _get_tables(request.app, country)
+    if not tables:
+        return None
+
+    def build_query(table: AsyncTable):
+        query = (
+            table.query()
+            .nearest_to_text(terms, columns="to_vectorize")
+            .select(["id", "title", "description", "country", "variety", "price", "points"])
+        )
+        return query if country is None else query.where(_country_filter(country))
+
     # In FTS, we limit to a max of 10K points to be more in line with Elasticsearch
-    search_result = (
-        request.app.table.search(terms, vector_column_name="description")
-        .select(["id", "title", "description", "country", "variety", "price", "points"])
-        .limit(10)
-    ).to_pydantic(SearchResult)
+    with metrics.time("fts_search", "search"):
+        search_result = await _search_tables(tables, build_query, 10, "_score")
+    with metrics.time("fts_search", "convert"):
+        search_result = search_results_adapter.validate_python(search_result.to_pylist())
     if not search_result:
         return None
     return search_result
 
 
-def _vector_search(
+async def _fetch_rows(tables: list[AsyncTable], ids: list[int], columns: list[str]) -> pa.Table:
+    """Look up the rows with these ids on the scalar index of `id`, in no particular order"""
+    id_filter = "id IN ({})".format(", ".join(str(wine_id) for wine_id in ids))
+    # Plain queries return 10 rows unless given a limit
+    results = await asyncio.gather(
+        *(
+            table.query().where(id_filter).select(columns).limit(len(ids)).to_arrow()
+            for table in tables
+        )
+    )
+    return results[0] if len(results) == 1 else pa.concat_tables(results)
+
+
+def _take_ids(rows: pa.Table, ids: list[int]) -> pa.Table:
+    """The rows with these ids, in the order of the ids (skipping ids that aren't in `rows`)"""
+    positions = {wine_id: i for i, wine_id in enumerate(rows["id"].to_pylist())}
+    indices = [positions[wine_id] for wine_id in ids if wine_id in positions]
+    return rows.take(pa.array(indices, type=pa.int64()))
+
+
+def _encode(request: Request, terms: str):
+    # Runs in the executor, so queue wait includes time spent waiting for a free worker thread
+    metrics.observe("vector_search", "queue_wait", time.perf_counter() - request.state.received)
+    with metrics.time("vector_search", "encode"):
+        return request.app.model.encode(terms.lower())
+
+
+async def _search_vectors(
+    endpoint: str,
+    tables: list[AsyncTable],
+    projection: Projection | None,
+    flat_index: FlatIndex | None,
+    query_vectors: np.ndarray,
+    country: str | None,
+    limit: int,
+) -> list[pa.Table]:
+    """
+    Find the `limit` nearest rows to each of a batch of query vectors: with one matrix multiply on
+    the flat index, or with one search per vector on the reduced index (rescoring its candidates
+    with the full vectors) or on the IVF-PQ index of the full vectors
+    """
+    loop = asyncio.get_running_loop()
+    if flat_index is not None and country is None:
+        # Filtered searches still go through the ANN index, as the flat index holds no columns
+        with metrics.time(endpoint, "search"):
+            # The matrix multiply releases the GIL, so it runs on the thread pool like encoding
+            ids, _ = await loop.run_in_executor(executor, flat_index.search, query_vectors, limit)
+        with metrics.time(endpoint, "fetch"):
+            rows = await _fetch_rows(tables, list(set(ids.ravel().tolist())), SEARCH_COLUMNS)
+        return [_take_ids(rows, row_ids) for row_ids in ids.tolist()]
+
+    settings = get_settings()
+    refine_factor = settings.refine_factor
+
+    def build_query(query_vector: np.ndarray):
+        def build(table: AsyncTable):
+            if projection is not None:
+                # Fetch candidates from the smaller index, with their full vectors for rescoring
+                query = (
+                    table.query()
+                    .nearest_to(projection.transform(query_vector))
+                    .column(REDUCED_VECTOR_COLUMN)
+                    .select(SEARCH_COLUMNS + ["vector"])
+                )
+            else:
+                query = table.query().nearest_to(query_vector).column("vector")
+                query = query.select(SEARCH_COLUMNS)
+            query = query.distance_type("cosine").nprobes(20)
+            if refine_factor > 0 and projection is None:
+                # Over-fetch refine_factor * limit candidates and re-rank them by exact distance
+                query = query.refine_factor(refine_factor)
+            return query if country is None else query.where(_country_filter(country))
+
+        return build
+
+    if projection is None:
+        with metrics.time(endpoint, "search"):
+            return await asyncio.gather(
+                *(_search_tables(tables, build_query(v), limit, "_distance") for v in query_vectors)
+            )
+    candidate_limit = limit * settings.reduced_rescore_factor
+    with metrics.time(endpoint, "search"):
+        candidates = await asyncio.gather(
+            *(
+                _search_tables(tables, build_query(v), candidate_limit, "_distance")
+                for v in query_vectors
+            )
+        )
+    with metrics.time(endpoint, "rescore"):
+        return [rescore(rows, v, limit) for rows, v in zip(candidates, query_vectors)]
+
+
+async def _vector_search(
     request: Request,
     terms: str,
+    country: str | None = None,
 ) -> list[SearchResult] | None:
-    query_vector = request.app.model.encode(terms.lower())
-    search_result = (
-        request.app.table.search(query_vector)
-        .metric("cosine")
-        .nprobes(20)
-        .select(["id", "title", "description", "country", "variety", "price", "points"])
-        .limit(10)
-    ).to_pydantic(SearchResult)
+    tables = _get_tables(request.app, country)
+    if not tables:
+        return None
+    # Read before any await, as the watcher swaps them together with the table
+    projection, flat_index = request.app.projection, request.app.flat_index
+    # Only the CPU-bound encoding is offloaded to the thread pool
+    loop = asyncio.get_running_loop()
+    query_vector = await loop.run_in_executor(executor, _encode, request, terms)
+    (search_result,) = await _search_vectors(
+        "vector_search", tables, projection, flat_index, query_vector[None], country, 10
+    )
+    with metrics.time("vector_search", "convert"):
+        search_result = search_results_adapter.validate_python(search_result.to_pylist())
 
     if not search_result:
         return None
     return search_result
 
 
+async def _similar(
+    request: Request, wine_ids: list[int], country: str | None = None
+) -> dict[int, list[SearchResult]]:
+    """
+    Find the wines most similar to each wine in `wine_ids`, from the neighbors precomputed by
+    neighbors.py or by searching with its stored vector, so that nothing is encoded. Wines that
+    aren't in the table are left out of the result.
+    """
+    metrics.observe("similar", "queue_wait", time.perf_counter() - request.state.received)
+    app = request.app
+    tables = _get_tables(app, country)
+    lookup_tables = _get_tables_for_ids(app, wine_ids)
+    # Read before any await, as the watcher swaps them together with the table
+    projection, flat_index, neighbors = app.projection, app.flat_index, app.neighbors
+    if not tables:
+        return {}
+
+    results = {}
+    # Precomputed neighbors aren't filtered by country, so they're only used without a filter
+    precomputed = {} if country else {i: neighbors[i] for i in wine_ids if i in neighbors}
+    if precomputed:
+        with metrics.time("similar", "fetch"):
+            ids = {wine_id for row_ids in precomputed.values() for wine_id in row_ids}
+            rows = await _fetch_rows(tables, list(ids), SEARCH_COLUMNS)
+        results = {i: _take_ids(rows, row_ids) for i, row_ids in precomputed.items()}
+
+    missing = [i for i in dict.fromkeys(wine_ids) if i not in precomputed]
+    if missing:
+        with metrics.time("similar", "lookup"):
+            stored = await _fetch_rows(lookup_tables, missing, ["id", "vector"])
+        if stored.num_rows:
+            vectors = stored["vector"].combine_chunks()
+            vectors = vectors.values.to_numpy(zero_copy_only=False).reshape(len(vectors), -1)
+            # Fetch one more neighbor than needed, as each wine is its own nearest neighbor
+            found = await _search_vectors(
+                "similar", tables, projection, flat_index, vectors, country, 11
+            )
+            for wine_id, rows in zip(stored["id"].to_pylist(), found):
+                results[wine_id] = rows.filter(pc.not_equal(rows["id"], wine_id)).slice(0, 10)
+
+    with metrics.time("similar", "convert"):
+        return {
+            wine_id: search_results_adapter.validate_python(rows.to_pylist())
+            for wine_id, rows in results.items()
+        }
+
+
+def _get_columns(fields: list[str] | None) -> list[str]:
+    """The columns to look up, which always include `id`, rejecting fields that wines don't have"""
+    if not fields:
+        return WINE_COLUMNS
+    unknown = sorted(set(fields) - set(WINE_COLUMNS))
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown fields: {', '.join(unknown)}")
+    return ["id"] + [field for field in dict.fromkeys(fields) if field != "id"]
+
+
+async def _get_wines(request: Request, wine_ids: list[int], columns: list[str]) -> list[dict]:
+    """Look up wines by id on the scalar index of `id`, in the order of the (distinct) ids"""
+    metrics.observe("wines", "queue_wait", time.perf_counter() - request.state.received)
+    wine_ids = list(dict.fromkeys(wine_ids))
+    tables = _get_tables_for_ids(request.app, wine_ids)
+    with metrics.time("wines", "lookup"):
+        rows = await _fetch_rows(tables, wine_ids, columns)
+    with metrics.time("wines", "convert"):
+        return _take_ids(rows, wine_ids).to_pylist()
+
+
+async def _search_once(
+    request: Request, endpoint: str, search_func, query: str, country: str | None = None
+):
+    """Run `search_func`, sharing its result with concurrent requests for the same query"""
+    if not get_settings().dedupe_concurrent_queries:
+        return await search_func(request, query, country)
+    key = (endpoint, normalize_query(query), country)
+    result, shared = await singleflight.do(key, lambda: search_func(request, query, country))
+    if shared:
+        deduplicated.inc(endpoint)
+    return result
+
+
+async def _facet_search(request: Request, query: str, search: str, limit: int) -> pa.Table:
+    """Fetch the facet columns of a query's result set"""
+    tables = _get_tables(request.app, None)
+    if search == "fts":
+        score = "_score"
+
+        def build_query(table: AsyncTable):
+            search_query = table.query().nearest_to_text(query, columns="to_vectorize")
+            return search_query.select(FACET_COLUMNS)
+
+    else:
+        score = "_distance"
+        loop = asyncio.get_running_loop()
+        query_vector = await loop.run_in_executor(executor, request.app.model.encode, query.lower())
+
+        def build_query(table: AsyncTable):
+            return (
+                table.query()
+                .nearest_to(query_vector)
+                .column("vector")
+                .distance_type("cosine")
+                .nprobes(20)
+                .select(FACET_COLUMNS)
+            )
+
+    return await _search_tables(tables, build_query, limit, score)
+
+
+def _serialize(
+    request: Request, endpoint: str, result: list, adapter: TypeAdapter = search_results_adapter
+) -> Response:
+    """Serialize results to JSON here rather than in FastAPI, so that the cost can be measured"""
+    with metrics.time(endpoint, "serialize"):
+        content = adapter.dump_json(result)
+    metrics.observe(endpoint, "total", time.perf_counter() - request.state.received)
+    return Response(content=content, media_type="application/json")
+
+
 # --- Endpoints ---
 
 
@@ -102,15 +647,15 @@ async def fts_search(
     query: str = Query(
         description="Specify terms to search for in the variety, title and description"
     ),
-) -> list[SearchResult] | None:
-    loop = asyncio.get_running_loop()
-    result = await loop.run_in_executor(executor, _fts_search, request, query)
+    country: str | None = Query(default=None, description="Only return wines from this country"),
+) -> Response:
+    result = await _search_once(request, "fts_search", _fts_search, query, country)
     if not result:
         raise HTTPException(
             status_code=404,
             detail=f"No wine with the provided terms '{query}' found in database - please try again",
         )
-    return result
+    return _serialize(request, "fts_search", result)
 
 
 @app.get(
@@ -123,12 +668,127 @@ async def vector_search(
     query: str = Query(
         description="Specify terms to search for in the variety, title and description"
     ),
-) -> list[SearchResult] | None:
-    loop = asyncio.get_running_loop()
-    result = await loop.run_in_executor(executor, _vector_search, request, query)
+    country: str | None = Query(default=None, description="Only return wines from this country"),
+) -> Response:
+    if request.app.model is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Vector search is disabled on this server (ENABLE_VECTOR_SEARCH=false)",
+        )
+    result = await _search_once(request, "vector_search", _vector_search, query, country)
     if not result:
         raise HTTPException(
             status_code=404,
             detail=f"No wine with the provided terms '{query}' found in database - please try again",
         )
-    return result
+    return _serialize(request, "vector_search", result)
+
+
+@app.get(
+    "/similar/{wine_id}",
+    response_model=list[SearchResult],
+    response_description="Find the wines most similar to a wine, without encoding any text",
+)
+async def similar(
+    request: Request,
+    wine_id: int,
+    country: str | None = Query(default=None, description="Only return wines from this country"),
+) -> Response:
+    result = (await _similar(request, [wine_id], country)).get(wine_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"No wine with id {wine_id} found in database")
+    return _serialize(request, "similar", result)
+
+
+@app.get(
+    "/similar",
+    response_model=list[SimilarResult],
+    response_description="Find the wines most similar to each of a batch of wines",
+)
+async def similar_batch(
+    request: Request,
+    ids: list[int] = Query(description="Ids of the wines to find similar wines for (up to 100)"),
+    country: str | None = Query(default=None, description="Only return wines from this country"),
+) -> Response:
+    if len(ids) > 100:
+        raise HTTPException(status_code=422, detail="Up to 100 ids can be looked up at once")
+    found = await _similar(request, ids, country)
+    # Wines that aren't in the database are left out, and repeated ids are returned once
+    result = [
+        SimilarResult(id=wine_id, similar=found[wine_id])
+        for wine_id in dict.fromkeys(ids)
+        if wine_id in found
+    ]
+    return _serialize(request, "similar", result, similar_results_adapter)
+
+
+@app.get(
+    "/wines/{wine_id}",
+    response_model=dict[str, Any],
+    response_description="Look up a wine by id",
+)
+async def get_wine(
+    request: Request,
+    wine_id: int,
+    fields: list[str] | None = Query(
+        default=None, description="Only return these fields (the id is always returned)"
+    ),
+) -> Response:
+    result = await _get_wines(request, [wine_id], _get_columns(fields))
+    if not result:
+        raise HTTPException(status_code=404, detail=f"No wine with id {wine_id} found in database")
+    return _serialize(request, "wines", result[0], wine_adapter)
+
+
+@app.get(
+    "/wines",
+    response_model=list[dict[str, Any]],
+    response_description="Look up a batch of wines by id",
+)
+async def get_wines(
+    request: Request,
+    ids: list[int] = Query(description="Ids of the wines to look up (up to 1000)"),
+    fields: list[str] | None = Query(
+        default=None, description="Only return these fields (the id is always returned)"
+    ),
+) -> Response:
+    if len(ids) > 1000:
+        raise HTTPException(status_code=422, detail="Up to 1000 ids can be looked up at once")
+    # Wines that aren't in the database are left out, and repeated ids are returned once
+    result = await _get_wines(request, ids, _get_columns(fields))
+    return _serialize(request, "wines", result, wines_adapter)
+
+
+@app.get(
+    "/facets",
+    response_model=FacetResult,
+    response_description="Count wines by country, variety, taster and price bucket",
+)
+async def facets(
+    request: Request,
+    query: str | None = Query(
+        default=None, description="Only count wines in the result set of this query"
+    ),
+    search: Literal["fts", "vector"] = Query(
+        default="fts", description="Search type used to find the result set of the query"
+    ),
+    limit: int = Query(
+        default=1000, ge=1, le=10000, description="Maximum size of the result set of the query"
+    ),
+    size: int = Query(
+        default=20, ge=1, description="Number of most frequent values to return for each field"
+    ),
+) -> FacetResult:
+    if query is None:
+        # Global counts are precomputed, and refreshed when the table version changes
+        return truncate_facets(request.app.facets, size)
+    if search == "vector" and request.app.model is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Vector search is disabled on this server (ENABLE_VECTOR_SEARCH=false)",
+        )
+    with metrics.time("facets", "search"):
+        data = await _facet_search(request, query, search, limit)
+    with metrics.time("facets", "aggregate"):
+        result = compute_facets(data)
+    return truncate_facets(result, size)
@@ -44,10 +44,10 @@ async def async_get(
 async def main():
     if args.search == "fts":
         URL = "http://localhost:8000/fts_search"
-        queries = get_query_terms("keyword_terms.txt")
+        queries = get_query_terms(args.queries_file or "keyword_terms.txt")
     else:
         URL = "http://localhost:8000/vector_search"
-        queries = get_query_terms("vector_terms.txt")
+        queries = get_query_terms(args.queries_file or "vector_terms.txt")
 
     random_choice_queries = [random.choice(queries) for _ in range(LIMIT)]
 
@@ -67,11 +67,13 @@ if __name__ == "__main__":
     parser.add_argument("--seed", type=int, default=37, help="Seed for random number generator")
     parser.add_argument("--limit", "-l", type=int, default=10, help="Number of search terms to randomly generate")
     parser.add_argument("--search", type=str, default="fts", help="Specify whether to do FTS or vector search")
+    parser.add_argument("--queries-file", type=str, default=None, help="File in benchmark_queries to sample queries from (defaults to keyword_terms.txt or vector_terms.txt)")
     args = parser.parse_args()
     # fmt: on
 
     LIMIT = args.limit
     SEED = args.seed
+    random.seed(SEED)
 
     # Assert that the search type is only one of "fts" or "vector"
     assert args.search in ["fts", "vector"], "Please specify a valid search type: 'fts' or 'vector'"
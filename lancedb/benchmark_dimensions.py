@@ -0,0 +1,152 @@
+"""
+Run this script to benchmark the recall and latency of vector search on reduced-dimension vectors,
+for each dimension and reduction method, against the full-dimension index
+
+For each reduced dimension, a projection is fitted as `index.py --reduced-dim` would, and an
+IVF-PQ index is built on the reduced vectors of a scratch copy of the `id` and `vector` columns of
+the wines table, so the table served by the app is left untouched. Searches fetch
+`rescore_factor * k` candidates from the reduced index and rescore them with the full vectors, as
+the app does. Recall@k is measured against an exact search over all the stored full vectors.
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+import pyarrow as pa
+from benchmark_recall import exact_search, get_vectors
+from reduction import REDUCED_VECTOR_COLUMN, Projection, rescore
+from rich import progress
+
+import lancedb
+from lancedb.table import Table
+
+
+def build_table(data: pa.Table, projection: Projection | None) -> tuple[Table, float]:
+    """Create the scratch table, returning it and the time taken to build its ANN index"""
+    # The full-dimension index has the parameters of the index that index.py builds
+    vector_column, num_sub_vectors = "vector", 32
+    if projection is not None:
+        reduced = [projection.transform_batch(batch)[0] for batch in data.to_batches()]
+        data = data.append_column(REDUCED_VECTOR_COLUMN, pa.chunked_array(reduced))
+        vector_column, num_sub_vectors = REDUCED_VECTOR_COLUMN, projection.dim // 8
+    tbl = db.create_table(SCRATCH_TABLE, data=data, mode="overwrite")
+    start = time.perf_counter()
+    tbl.create_index(
+        metric="cosine",
+        num_partitions=4,
+        num_sub_vectors=num_sub_vectors,
+        vector_column_name=vector_column,
+        replace=True,
+    )
+    return tbl, time.perf_counter() - start
+
+
+def search(
+    tbl: Table, projection: Projection | None, query_vector: np.ndarray, k: int
+) -> list[int]:
+    if projection is None:
+        search_query = tbl.search(query_vector).metric("cosine").nprobes(NPROBES).select(["id"])
+        return search_query.limit(k).to_arrow()["id"].to_pylist()
+    search_query = (
+        tbl.search(projection.transform(query_vector), vector_column_name=REDUCED_VECTOR_COLUMN)
+        .metric("cosine")
+        .nprobes(NPROBES)
+        .select(["id", "vector"])
+        .limit(k * RESCORE_FACTOR)
+    )
+    return rescore(search_query.to_arrow(), query_vector, k)["id"].to_pylist()
+
+
+def get_configurations(full_dim: int) -> list[tuple[str, int]]:
+    methods = ["pca", "truncate"] if REDUCTION == "both" else [REDUCTION]
+    dims = [dim for dim in DIMS if dim < full_dim]
+    return [("full", full_dim)] + [(method, dim) for dim in dims for method in methods]
+
+
+def main():
+    source = db.open_table(TABLE)
+    data = source.to_lance().to_table(columns=["id", "vector"])
+    ids, vectors = get_vectors(source)
+    rng = random.Random(SEED)
+    # Stored vectors make for a large, cheap set of queries that needs no encoding
+    query_vectors = [vectors[i] for i in rng.sample(range(len(ids)), min(SAMPLE, len(ids)))]
+    ground_truth = [exact_search(ids, vectors, q, K) for q in query_vectors]
+    # Fit projections on the same sample of the stored (unnormalized) vectors as index.py does
+    fit_sample = np.random.default_rng(37).choice(len(ids), min(len(ids), 50_000), replace=False)
+    stored = data["vector"].combine_chunks()
+    stored = stored.values.to_numpy(zero_copy_only=False).reshape(len(stored), -1)
+    configurations = get_configurations(vectors.shape[1])
+
+    results = []
+    try:
+        with progress.Progress(
+            "[progress.description]{task.description}",
+            progress.BarColumn(),
+            "[progress.percentage]{task.percentage:>3.0f}%",
+            progress.TimeElapsedColumn(),
+        ) as prog:
+            for method, dim in configurations:
+                projection = None
+                if method != "full":
+                    projection = Projection.fit(method, dim, stored[np.sort(fit_sample)])
+                tbl, build_time = build_table(data, projection)
+                task = prog.add_task(f"{method} {dim}", total=len(query_vectors))
+                recalls, latencies = [], []
+                for query_vector, expected in zip(query_vectors, ground_truth):
+                    start = time.perf_counter()
+                    result = search(tbl, projection, query_vector, K)
+                    latencies.append(time.perf_counter() - start)
+                    recalls.append(len(expected.intersection(result)) / K)
+                    prog.update(task, advance=1)
+                results.append(
+                    (method, dim, build_time, np.mean(recalls), np.array(latencies) * 1000)
+                )
+    finally:
+        db.drop_table(SCRATCH_TABLE, ignore_missing=True)
+
+    print(
+        f"Recall@{K} and latency over {len(query_vectors)} queries with nprobes={NPROBES}, "
+        f"rescoring {RESCORE_FACTOR * K} candidates of reduced searches"
+    )
+    print(
+        f"{'method':>9} {'dim':>5} {'index sec':>10} {'recall':>8} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'QPS':>8}"
+    )
+    for method, dim, build_time, recall, latencies in results:
+        p50, p99 = np.percentile(latencies, [50, 99])
+        qps = 1000 / latencies.mean()
+        print(
+            f"{method:>9} {dim:>5} {build_time:>10.3f} {recall:>8.4f} {p50:>8.3f} {p99:>8.3f} {qps:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    # fmt: off
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, default=37, help="Seed for random number generator")
+    parser.add_argument("--sample", type=int, default=100, help="Number of stored vectors to sample as queries")
+    parser.add_argument("--dims", type=int, nargs="+", default=[256, 128, 64], help="Reduced dimensions to benchmark (multiples of 8)")
+    parser.add_argument("--reduction", type=str, default="both", choices=["pca", "truncate", "both"], help="Reduction methods to benchmark")
+    parser.add_argument("--rescore-factor", type=int, default=4, help="Rescore this many times k candidates of reduced searches with the full vectors")
+    parser.add_argument("--nprobes", type=int, default=20, help="Number of IVF partitions to search")
+    parser.add_argument("--k", type=int, default=10, help="Number of nearest neighbors to retrieve")
+    args = parser.parse_args()
+    # fmt: on
+
+    SEED = args.seed
+    SAMPLE = args.sample
+    DIMS = args.dims
+    REDUCTION = args.reduction
+    RESCORE_FACTOR = args.rescore_factor
+    NPROBES = args.nprobes
+    K = args.k
+    assert all(dim % 8 == 0 for dim in DIMS), "Reduced dimensions must be multiples of 8"
+
+    # Assumes that the table in the DB has already been created
+    DB_NAME = "./winemag"
+    TABLE = "wines"
+    SCRATCH_TABLE = "wines_dimensions_benchmark"
+    db = lancedb.connect(DB_NAME)
+
+    main()
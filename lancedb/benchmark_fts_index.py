@@ -0,0 +1,75 @@
+"""
+Run this script to compare the time taken to rebuild the FTS index from scratch against the time
+taken to update it incrementally, after a fraction of the catalog is appended to the table
+
+The benchmark runs on a scratch copy of the `id` and `to_vectorize` columns of the wines table,
+so the table served by the app is left untouched.
+"""
+import argparse
+import time
+
+import pyarrow as pa
+
+import lancedb
+from lancedb.db import DBConnection
+
+FTS_INDEX = "to_vectorize_idx"
+
+
+def benchmark_update(db: DBConnection, data: pa.Table, fraction: float) -> tuple[float, float]:
+    """Return the time for an incremental update and for a full rebuild after an append"""
+    num_new = max(1, int(len(data) * fraction))
+    base, new = data.slice(0, len(data) - num_new), data.slice(len(data) - num_new)
+
+    tbl = db.create_table(SCRATCH_TABLE, data=base, mode="overwrite")
+    tbl.create_fts_index("to_vectorize", use_tantivy=False)
+    tbl.add(new)
+
+    start = time.perf_counter()
+    tbl.to_lance().optimize.optimize_indices(index_names=[FTS_INDEX])
+    incremental = time.perf_counter() - start
+    tbl.checkout_latest()
+    stats = tbl.to_lance().stats.index_stats(FTS_INDEX)
+    assert stats["num_unindexed_rows"] == 0, "Incremental update did not index all new rows"
+
+    start = time.perf_counter()
+    tbl.create_fts_index("to_vectorize", use_tantivy=False, replace=True)
+    rebuild = time.perf_counter() - start
+    return incremental, rebuild
+
+
+def main():
+    tbl = db.open_table(TABLE)
+    data = tbl.to_lance().to_table(columns=["id", "to_vectorize"])
+    print(f"Updating the FTS index after appending a fraction of {len(data)} rows")
+    print(
+        f"{'fraction':>9} {'new rows':>9} {'incremental sec':>16} {'rebuild sec':>12} "
+        f"{'speedup':>8}"
+    )
+    try:
+        for fraction in FRACTIONS:
+            incremental, rebuild = benchmark_update(db, data, fraction)
+            num_new = max(1, int(len(data) * fraction))
+            print(
+                f"{fraction:>9} {num_new:>9} {incremental:>16.4f} {rebuild:>12.4f} {rebuild / incremental:>7.1f}x"
+            )
+    finally:
+        db.drop_table(SCRATCH_TABLE, ignore_missing=True)
+
+
+if __name__ == "__main__":
+    # fmt: off
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fractions", type=float, nargs="+", default=[0.001, 0.01, 0.1], help="Fractions of the catalog to append before updating the index")
+    args = parser.parse_args()
+    # fmt: on
+
+    FRACTIONS = args.fractions
+
+    # Assumes that the table in the DB has already been created
+    DB_NAME = "./winemag"
+    TABLE = "wines"
+    SCRATCH_TABLE = "wines_fts_benchmark"
+    db = lancedb.connect(DB_NAME)
+
+    main()
@@ -0,0 +1,110 @@
+"""
+Run this script to benchmark the latency of looking up wines by id, for each batch size, as the
+app's `/wines` endpoints do
+
+Each lookup reads the rows with a batch of random ids as one `id IN (...)` filter, which the
+scalar index on `id` (built by index.py) answers without scanning the table. With
+`--compare-scan`, the same lookups are also run with the scalar index disabled, as a full scan.
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+from rich import progress
+from schemas.wine import Wine
+from table_version import get_published_version
+
+import lancedb
+
+WINE_COLUMNS = list(Wine.model_fields)
+
+
+def lookup(dataset, ids: list[int], columns: list[str], use_scalar_index: bool) -> int:
+    """Read the rows with these ids, returning the number of rows found"""
+    rows = dataset.to_table(
+        columns=columns,
+        filter=f"id IN ({', '.join(str(i) for i in ids)})",
+        use_scalar_index=use_scalar_index,
+    )
+    return rows.num_rows
+
+
+def main():
+    version = get_published_version(DB_NAME, TABLE)
+    if version is not None:
+        tbl.checkout(version)
+    dataset = tbl.to_lance()
+    indexes = {index["name"] for index in dataset.list_indices()}
+    assert "id_idx" in indexes, "No scalar index on `id`, please run index.py first"
+    all_ids = dataset.to_table(columns=["id"])["id"].to_pylist()
+    columns = ["id"] + [field for field in FIELDS if field != "id"] if FIELDS else WINE_COLUMNS
+    modes = [("index", True), ("scan", False)] if COMPARE_SCAN else [("index", True)]
+
+    results = []
+    with progress.Progress(
+        "[progress.description]{task.description}",
+        progress.BarColumn(),
+        "[progress.percentage]{task.percentage:>3.0f}%",
+        progress.TimeElapsedColumn(),
+    ) as prog:
+        for batch_size in BATCH_SIZES:
+            batches = [
+                random.sample(all_ids, min(batch_size, len(all_ids))) for _ in range(ITERATIONS)
+            ]
+            for mode, use_scalar_index in modes:
+                task = prog.add_task(f"{mode} {batch_size}", total=ITERATIONS)
+                # Warm the index and file caches, so that the first lookup isn't an outlier
+                lookup(dataset, batches[0], columns, use_scalar_index)
+                latencies = []
+                for ids in batches:
+                    start = time.perf_counter()
+                    found = lookup(dataset, ids, columns, use_scalar_index)
+                    latencies.append(time.perf_counter() - start)
+                    assert found == len(ids), f"Found {found} of {len(ids)} ids"
+                    prog.update(task, advance=1)
+                results.append((mode, len(batches[0]), np.array(latencies) * 1000))
+
+    print(
+        f"Lookup latency over {ITERATIONS} batches of random ids from {len(all_ids)} rows "
+        f"(version {tbl.version}), reading {len(columns)} columns"
+    )
+    print(
+        f"{'mode':>6} {'batch':>6} {'mean ms':>9} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'ms/id':>8} {'ids/s':>9}"
+    )
+    for mode, batch_size, latencies in results:
+        p50, p99 = np.percentile(latencies, [50, 99])
+        per_id = latencies.mean() / batch_size
+        print(
+            f"{mode:>6} {batch_size:>6} {latencies.mean():>9.3f} {p50:>8.3f} {p99:>8.3f} "
+            f"{per_id:>8.4f} {1000 / per_id:>9.0f}"
+        )
+
+
+if __name__ == "__main__":
+    # fmt: off
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, default=37, help="Seed for random number generator")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 100, 1000], help="Numbers of ids to look up at once")
+    parser.add_argument("--iterations", type=int, default=100, help="Number of lookups to time per batch size")
+    parser.add_argument("--fields", type=str, nargs="+", default=None, help="Only read these columns (defaults to all the columns of a wine)")
+    parser.add_argument("--compare-scan", action="store_true", help="Also time the lookups as full scans, without the scalar index")
+    args = parser.parse_args()
+    # fmt: on
+
+    SEED = args.seed
+    BATCH_SIZES = args.batch_sizes
+    ITERATIONS = args.iterations
+    FIELDS = args.fields
+    COMPARE_SCAN = args.compare_scan
+    random.seed(SEED)
+    assert not FIELDS or set(FIELDS) <= set(WINE_COLUMNS), f"Fields must be in {WINE_COLUMNS}"
+
+    # Assumes that the table in the DB has already been created
+    DB_NAME = "./winemag"
+    TABLE = "wines"
+    db = lancedb.connect(DB_NAME)
+    tbl = db.open_table(TABLE)
+
+    main()
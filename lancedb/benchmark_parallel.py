@@ -0,0 +1,138 @@
+"""
+Run this script to benchmark how LanceDB search scales across cores, in-process and without HTTP
+
+The `fts_search` and `search_vector` functions of the serial benchmark are run from thread pools
+and process pools of increasing size against the same table. Query vectors are encoded once,
+before any search, so that only the search itself is measured. Each worker process opens its own
+handle to the table, while threads share one.
+"""
+import argparse
+import multiprocessing
+import random
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+
+import numpy as np
+from benchmark_serial import fts_search, get_query_terms, load_flat_index, search_vector
+from config import Settings
+
+import lancedb
+from lancedb.table import Table
+
+# The table searched by the queries of this process, shared by its threads
+worker_table: Table | None = None
+
+
+@lru_cache()
+def get_settings():
+    # Use lru_cache to avoid loading .env file for every request
+    return Settings()
+
+
+def init_worker(db_name: str, table_name: str, engine: str = "ann") -> None:
+    global worker_table, worker_flat_index
+    worker_table = lancedb.connect(db_name).open_table(table_name)
+    # Worker processes map the same flat index file, so they share one copy of it in memory
+    worker_flat_index = load_flat_index(db_name, worker_table) if engine == "flat" else None
+
+
+def run_query(query: str | np.ndarray, refine_factor: int = 0) -> float:
+    """Run an FTS query (a string) or a vector search (a query vector) and return its latency"""
+    start = time.perf_counter()
+    if isinstance(query, str):
+        fts_search(worker_table, query)
+    else:
+        search_vector(worker_table, query, refine_factor, worker_flat_index)
+    return time.perf_counter() - start
+
+
+def get_workload() -> list[str | np.ndarray]:
+    rng = random.Random(SEED)
+    if args.search == "fts":
+        queries = get_query_terms(args.queries_file or "keyword_terms.txt")
+        return [rng.choice(queries) for _ in range(LIMIT)]
+    if args.stored_vectors:
+        # Stored vectors make for query vectors that need no model at all
+        data = lancedb.connect(DB_NAME).open_table(TABLE).to_lance().to_table(columns=["vector"])
+        vectors = data["vector"].to_numpy(zero_copy_only=False)
+        return [vectors[rng.randrange(len(vectors))] for _ in range(LIMIT)]
+    # Imported lazily so that FTS runs never pay for importing torch
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(get_settings().embedding_model_checkpoint)
+    queries = get_query_terms(args.queries_file or "vector_terms.txt")
+    query_vectors = {query: model.encode(query.lower()) for query in set(queries)}
+    return [query_vectors[rng.choice(queries)] for _ in range(LIMIT)]
+
+
+def get_executor(pool: str, workers: int) -> Executor:
+    if pool == "thread":
+        return ThreadPoolExecutor(max_workers=workers)
+    # Spawn rather than fork worker processes, as forking a process with a live LanceDB handle
+    # (and its Rust thread pools) isn't safe
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(DB_NAME, TABLE, args.engine),
+    )
+
+
+def benchmark_pool(pool: str, workers: int, workload: list) -> tuple[float, np.ndarray]:
+    """Return the QPS and the latencies (ms) of the workload run on a pool of `workers`"""
+    search = partial(run_query, refine_factor=args.refine_factor)
+    # Batch queries sent to worker processes, to amortize the cost of inter-process communication
+    chunksize = max(1, len(workload) // (workers * 16)) if pool == "process" else 1
+    with get_executor(pool, workers) as executor:
+        # Warm up every worker (including process startup) before timing
+        list(executor.map(search, workload[: workers * 4]))
+        start = time.perf_counter()
+        latencies = list(executor.map(search, workload, chunksize=chunksize))
+        elapsed = time.perf_counter() - start
+    return len(workload) / elapsed, np.array(latencies) * 1000
+
+
+def main():
+    workload = get_workload()
+    # Threads in this process search the table opened here
+    init_worker(DB_NAME, TABLE, args.engine)
+
+    print(f"Running {LIMIT} {args.search} queries on each pool")
+    print(f"{'pool':>8} {'workers':>8} {'QPS':>9} {'speedup':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for pool in POOLS:
+        baseline = None
+        for workers in WORKERS:
+            qps, latencies = benchmark_pool(pool, workers, workload)
+            baseline = baseline or qps
+            p50, p99 = np.percentile(latencies, [50, 99])
+            print(
+                f"{pool:>8} {workers:>8} {qps:>9.1f} {qps / baseline:>7.2f}x {p50:>8.3f} {p99:>8.3f}"
+            )
+
+
+if __name__ == "__main__":
+    # fmt: off
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, default=37, help="Seed for random number generator")
+    parser.add_argument("--limit", "-l", type=int, default=1000, help="Number of search terms to randomly generate")
+    parser.add_argument("--search", type=str, default="fts", choices=["fts", "vector"], help="Specify whether to do FTS or vector search")
+    parser.add_argument("--queries-file", type=str, default=None, help="File in benchmark_queries to sample queries from (defaults to keyword_terms.txt or vector_terms.txt)")
+    parser.add_argument("--pool", type=str, default="both", choices=["thread", "process", "both"], help="Run queries on a thread pool, a process pool, or both")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="Pool sizes to benchmark")
+    parser.add_argument("--stored-vectors", action="store_true", help="Use stored vectors as query vectors instead of encoding the vector search queries")
+    parser.add_argument("--refine-factor", type=int, default=0, help="Re-rank refine_factor * k vector search candidates by exact distance (0 disables)")
+    parser.add_argument("--engine", type=str, default="ann", choices=["ann", "flat"], help="Run vector search on the IVF-PQ index, or as an exact scan of the flat index")
+    args = parser.parse_args()
+    # fmt: on
+
+    LIMIT = args.limit
+    SEED = args.seed
+    POOLS = ["thread", "process"] if args.pool == "both" else [args.pool]
+    WORKERS = sorted(args.workers)
+
+    # Assumes that the table in the DB has already been created
+    DB_NAME = "./winemag"
+    TABLE = "wines"
+
+    main()
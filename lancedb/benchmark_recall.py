@@ -0,0 +1,176 @@
+"""
+Run this script to benchmark the recall and latency of vector search at different refine factors
+
+The IVF-PQ index ranks candidates by their distances to PQ-compressed vectors. With a refine factor
+`r`, LanceDB over-fetches `r * k` candidates from the index and re-ranks them by their exact
+distances to the stored full-precision vectors. Recall@k is measured against an exact search over
+all the stored vectors.
+
+The same queries are then run on the flat index, an exact scan of all the vectors in memory, in
+batches of each size in `--flat-batch-sizes`, to show where the ANN index stops being worth it.
+"""
+import argparse
+import random
+import time
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+from benchmark_serial import load_flat_index
+from config import Settings
+from flat_index import FlatIndex
+from rich import progress
+
+import lancedb
+from lancedb.table import Table
+
+
+@lru_cache()
+def get_settings():
+    # Use lru_cache to avoid loading .env file for every request
+    return Settings()
+
+
+def get_query_terms(filename: str) -> list[str]:
+    assert filename.endswith(".txt")
+    query_terms_file = Path("./benchmark_queries") / filename
+    with open(query_terms_file, "r") as f:
+        queries = f.readlines()
+    assert queries
+    result = [query.strip() for query in queries]
+    return result
+
+
+def get_vectors(table: Table) -> tuple[np.ndarray, np.ndarray]:
+    """Load the ids and L2-normalized vectors of all rows, for exact search"""
+    data = table.to_lance().to_table(columns=["id", "vector"])
+    ids = data["id"].to_numpy()
+    vectors = data["vector"].combine_chunks()
+    vectors = vectors.values.to_numpy().reshape(len(vectors), -1)
+    return ids, vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def exact_search(ids: np.ndarray, vectors: np.ndarray, query_vector: np.ndarray, k: int) -> set:
+    similarities = vectors @ (query_vector / np.linalg.norm(query_vector))
+    top_k = np.argpartition(-similarities, k)[:k]
+    return set(ids[top_k].tolist())
+
+
+def ann_search(table: Table, query_vector: np.ndarray, k: int, refine_factor: int) -> list[int]:
+    search_query = (
+        table.search(query_vector, vector_column_name="vector")
+        .metric("cosine")
+        .nprobes(NPROBES)
+        .select(["id"])
+        .limit(k)
+    )
+    if refine_factor > 0:
+        search_query = search_query.refine_factor(refine_factor)
+    return search_query.to_arrow()["id"].to_pylist()
+
+
+def benchmark_flat(
+    flat_index: FlatIndex, query_vectors: list[np.ndarray], ground_truth: list[set], batch_size: int
+) -> tuple[float, np.ndarray, float]:
+    """Return the recall, the latencies (ms) of each batch and the QPS of the flat index"""
+    recalls, latencies = [], []
+    for i in range(0, len(query_vectors), batch_size):
+        start = time.perf_counter()
+        ids, _ = flat_index.search(np.stack(query_vectors[i : i + batch_size]), K)
+        latencies.append(time.perf_counter() - start)
+        for result, expected in zip(ids.tolist(), ground_truth[i : i + batch_size]):
+            recalls.append(len(expected.intersection(result)) / K)
+    return np.mean(recalls), np.array(latencies) * 1000, len(query_vectors) / sum(latencies)
+
+
+def get_query_vectors(ids: np.ndarray, vectors: np.ndarray) -> list[np.ndarray]:
+    rng = random.Random(SEED)
+    # Stored vectors make for a large, cheap set of queries that needs no encoding
+    sample = rng.sample(range(len(ids)), min(args.sample, len(ids)))
+    query_vectors = [vectors[i] for i in sample]
+    if args.text_queries:
+        # Imported lazily so that runs on stored vectors alone never pay for importing torch
+        from sentence_transformers import SentenceTransformer
+
+        model = SentenceTransformer(get_settings().embedding_model_checkpoint)
+        # Generated workloads repeat queries, which only need to be encoded once
+        queries = list(dict.fromkeys(get_query_terms(args.queries_file or "vector_terms.txt")))
+        query_vectors += [model.encode(query.lower()) for query in queries]
+    return query_vectors
+
+
+def main():
+    ids, vectors = get_vectors(tbl)
+    query_vectors = get_query_vectors(ids, vectors)
+    ground_truth = [exact_search(ids, vectors, q, K) for q in query_vectors]
+
+    results = []
+    with progress.Progress(
+        "[progress.description]{task.description}",
+        progress.BarColumn(),
+        "[progress.percentage]{task.percentage:>3.0f}%",
+        progress.TimeElapsedColumn(),
+    ) as prog:
+        for refine_factor in REFINE_FACTORS:
+            task = prog.add_task(f"Refine factor {refine_factor}", total=len(query_vectors))
+            recalls, latencies = [], []
+            for query_vector, expected in zip(query_vectors, ground_truth):
+                start = time.perf_counter()
+                result = ann_search(tbl, query_vector, K, refine_factor)
+                latencies.append(time.perf_counter() - start)
+                recalls.append(len(expected.intersection(result)) / K)
+                prog.update(task, advance=1)
+            results.append((refine_factor, np.mean(recalls), np.array(latencies) * 1000))
+
+    print(f"Recall@{K} and latency over {len(query_vectors)} queries with nprobes={NPROBES}")
+    print(
+        f"{'refine factor':>14} {'recall':>8} {'mean ms':>9} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'QPS':>8}"
+    )
+    for refine_factor, recall, latencies in results:
+        p50, p99 = np.percentile(latencies, [50, 99])
+        qps = 1000 / latencies.mean()
+        print(
+            f"{refine_factor:>14} {recall:>8.4f} {latencies.mean():>9.3f} {p50:>8.3f} {p99:>8.3f} {qps:>8.1f}"
+        )
+
+    if not FLAT_BATCH_SIZES:
+        return
+    flat_index = load_flat_index(DB_NAME, tbl)
+    print(f"Recall@{K} and latency per batch of queries of the flat index")
+    print(f"{'batch size':>14} {'recall':>8} {'mean ms':>9} {'p50 ms':>8} {'p99 ms':>8} {'QPS':>8}")
+    for batch_size in FLAT_BATCH_SIZES:
+        recall, latencies, qps = benchmark_flat(flat_index, query_vectors, ground_truth, batch_size)
+        p50, p99 = np.percentile(latencies, [50, 99])
+        print(
+            f"{batch_size:>14} {recall:>8.4f} {latencies.mean():>9.3f} {p50:>8.3f} {p99:>8.3f} {qps:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    # fmt: off
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, default=37, help="Seed for random number generator")
+    parser.add_argument("--sample", type=int, default=100, help="Number of stored vectors to sample as queries")
+    parser.add_argument("--text-queries", action=argparse.BooleanOptionalAction, default=True, help="Also encode the vector search benchmark queries")
+    parser.add_argument("--queries-file", type=str, default=None, help="File in benchmark_queries to sample queries from (defaults to vector_terms.txt)")
+    parser.add_argument("--refine-factors", type=int, nargs="+", default=[0, 1, 2, 5, 10, 20], help="Refine factors to benchmark (0 disables re-ranking)")
+    parser.add_argument("--flat-batch-sizes", type=int, nargs="*", default=[1, 10, 100], help="Batch sizes of queries to run on the flat index (none skips it)")
+    parser.add_argument("--nprobes", type=int, default=20, help="Number of IVF partitions to search")
+    parser.add_argument("--k", type=int, default=10, help="Number of nearest neighbors to retrieve")
+    args = parser.parse_args()
+    # fmt: on
+
+    SEED = args.seed
+    REFINE_FACTORS = args.refine_factors
+    FLAT_BATCH_SIZES = args.flat_batch_sizes
+    NPROBES = args.nprobes
+    K = args.k
+
+    # Assumes that the table in the DB has already been created
+    DB_NAME = "./winemag"
+    TABLE = "wines"
+    db = lancedb.connect(DB_NAME)
+    tbl = db.open_table(TABLE)
+
+    main()
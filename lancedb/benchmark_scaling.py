@@ -0,0 +1,226 @@
+"""
+Run this script to benchmark how ingest, index build and search scale with the number of rows
+
+Each size is ingested from the first rows of an Arrow file generated by `data/scale.py`, which
+already contains vectors, so that encoding doesn't dominate the ingest time. Search latency is
+measured on FTS queries from `benchmark_queries` and on stored vectors used as query vectors.
+Each size runs in a fresh process, so that its peak RSS isn't carried over from smaller sizes.
+The results are written to a JSON file and, if matplotlib is installed, plotted.
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import random
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+from codetiming import Timer
+
+import lancedb
+from lancedb.table import Table
+
+
+def get_query_terms(filename: str) -> list[str]:
+    assert filename.endswith(".txt")
+    query_terms_file = Path("./benchmark_queries") / filename
+    with open(query_terms_file, "r") as f:
+        queries = f.readlines()
+    assert queries
+    result = [query.strip() for query in queries]
+    return result
+
+
+def get_peak_rss_mb() -> float:
+    # ru_maxrss is in KB on Linux, and is the peak of the whole process so far
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def init_worker(
+    source: Path,
+    db_name: str,
+    scratch_table: str,
+    query_terms: list[str],
+    num_queries: int,
+    seed: int,
+) -> None:
+    """Set the globals that a spawned process needs, as it doesn't run the `__main__` block"""
+    global SOURCE, DB_NAME, SCRATCH_TABLE, QUERY_TERMS, NUM_QUERIES, SEED, db
+    SOURCE, DB_NAME, SCRATCH_TABLE = source, db_name, scratch_table
+    QUERY_TERMS, NUM_QUERIES, SEED = query_terms, num_queries, seed
+    db = lancedb.connect(DB_NAME)
+
+
+def read_rows(path: Path, num_rows: int) -> pa.RecordBatchReader:
+    """Stream the first `num_rows` rows of an Arrow file, without loading the file into memory"""
+    reader = pa.ipc.open_file(pa.memory_map(str(path)))
+
+    def batches():
+        remaining = num_rows
+        for i in range(reader.num_record_batches):
+            if remaining <= 0:
+                return
+            batch = reader.get_batch(i).slice(0, remaining)
+            remaining -= batch.num_rows
+            yield batch
+
+    return pa.RecordBatchReader.from_batches(reader.schema, batches())
+
+
+def measure_latencies(search, queries: list) -> dict[str, float]:
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query)
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000
+    p50, p99 = np.percentile(latencies, [50, 99])
+    return {"p50_ms": p50, "p99_ms": p99, "qps": 1000 / latencies.mean()}
+
+
+def benchmark_size(num_rows: int) -> dict[str, float]:
+    result = {"rows": num_rows}
+    timer_text = f"[{num_rows} rows] {{name}} in {{:.4f}} sec"
+    with Timer(name="Ingest", text=timer_text) as timer:
+        tbl = db.create_table(SCRATCH_TABLE, data=read_rows(SOURCE, num_rows), mode="overwrite")
+    result["ingest_sec"] = timer.last
+    assert len(tbl) == num_rows, f"Only {len(tbl)} rows in the source file"
+
+    # Choose num partitions as a power of 2 that's closest to len(dataset) // 5000
+    num_partitions = 2 ** max(0, round(math.log2(max(1, num_rows // 5000))))
+    with Timer(name="ANN index", text=timer_text) as timer:
+        tbl.create_index(
+            metric="cosine", num_partitions=num_partitions, num_sub_vectors=32, replace=True
+        )
+    result["ann_index_sec"] = timer.last
+    with Timer(name="FTS index", text=timer_text) as timer:
+        tbl.create_fts_index("to_vectorize", use_tantivy=False, replace=True)
+    result["fts_index_sec"] = timer.last
+    result["peak_rss_mb"] = get_peak_rss_mb()
+    table_dir = Path(DB_NAME) / f"{SCRATCH_TABLE}.lance"
+    result["disk_mb"] = sum(f.stat().st_size for f in table_dir.rglob("*") if f.is_file()) / 2**20
+
+    rng = random.Random(SEED)
+    fts_queries = [rng.choice(QUERY_TERMS) for _ in range(NUM_QUERIES)]
+    result["fts"] = measure_latencies(lambda query: fts_search(tbl, query), fts_queries)
+    # Stored vectors make for query vectors that need no encoding
+    sample = sorted(rng.sample(range(num_rows), min(NUM_QUERIES, num_rows)))
+    vectors = tbl.to_lance().take(sample, columns=["vector"])["vector"]
+    vectors = vectors.to_numpy(zero_copy_only=False)
+    result["vector"] = measure_latencies(lambda vector: vector_search(tbl, vector), vectors)
+    return result
+
+
+def drop_scratch_table() -> None:
+    db.drop_table(SCRATCH_TABLE, ignore_missing=True)
+
+
+def run_in_process(func, *args):
+    """Run a function in a fresh process, so that it has its own peak RSS"""
+    with ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(SOURCE, DB_NAME, SCRATCH_TABLE, QUERY_TERMS, NUM_QUERIES, SEED),
+    ) as pool:
+        return pool.submit(func, *args).result()
+
+
+def fts_search(tbl: Table, query: str) -> pa.Table:
+    return tbl.search(query, query_type="fts").select(["id"]).limit(10).to_arrow()
+
+
+def vector_search(tbl: Table, query_vector: np.ndarray) -> pa.Table:
+    search_query = tbl.search(query_vector, vector_column_name="vector").metric("cosine")
+    search_query = search_query.nprobes(20).select(["id"]).limit(10)
+    return search_query.to_arrow()
+
+
+def print_results(results: list[dict]) -> None:
+    print(
+        f"{'rows':>10} {'ingest s':>9} {'ANN s':>8} {'FTS s':>8} {'RSS MB':>8} {'disk MB':>8} "
+        f"{'FTS p50':>8} {'FTS p99':>8} {'vec p50':>8} {'vec p99':>8}"
+    )
+    for r in results:
+        print(
+            f"{r['rows']:>10} {r['ingest_sec']:>9.2f} {r['ann_index_sec']:>8.2f} "
+            f"{r['fts_index_sec']:>8.2f} {r['peak_rss_mb']:>8.0f} {r['disk_mb']:>8.0f} "
+            f"{r['fts']['p50_ms']:>8.3f} {r['fts']['p99_ms']:>8.3f} "
+            f"{r['vector']['p50_ms']:>8.3f} {r['vector']['p99_ms']:>8.3f}"
+        )
+
+
+def plot_results(results: list[dict], path: Path) -> None:
+    try:
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("Install matplotlib to plot the scaling curves")
+        return
+    rows = [r["rows"] for r in results]
+    fig, (ax_build, ax_search) = plt.subplots(1, 2, figsize=(12, 5))
+    build_stages = {
+        "ingest_sec": "Ingest",
+        "ann_index_sec": "ANN index",
+        "fts_index_sec": "FTS index",
+    }
+    for key, label in build_stages.items():
+        ax_build.plot(rows, [r[key] for r in results], marker="o", label=label)
+    ax_build.set(xscale="log", yscale="log", xlabel="Rows", ylabel="Time (sec)", title="Build time")
+    for search in ["fts", "vector"]:
+        for percentile in ["p50", "p99"]:
+            latencies = [r[search][f"{percentile}_ms"] for r in results]
+            ax_search.plot(rows, latencies, marker="o", label=f"{search} {percentile}")
+    ax_search.set(xscale="log", xlabel="Rows", ylabel="Latency (ms)", title="Search latency")
+    for ax in (ax_build, ax_search):
+        ax.legend()
+        ax.grid(True, which="both", alpha=0.3)
+    fig.tight_layout()
+    fig.savefig(path)
+    print(f"Plotted scaling curves to {path}")
+
+
+def main():
+    results = []
+    try:
+        for num_rows in sorted(SIZES):
+            result = run_in_process(benchmark_size, num_rows)
+            print_results([result])
+            results.append(result)
+    finally:
+        if not args.keep:
+            run_in_process(drop_scratch_table)
+    print_results(results)
+    Path(OUTPUT).write_text(json.dumps(results, indent=2))
+    print(f"Wrote results to {OUTPUT}")
+    plot_results(results, Path(OUTPUT).with_suffix(".png"))
+
+
+if __name__ == "__main__":
+    # fmt: off
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--filename", type=str, default="winemag-data-10000000.arrow", help="Name of the Arrow file generated by data/scale.py")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[129_971, 1_000_000, 10_000_000], help="Numbers of rows to benchmark")
+    parser.add_argument("--queries", type=int, default=200, help="Number of FTS and vector search queries at each size")
+    parser.add_argument("--queries-file", type=str, default="keyword_terms.txt", help="File in benchmark_queries to sample FTS queries from")
+    parser.add_argument("--seed", type=int, default=37, help="Seed for random number generator")
+    parser.add_argument("--output", "-o", type=str, default="benchmark_scaling.json", help="Path of the JSON results file (the plot is saved next to it)")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch table of the largest size")
+    args = parser.parse_args()
+    # fmt: on
+
+    SOURCE = Path(__file__).parents[1] / "data" / args.filename
+    SIZES = args.sizes
+    NUM_QUERIES = args.queries
+    QUERY_TERMS = get_query_terms(args.queries_file)
+    SEED = args.seed
+    OUTPUT = args.output
+
+    DB_NAME = "./winemag"
+    SCRATCH_TABLE = "wines_scaling_benchmark"
+    # The table is only opened in the processes that run each size (see init_worker)
+
+    main()
@@ -3,17 +3,20 @@ Run this script to benchmark the serial search performance of FTS and vector sea
 """
 import argparse
 import random
+import time
 from functools import lru_cache
 from pathlib import Path
 from typing import Any
 
+import numpy as np
 from codetiming import Timer
 from config import Settings
+from flat_index import FlatIndex, build_flat_index
 from rich import progress
 from schemas.wine import SearchResult
-from sentence_transformers import SentenceTransformer
 
 import lancedb
+from lancedb.query import LanceQueryBuilder
 from lancedb.table import Table
 
 # Custom types
@@ -36,42 +39,151 @@ def get_query_terms(filename: str) -> list[str]:
     return result
 
 
-def fts_search(table: Table, query: str) -> list[SearchResult] | None:
-    search_result = (
+def get_fts_query(table: Table, query: str) -> LanceQueryBuilder:
+    return (
         table.search(query, vector_column_name="description")
         .select(["id", "title", "description", "country", "variety", "price", "points"])
         .limit(10)
-    ).to_pydantic(SearchResult)
-    if not search_result:
-        return None
-    return search_result
+    )
 
 
-def vector_search(model, table: Table, query: str) -> list[SearchResult] | None:
-    query_vector = model.encode(query.lower())
-    search_result = (
-        table.search(query_vector)
+def get_vector_query(
+    table: Table, query_vector: np.ndarray, refine_factor: int = 0
+) -> LanceQueryBuilder:
+    search_query = (
+        table.search(query_vector, vector_column_name="vector")
         .metric("cosine")
         .nprobes(20)
         .select(["id", "title", "description", "country", "variety", "price", "points"])
         .limit(10)
-    ).to_pydantic(SearchResult)
+    )
+    if refine_factor > 0:
+        # Over-fetch refine_factor * 10 candidates and re-rank them by their exact distances
+        search_query = search_query.refine_factor(refine_factor)
+    return search_query
+
+
+def load_flat_index(db_name: str, table: Table) -> FlatIndex:
+    """Memory-map the flat index of the table's version, building it if it's missing"""
+    flat_index = FlatIndex.open(db_name, table.name, table.version)
+    if flat_index is None:
+        data = table.to_lance().to_table(columns=["id", "vector"])
+        flat_index = build_flat_index(db_name, table.name, table.version, data)
+    return flat_index
+
+
+def fetch_rows(table: Table, ids: list[int]) -> list[JsonBlob]:
+    """Fetch the result columns of the rows with these ids, in the order of the ids"""
+    rows = (
+        table.search()
+        .where(f"id IN ({', '.join(str(i) for i in ids)})")
+        .select(["id", "title", "description", "country", "variety", "price", "points"])
+        .limit(len(ids))
+        .to_list()
+    )
+    rows_by_id = {row["id"]: row for row in rows}
+    return [rows_by_id[i] for i in ids if i in rows_by_id]
 
+
+def fts_search(table: Table, query: str) -> list[SearchResult] | None:
+    search_result = get_fts_query(table, query).to_pydantic(SearchResult)
     if not search_result:
         return None
     return search_result
 
 
+def vector_search(
+    model, table: Table, query: str, refine_factor: int = 0, flat_index: FlatIndex | None = None
+) -> list[SearchResult] | None:
+    query_vector = model.encode(query.lower())
+    return search_vector(table, query_vector, refine_factor, flat_index)
+
+
+def search_vector(
+    table: Table,
+    query_vector: np.ndarray,
+    refine_factor: int = 0,
+    flat_index: FlatIndex | None = None,
+) -> list[SearchResult] | None:
+    """Vector search with an already encoded query vector, on the flat index if one is given"""
+    if flat_index is not None:
+        ids, _ = flat_index.search(query_vector, 10)
+        search_result = [SearchResult(**row) for row in fetch_rows(table, ids[0].tolist())]
+    else:
+        search_query = get_vector_query(table, query_vector, refine_factor)
+        search_result = search_query.to_pydantic(SearchResult)
+
+    if not search_result:
+        return None
+    return search_result
+
+
+def time_stages(
+    table: Table, query: str, query_vector: np.ndarray | None = None
+) -> dict[str, float]:
+    """Run a query and return the time taken by each of its stages, in seconds"""
+    stages = {}
+    if args.search == "vector" and query_vector is None:
+        start = time.perf_counter()
+        query_vector = MODEL.encode(query.lower())
+        stages["encode"] = time.perf_counter() - start
+    if args.search == "vector" and FLAT_INDEX is not None:
+        start = time.perf_counter()
+        ids, _ = FLAT_INDEX.search(query_vector, 10)
+        stages["search"] = time.perf_counter() - start
+        start = time.perf_counter()
+        rows = fetch_rows(table, ids[0].tolist())
+        stages["fetch"] = time.perf_counter() - start
+        start = time.perf_counter()
+        _ = [SearchResult(**row) for row in rows]
+        stages["convert"] = time.perf_counter() - start
+        return stages
+    if args.search == "fts":
+        search_query = get_fts_query(table, query)
+    else:
+        search_query = get_vector_query(table, query_vector, args.refine_factor)
+    start = time.perf_counter()
+    result = search_query.to_arrow()
+    stages["search"] = time.perf_counter() - start
+    # The same conversion as `to_pydantic`, timed separately from the search
+    start = time.perf_counter()
+    _ = [SearchResult(**row) for row in result.to_pylist()]
+    stages["convert"] = time.perf_counter() - start
+    return stages
+
+
+def print_stages(stage_timings: list[dict[str, float]]) -> None:
+    """Print the latency distribution of each stage, and its share of the total time"""
+    total = sum(sum(stages.values()) for stages in stage_timings)
+    print(f"{'stage':>8} {'mean ms':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'share':>7}")
+    for stage in stage_timings[0]:
+        latencies = np.array([stages[stage] for stages in stage_timings]) * 1000
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        share = latencies.sum() / 1000 / total
+        print(
+            f"{stage:>8} {latencies.mean():>9.3f} {p50:>8.3f} {p90:>8.3f} {p99:>8.3f} {share:>7.1%}"
+        )
+
+
 def main():
     if args.search == "fts":
         URL = "http://localhost:8000/fts_search"
-        queries = get_query_terms("keyword_terms.txt")
+        queries = get_query_terms(args.queries_file or "keyword_terms.txt")
     else:
         URL = "http://localhost:8000/vector_search"
-        queries = get_query_terms("vector_terms.txt")
+        queries = get_query_terms(args.queries_file or "vector_terms.txt")
 
     random_choice_queries = [random.choice(queries) for _ in range(LIMIT)]
 
+    query_vectors = {}
+    if args.search == "vector" and args.precomputed_vectors:
+        # Encode each distinct query up front, so that the timed run replays the query vectors
+        with Timer(name="Encode queries", text="Encoded query vectors in {:.4f} sec"):
+            query_vectors = {
+                query: MODEL.encode(query.lower()) for query in set(random_choice_queries)
+            }
+
+    stage_timings = []
     # Run the search directly on the lancedb table
     with Timer(name="Serial search", text="Finished search in {:.4f} sec"):
         # Add rich progress bar
@@ -85,11 +197,17 @@ def main():
                 f"Performing {args.search} search", total=len(random_choice_queries)
             )
             for query in random_choice_queries:
-                if args.search == "fts":
+                if args.stages:
+                    stage_timings.append(time_stages(tbl, query, query_vectors.get(query)))
+                elif args.search == "fts":
                     _ = fts_search(tbl, query)
+                elif query in query_vectors:
+                    _ = search_vector(tbl, query_vectors[query], args.refine_factor, FLAT_INDEX)
                 else:
-                    _ = vector_search(MODEL, tbl, query)
+                    _ = vector_search(MODEL, tbl, query, args.refine_factor, FLAT_INDEX)
                 prog.update(overall_progress_task, advance=1)
+    if args.stages:
+        print_stages(stage_timings)
 
 
 if __name__ == "__main__":
@@ -98,11 +216,17 @@ if __name__ == "__main__":
     parser.add_argument("--seed", type=int, default=37, help="Seed for random number generator")
     parser.add_argument("--limit", "-l", type=int, default=10, help="Number of search terms to randomly generate")
     parser.add_argument("--search", type=str, default="fts", help="Specify whether to do FTS or vector search")
+    parser.add_argument("--queries-file", type=str, default=None, help="File in benchmark_queries to sample queries from (defaults to keyword_terms.txt or vector_terms.txt)")
+    parser.add_argument("--refine-factor", type=int, default=0, help="Re-rank refine_factor * k vector search candidates by exact distance (0 disables)")
+    parser.add_argument("--engine", type=str, default="ann", choices=["ann", "flat"], help="Run vector search on the IVF-PQ index, or as an exact scan of the flat index")
+    parser.add_argument("--stages", action="store_true", help="Time the encode, search and convert stages of each query separately")
+    parser.add_argument("--precomputed-vectors", action="store_true", help="Encode the vector search queries before the timed run and replay their vectors")
     args = parser.parse_args()
     # fmt: on
 
     LIMIT = args.limit
     SEED = args.seed
+    random.seed(SEED)
 
     # Assert that the search type is only one of "fts" or "vector"
     assert args.search in ["fts", "vector"], "Please specify a valid search type: 'fts' or 'vector'"
@@ -112,10 +236,19 @@ if __name__ == "__main__":
     TABLE = "wines"
     db = lancedb.connect(DB_NAME)
     tbl = db.open_table(TABLE)
+    FLAT_INDEX = None
+
+    if args.search == "vector":
+        if args.engine == "flat":
+            with Timer(name="Load flat index", text="Loaded flat index in {:.4f} sec"):
+                FLAT_INDEX = load_flat_index(DB_NAME, tbl)
+
+        # Imported lazily so that FTS runs never pay for importing torch
+        from sentence_transformers import SentenceTransformer
 
-    # Load a sentence transformer model for semantic similarity from a specified checkpoint
-    model_id = get_settings().embedding_model_checkpoint
-    assert model_id, "Invalid embedding model checkpoint specified in .env file"
-    MODEL = SentenceTransformer(model_id)
+        # Load a sentence transformer model for semantic similarity from a specified checkpoint
+        model_id = get_settings().embedding_model_checkpoint
+        assert model_id, "Invalid embedding model checkpoint specified in .env file"
+        MODEL = SentenceTransformer(model_id)
 
     main()
@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -8,3 +10,34 @@ class Settings(BaseSettings):
     )
     lancedb_dir: str
     embedding_model_checkpoint: str
+    # Set to false to serve FTS only, without loading the embedding model (or torch)
+    enable_vector_search: bool = True
+    # Concurrent requests for the same normalized query share a single search
+    dedupe_concurrent_queries: bool = True
+    # "ann" searches the IVF-PQ index, "flat" an exact scan of all vectors held in memory
+    vector_search_engine: Literal["ann", "flat"] = "ann"
+    # Re-rank refine_factor * k candidates from the IVF-PQ index by exact distance (0 disables)
+    refine_factor: int = 0
+    # Search the reduced-dimension index built with index.py --reduced-dim, and rescore
+    # reduced_rescore_factor * k of its candidates with the full vectors
+    reduced_vector_search: bool = False
+    reduced_rescore_factor: int = 4
+    # Seconds between checks for a newly published table version (0 disables hot-reloading)
+    table_refresh_interval: float = 5.0
+    # Seconds that requests still in flight on a replaced table handle have before it's closed
+    table_close_grace_period: float = 60.0
+    # Profile a sampled fraction of requests, and every request sent with the profiling header
+    enable_profiling: bool = False
+    profile_sample_rate: float = 0.01
+    profile_header: str = "x-profile"
+    # Seconds between stack samples of a profiled request
+    profile_interval: float = 0.001
+    # Directory of the on-disk ring buffer of profiles, and the number of profiles kept in it
+    profile_dir: str = "profiles"
+    profile_max_files: int = 200
+    # Entries in the index cache of the table (one per IVF partition), which caps its memory
+    index_cache_size: int = 256
+    # Trace the Python heap with tracemalloc, which the /memory endpoint breaks down (slow)
+    trace_memory: bool = False
+    # Serve the shard tables written by `index.py --shards` instead of a single table
+    sharded: bool = False
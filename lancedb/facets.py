@@ -0,0 +1,73 @@
+"""
+Count wines by country, variety, taster and price bucket, vectorized over Arrow columns
+
+Global counts are computed at index time and stored next to the table, keyed by the table version
+they were computed for, so that the app only has to recompute them if they're missing or stale.
+"""
+import json
+import os
+from pathlib import Path
+from typing import Any
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+FACET_FIELDS = ["country", "variety", "taster_name"]
+FACET_COLUMNS = FACET_FIELDS + ["price"]
+# Price buckets as (label, lower bound inclusive, upper bound exclusive)
+PRICE_BUCKETS = [
+    ("0-10", 0, 10),
+    ("10-25", 10, 25),
+    ("25-50", 25, 50),
+    ("50-100", 50, 100),
+    ("100+", 100, None),
+]
+
+Facets = dict[str, Any]
+
+
+def compute_facets(data: pa.Table) -> Facets:
+    """Count the values of each facet field (sorted by count) and the wines in each price bucket"""
+    facets: Facets = {"total": data.num_rows}
+    for field in FACET_FIELDS:
+        value_counts = pc.value_counts(data[field].drop_null())
+        values = value_counts.field("values").to_pylist()
+        counts = value_counts.field("counts").to_pylist()
+        facets[field] = dict(sorted(zip(values, counts), key=lambda item: -item[1]))
+    facets["price"] = {}
+    for label, lower, upper in PRICE_BUCKETS:
+        mask = pc.greater_equal(data["price"], lower)
+        if upper is not None:
+            mask = pc.and_(mask, pc.less(data["price"], upper))
+        facets["price"][label] = pc.sum(mask.cast(pa.int64())).as_py() or 0
+    return facets
+
+
+def truncate_facets(facets: Facets, size: int) -> Facets:
+    """Keep the `size` most frequent values of each facet field"""
+    truncated = dict(facets)
+    for field in FACET_FIELDS:
+        truncated[field] = dict(list(facets[field].items())[:size])
+    return truncated
+
+
+def _facets_path(db_dir: str, table_name: str) -> Path:
+    return Path(db_dir) / f"{table_name}.facets.json"
+
+
+def write_facets(db_dir: str, table_name: str, version: int, facets: Facets) -> None:
+    path = _facets_path(db_dir, table_name)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps({"version": version, "facets": facets}))
+    os.replace(tmp_path, path)
+
+
+def read_facets(db_dir: str, table_name: str, version: int) -> Facets | None:
+    """Return the precomputed facets, or None if they're missing or for another table version"""
+    try:
+        precomputed = json.loads(_facets_path(db_dir, table_name).read_text())
+    except FileNotFoundError:
+        return None
+    if precomputed["version"] != version:
+        return None
+    return precomputed["facets"]
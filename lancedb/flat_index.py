@@ -0,0 +1,89 @@
+"""
+Exact cosine search over all the stored vectors, as one matrix multiply per batch of queries
+
+The `vector` column of a table version is L2-normalized once and saved as a contiguous float32
+matrix in `<table>.flat/`, keyed by the table version, and then memory-mapped, so that the
+workers serving the same version share a single copy of it in the page cache. Files of other
+versions are removed when a newer version is saved.
+"""
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+
+def _flat_index_dir(db_dir: str, table_name: str) -> Path:
+    return Path(db_dir) / f"{table_name}.flat"
+
+
+class FlatIndex:
+    "Ids and L2-normalized vectors of all rows of a table version"
+
+    def __init__(self, ids: np.ndarray, vectors: np.ndarray) -> None:
+        self.ids = ids
+        self.vectors = vectors
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, data: pa.Table) -> "FlatIndex":
+        """Build an in-memory index from a table with `id` and `vector` columns"""
+        vectors = data["vector"].combine_chunks()
+        vectors = vectors.values.to_numpy(zero_copy_only=False).reshape(len(vectors), -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = np.ascontiguousarray(vectors / np.maximum(norms, 1e-12), dtype=np.float32)
+        return cls(data["id"].to_numpy().astype(np.int64), vectors)
+
+    @classmethod
+    def open(cls, db_dir: str, table_name: str, version: int) -> "FlatIndex | None":
+        """Memory-map the saved index of a table version, or return None if it's missing"""
+        directory = _flat_index_dir(db_dir, table_name)
+        try:
+            ids = np.load(directory / f"v{version}_ids.npy", mmap_mode="r")
+            vectors = np.load(directory / f"v{version}_vectors.npy", mmap_mode="r")
+        except FileNotFoundError:
+            return None
+        return cls(ids, vectors)
+
+    def save(self, db_dir: str, table_name: str, version: int) -> None:
+        directory = _flat_index_dir(db_dir, table_name)
+        directory.mkdir(exist_ok=True)
+        # Vectors go last, as `open` only finds an index once both of its files exist
+        for name, array in [("ids", self.ids), ("vectors", self.vectors)]:
+            # Each writer has its own temporary file, as workers may save the same version at once
+            with tempfile.NamedTemporaryFile(dir=directory, suffix=".tmp", delete=False) as f:
+                np.save(f, array)
+            os.replace(f.name, directory / f"v{version}_{name}.npy")
+        # Older versions are removed, while a worker that's still serving one keeps its mapping
+        for path in directory.glob("v*.npy"):
+            if int(path.name[1:].split("_")[0]) < version:
+                path.unlink(missing_ok=True)
+
+    def search(self, query_vectors: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Return the ids of the `k` nearest rows to each of a batch of query vectors, with their
+        cosine distances, both of shape (queries, k) and sorted by distance
+        """
+        queries = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        similarities = queries @ self.vectors.T
+        k = min(k, len(self))
+        if k < len(self):
+            # Only the top k of each row need sorting, after an O(n) partial sort
+            top_k = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        else:
+            top_k = np.broadcast_to(np.arange(len(self)), (len(queries), len(self)))
+        top_similarities = np.take_along_axis(similarities, top_k, axis=1)
+        order = np.argsort(-top_similarities, axis=1)
+        top_k = np.take_along_axis(top_k, order, axis=1)
+        distances = 1 - np.take_along_axis(top_similarities, order, axis=1)
+        return self.ids[top_k], distances
+
+
+def build_flat_index(db_dir: str, table_name: str, version: int, data: pa.Table) -> FlatIndex:
+    """Build and save the index of a table version, and return it memory-mapped"""
+    FlatIndex.build(data).save(db_dir, table_name, version)
+    return FlatIndex.open(db_dir, table_name, version)
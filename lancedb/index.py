@@ -1,17 +1,25 @@
 import argparse
-import os
-import shutil
+import gzip
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
+from itertools import islice
 from pathlib import Path
 from typing import Any, Iterator
 
+import numpy as np
 import srsly
 from codetiming import Timer
 from config import Settings
 from dotenv import load_dotenv
+from facets import FACET_COLUMNS, compute_facets, write_facets
+from ingest_report import IngestReport
+from reduction import REDUCED_VECTOR_COLUMN, Projection, read_projection, write_projection
 from rich import progress
 from schemas.wine import LanceModelWine, Wine
-from sentence_transformers import SentenceTransformer
+from shards import Layout, partition, shard_table_name, write_layout
+from table_version import publish_version
 
 import lancedb
 from lancedb.pydantic import pydantic_to_schema
@@ -21,6 +29,9 @@ load_dotenv()
 # Custom types
 JsonBlob = dict[str, Any]
 
+# Number of lines decompressed at a time before they're parsed
+READ_BATCH_SIZE = 10000
+
 
 class FileNotFoundError(Exception):
     pass
@@ -40,17 +51,25 @@ def chunk_iterable(item_list: list[JsonBlob], chunksize: int) -> Iterator[list[J
         yield item_list[i : i + chunksize]
 
 
-def get_json_data(data_dir: Path, filename: str) -> list[JsonBlob]:
+def get_json_data(data_dir: Path, filename: str, report: IngestReport) -> list[JsonBlob]:
     """Get all line-delimited json files (.jsonl) from a directory with a given prefix"""
     file_path = data_dir / filename
     if not file_path.is_file():
-        # File may not have been uncompressed yet so try to do that first
-        data = srsly.read_gzip_jsonl(file_path)
-        # This time if it isn't there it really doesn't exist
-        if not file_path.is_file():
-            raise FileNotFoundError(f"No valid .jsonl file found in `{data_dir}`")
-    else:
-        data = srsly.read_gzip_jsonl(file_path)
+        raise FileNotFoundError(f"No valid .jsonl file found in `{data_dir}`")
+    # Lines are decompressed and parsed in batches, so that reading and parsing are timed as
+    # separate stages without holding the whole decompressed file in memory
+    data = []
+    with gzip.open(file_path, "rb") as f:
+        while True:
+            with report.stage("read"):
+                lines = list(islice(f, READ_BATCH_SIZE))
+            if not lines:
+                break
+            with report.stage("parse"):
+                batch = [srsly.json_loads(line) for line in lines if line.strip()]
+            report.add_rows("read", len(lines))
+            report.add_rows("parse", len(batch))
+            data += batch
     return data
 
 
@@ -62,19 +81,31 @@ def validate(
     return validated_data
 
 
+@lru_cache()
+def get_embedding_model():
+    # Imported lazily so that `--help` and other cheap commands don't pay for importing torch
+    from sentence_transformers import SentenceTransformer
+
+    # Load a sentence transformer model for semantic similarity from a specified checkpoint
+    model_id = get_settings().embedding_model_checkpoint
+    assert model_id, "Invalid embedding model checkpoint specified in .env file"
+    return SentenceTransformer(model_id)
+
+
 def embed_func(batch: list[str], model) -> list[list[float]]:
     return [model.encode(sentence.lower()) for sentence in batch]
 
 
 def vectorize_text(data: list[JsonBlob]) -> list[LanceModelWine] | None:
-    # Load a sentence transformer model for semantic similarity from a specified checkpoint
-    model_id = get_settings().embedding_model_checkpoint
-    assert model_id, "Invalid embedding model checkpoint specified in .env file"
-    MODEL = SentenceTransformer(model_id)
+    MODEL = get_embedding_model()
 
     ids = [item["id"] for item in data]
     to_vectorize = [text.get("to_vectorize") for text in data]
     vectors = embed_func(to_vectorize, MODEL)
+    if PROJECTION is not None:
+        # Rows upserted into a table with reduced vectors get them from the stored projection
+        reduced = PROJECTION.transform(np.array(vectors))
+        data = [{**d, REDUCED_VECTOR_COLUMN: vector} for d, vector in zip(data, reduced)]
     try:
         data_batch = [{**d, "vector": vector} for d, vector in zip(data, vectors)]
     except Exception as e:
@@ -83,7 +114,7 @@ def vectorize_text(data: list[JsonBlob]) -> list[LanceModelWine] | None:
     return data_batch
 
 
-def embed_batches(tbl: str, validated_data: list[JsonBlob]) -> Table:
+def embed_batches(tbl: str, validated_data: list[JsonBlob], upsert: bool = False) -> Table:
     """Ingest vector embeddings in batches for ANN index"""
     chunked_data = chunk_iterable(validated_data, CHUNKSIZE)
     print(f"Adding vectors to table for ANN index...")
@@ -98,36 +129,174 @@ def embed_batches(tbl: str, validated_data: list[JsonBlob]) -> Table:
             "Starting vectorization...", total=len(validated_data) // CHUNKSIZE
         )
         for chunk in chunked_data:
-            batch = vectorize_text(chunk)
+            with REPORT.stage("embed", rows=len(chunk)):
+                batch = vectorize_text(chunk)
             prog.update(overall_progress_task, advance=1)
-            tbl.add(batch, mode="append")
+            with REPORT.stage("write", rows=len(chunk)):
+                if upsert:
+                    # Update existing wines in place and append new ones, matching rows on `id`
+                    (
+                        tbl.merge_insert("id")
+                        .when_matched_update_all()
+                        .when_not_matched_insert_all()
+                        .execute(batch)
+                    )
+                else:
+                    tbl.add(batch, mode="append")
+
+
+def update_indexes(tbl: Table) -> bool:
+    """
+    Add rows that were appended or upserted since the indexes were built to the existing ANN and
+    FTS indexes, without retraining or rebuilding them. New vectors are indexed as a delta segment,
+    which `optimize.py` merges into the main index in the background.
 
+    Returns False if there are no indexes to update, which happens when every indexed row was
+    replaced (Lance drops indexes that no longer cover any data).
+    """
+    dataset = tbl.to_lance()
+    indexes = {index["name"] for index in dataset.list_indices()}
+    if not {"vector_idx", "to_vectorize_idx"} <= indexes:
+        return False
+    dataset.optimize.optimize_indices(num_indices_to_merge=0)
+    tbl.checkout_latest()
+    if "id_idx" not in {index["name"] for index in tbl.to_lance().list_indices()}:
+        # Tables indexed before point lookups were served by id lack the scalar index
+        tbl.create_scalar_index("id")
+    return True
+
+
+def add_reduced_vectors(tbl: Table) -> Projection:
+    """Fit a projection on a sample of the stored vectors, and add a column of reduced vectors"""
+    dataset = tbl.to_lance()
+    rng = np.random.default_rng(37)
+    sample = np.sort(rng.choice(len(tbl), min(len(tbl), 50_000), replace=False))
+    vectors = dataset.take(sample, columns=["vector"])["vector"].combine_chunks()
+    vectors = vectors.values.to_numpy(zero_copy_only=False).reshape(len(vectors), -1)
+    projection = Projection.fit(REDUCTION, REDUCED_DIM, vectors)
+    dataset.add_columns(projection.transform_batch, read_columns=["vector"])
+    tbl.checkout_latest()
+    return projection
+
+
+def create_indexes(tbl: Table) -> None:
+    with Timer(name="Create ANN index", text="Created ANN index in {:.4f} sec"):
+        print("Creating ANN index...")
+        # Creating IVF-PQ index for now, as we eagerly await DiskANN
+        # Choose num partitions as a power of 2 that's closest to len(dataset) // 5000
+        # In this case, we have 130k datapoints, so the nearest power of 2 is 130000//5000 ~ 32)
+        with REPORT.stage("ann_index", rows=len(tbl)):
+            tbl.create_index(metric="cosine", num_partitions=4, num_sub_vectors=32, replace=True)
 
-def main(tbl: Table, data: list[JsonBlob]) -> None:
-    """Generate sentence embeddings and create ANN and FTS indexes"""
+    with Timer(name="Create FTS index", text="Created FTS index in {:.4f} sec"):
+        # Create a native full-text search index (BM25), which, unlike the Tantivy-based index,
+        # can also be queried through LanceDB's async API used by the FastAPI app
+        with REPORT.stage("fts_index", rows=len(tbl)):
+            tbl.create_fts_index("to_vectorize", use_tantivy=False, replace=True)
+
+    with Timer(name="Create scalar index", text="Created scalar index on id in {:.4f} sec"):
+        # A B-tree on `id` turns lookups of wines by id into point lookups rather than scans
+        with REPORT.stage("id_index", rows=len(tbl)):
+            tbl.create_scalar_index("id", replace=True)
+
+    if REDUCED_VECTOR_COLUMN in tbl.schema.names:
+        dim = tbl.schema.field(REDUCED_VECTOR_COLUMN).type.list_size
+        with Timer(name="Create reduced ANN index", text="Created reduced ANN index in {:.4f} sec"):
+            # PQ-encode the reduced vectors as 8-dimensional sub-vectors
+            with REPORT.stage("reduced_index", rows=len(tbl)):
+                tbl.create_index(
+                    metric="cosine",
+                    num_partitions=4,
+                    num_sub_vectors=dim // 8,
+                    vector_column_name=REDUCED_VECTOR_COLUMN,
+                    replace=True,
+                )
+
+
+def build_shard_indexes(tbl: Table) -> float:
+    """Build the ANN, FTS and scalar indexes of a shard, returning the time taken"""
+    start = time.perf_counter()
+    # Choose num partitions as a power of 2 that's closest to len(shard) // 5000
+    num_partitions = 2 ** max(0, round(math.log2(max(1, len(tbl) // 5000))))
+    tbl.create_index(
+        metric="cosine", num_partitions=num_partitions, num_sub_vectors=32, replace=True
+    )
+    tbl.create_fts_index("to_vectorize", use_tantivy=False, replace=True)
+    tbl.create_scalar_index("id", replace=True)
+    return time.perf_counter() - start
+
+
+def main_sharded(db: lancedb.DBConnection, data: list[JsonBlob]) -> Layout:
+    """Split the data across shard tables, then build the indexes of all shards in parallel"""
     with Timer(
         name="Data validation in pydantic",
         text="Validated data using Pydantic in {:.4f} sec",
     ):
-        validated_data = validate(data, exclude_none=False)
+        with REPORT.stage("validate", rows=len(data)):
+            validated_data = validate(data, exclude_none=False)
 
+    shard_data, countries = partition(validated_data, NUM_SHARDS, PARTITION)
+    # Training the PQ codebooks of an ANN index takes at least 256 vectors
+    assert min(len(rows) for rows in shard_data) >= 256, "Too few rows per shard, use fewer shards"
+    tables = []
     with Timer(
         name="Insert vectors in batches",
         text="Created sentence embeddings in {:.4f} sec",
     ):
-        embed_batches(tbl, validated_data)
-        print(f"Finished inserting {len(tbl)} vectors into LanceDB table")
+        for shard, rows in enumerate(shard_data):
+            tbl = db.create_table(
+                shard_table_name(TABLE, shard),
+                schema=pydantic_to_schema(LanceModelWine),
+                mode="overwrite",
+            )
+            embed_batches(tbl, rows)
+            print(f"Finished inserting {len(tbl)} vectors into shard {shard}")
+            tables.append(tbl)
+
+    # Index builds run in Rust and release the GIL, so threads build the shards in parallel
+    with Timer(name="Build shard indexes", text="Built indexes of all shards in {:.4f} sec"):
+        with REPORT.stage("index_build", rows=len(validated_data)):
+            with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+                build_times = list(executor.map(build_shard_indexes, tables))
+    for shard, seconds in enumerate(build_times):
+        print(f"Built indexes of shard {shard} in {seconds:.4f} sec")
+    return {
+        "partition": PARTITION,
+        "countries": countries,
+        "shards": [{"table": tbl.name, "version": tbl.version, "rows": len(tbl)} for tbl in tables],
+    }
+
+
+def main(tbl: Table, data: list[JsonBlob], upsert: bool = False) -> Projection | None:
+    """Generate sentence embeddings and create (or incrementally update) ANN and FTS indexes,
+    returning the projection of the reduced vectors, if the table has any"""
+    with Timer(
+        name="Data validation in pydantic",
+        text="Validated data using Pydantic in {:.4f} sec",
+    ):
+        with REPORT.stage("validate", rows=len(data)):
+            validated_data = validate(data, exclude_none=False)
 
-    with Timer(name="Create ANN index", text="Created ANN index in {:.4f} sec"):
-        print("Creating ANN index...")
-        # Creating IVF-PQ index for now, as we eagerly await DiskANN
-        # Choose num partitions as a power of 2 that's closest to len(dataset) // 5000
-        # In this case, we have 130k datapoints, so the nearest power of 2 is 130000//5000 ~ 32)
-        tbl.create_index(metric="cosine", num_partitions=4, num_sub_vectors=32)
+    with Timer(
+        name="Insert vectors in batches",
+        text="Created sentence embeddings in {:.4f} sec",
+    ):
+        embed_batches(tbl, validated_data, upsert=upsert)
+        print(f"Finished inserting {len(tbl)} vectors into LanceDB table")
 
-    with Timer(name="Create FTS index", text="Created FTS index in {:.4f} sec"):
-        # Create a full-text search index via Tantivy (which implements Lucene + BM25 in Rust)
-        tbl.create_fts_index(["to_vectorize"])
+    projection = PROJECTION
+    if upsert:
+        with Timer(name="Update indexes", text="Updated ANN and FTS indexes in {:.4f} sec"):
+            with REPORT.stage("index_update", rows=len(validated_data)):
+                updated = update_indexes(tbl)
+        if updated:
+            return projection
+    elif REDUCED_DIM:
+        with Timer(name="Reduce vectors", text="Added reduced vectors in {:.4f} sec"):
+            with REPORT.stage("reduce", rows=len(tbl)):
+                projection = add_reduced_vectors(tbl)
+    create_indexes(tbl)
+    return projection
 
 
 if __name__ == "__main__":
@@ -136,6 +305,14 @@ if __name__ == "__main__":
     parser.add_argument("--limit", "-l", type=int, default=0, help="Limit the size of the dataset to load for testing purposes")
     parser.add_argument("--chunksize", type=int, default=1000, help="Size of each chunk to break the dataset into before processing")
     parser.add_argument("--filename", type=str, default="winemag-data-130k-v2.jsonl.gz", help="Name of the JSONL zip file to use")
+    parser.add_argument("--mode", type=str, default="overwrite", choices=["overwrite", "upsert"], help="Overwrite the table and rebuild its indexes, or upsert rows into it and update its indexes incrementally")
+    parser.add_argument("--report", type=str, default="ingest_report.json", help="Path of the JSON report of the time, rows per second and peak RSS of each ingest stage")
+    parser.add_argument("--shards", type=int, default=0, help="Split the data across this many shard tables, each with its own indexes (0 keeps a single table)")
+    parser.add_argument("--partition", type=str, default="hash", choices=["hash", "country"], help="Assign rows to shards by a hash of their id, or by their country")
+    parser.add_argument("--workers", type=int, default=0, help="Number of shards whose indexes are built in parallel (defaults to all of them)")
+    parser.add_argument("--reduced-dim", type=int, default=0, help="Also store and index vectors reduced to this many dimensions (a multiple of 8, 0 disables)")
+    parser.add_argument("--reduction", type=str, default="pca", choices=["pca", "truncate"], help="Reduce vectors by PCA fitted on the stored vectors, or by keeping their leading dimensions (for Matryoshka models)")
+    parser.add_argument("--trace-memory", action="store_true", help="Also record the RSS and Python heap (with tracemalloc, which slows ingest down) of each ingest stage")
     args = vars(parser.parse_args())
     # fmt: on
 
@@ -143,21 +320,60 @@ if __name__ == "__main__":
     DATA_DIR = Path(__file__).parents[1] / "data"
     FILENAME = args["filename"]
     CHUNKSIZE = args["chunksize"]
-
-    data = list(get_json_data(DATA_DIR, FILENAME))
+    UPSERT = args["mode"] == "upsert"
+    NUM_SHARDS = args["shards"]
+    PARTITION = args["partition"]
+    WORKERS = args["workers"] or NUM_SHARDS
+    assert not (UPSERT and NUM_SHARDS), "Upserts into sharded tables aren't supported"
+    REDUCED_DIM = args["reduced_dim"]
+    REDUCTION = args["reduction"]
+    assert REDUCED_DIM % 8 == 0, "The reduced dimension must be a multiple of 8"
+    assert not (REDUCED_DIM and NUM_SHARDS), "Sharded tables don't support reduced vectors"
+    PROJECTION = None
+    REPORT = IngestReport("lancedb", trace_memory=args["trace_memory"])
+
+    data = list(get_json_data(DATA_DIR, FILENAME, REPORT))
     assert data, "No data found in the specified file"
     data = data[:LIMIT] if LIMIT > 0 else data
 
     DB_NAME = "./winemag"
     TABLE = "wines"
-    if os.path.exists(DB_NAME):
-        shutil.rmtree(DB_NAME)
-
+    # Overwrite the table as a new version rather than deleting the directory, so that a running
+    # app keeps serving the previously published version until this one is fully indexed
     db = lancedb.connect(DB_NAME)
-    try:
-        tbl = db.create_table(TABLE, schema=pydantic_to_schema(LanceModelWine), mode="create")
-    except OSError:
-        tbl = db.open_table(TABLE)
-
-    main(tbl, data)
+    if NUM_SHARDS:
+        layout = main_sharded(db, data)
+        # Writing the layout publishes the indexed shard versions for the app to pick up
+        write_layout(DB_NAME, TABLE, layout)
+        print(f"Published {NUM_SHARDS} shards of table '{TABLE}', partitioned by {PARTITION}")
+    else:
+        if UPSERT:
+            tbl = db.open_table(TABLE)
+            if REDUCED_VECTOR_COLUMN in tbl.schema.names:
+                PROJECTION = read_projection(DB_NAME, TABLE)
+                assert PROJECTION is not None, f"No projection found for table '{TABLE}'"
+        else:
+            tbl = db.create_table(
+                TABLE, schema=pydantic_to_schema(LanceModelWine), mode="overwrite"
+            )
+
+        projection = main(tbl, data, upsert=UPSERT)
+        with Timer(name="Compute facets", text="Computed facet counts in {:.4f} sec"):
+            with REPORT.stage("facets", rows=len(tbl)):
+                facets = compute_facets(tbl.to_lance().to_table(columns=FACET_COLUMNS))
+                write_facets(DB_NAME, TABLE, tbl.version, facets)
+        if projection is not None:
+            # Queries on this version must be projected exactly as its stored vectors were
+            write_projection(DB_NAME, TABLE, tbl.version, projection)
+        publish_version(DB_NAME, TABLE, tbl.version)
+        print(f"Published version {tbl.version} of table '{TABLE}'")
+    REPORT.write(
+        Path(args["report"]),
+        rows=len(data),
+        filename=FILENAME,
+        mode=args["mode"],
+        chunksize=CHUNKSIZE,
+        shards=NUM_SHARDS,
+        partition=PARTITION,
+    )
     print("Finished execution!")
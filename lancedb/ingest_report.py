@@ -0,0 +1,200 @@
+"""
+Per-stage ingest throughput report, and a command to compare a report against a baseline
+
+`index.py` records the time, rows and peak RSS of each ingest stage and writes them to a JSON
+report. Stages that run once per batch or chunk (e.g., reading, parsing and embedding) are
+accumulated across runs, and the peak RSS at the end of every run of a stage is also kept in the
+order the runs ended.
+With `--trace-memory`, each stage also records the RSS at its end, how much it grew the RSS, and
+the peak size of the Python heap during the stage (traced by tracemalloc, which slows ingest down).
+
+Compare a report against a baseline report to flag regressions, and optionally the stages that
+went over a memory budget (exits with 1 if there are any):
+
+    python ingest_report.py ingest_baseline.json ingest_report.json --max-rss-mb 3500
+"""
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Iterator
+
+from memory import get_heap_mb, get_peak_rss_mb, get_rss_mb
+
+# Custom types
+JsonBlob = dict[str, Any]
+
+
+class IngestReport:
+    def __init__(self, indexer: str, trace_memory: bool = False) -> None:
+        self.indexer = indexer
+        self.trace_memory = trace_memory
+        self.stages: dict[str, JsonBlob] = {}
+        # Every run of every stage in the order they ended, as stages that run per chunk interleave
+        self.timeline: list[JsonBlob] = []
+        self.start = time.perf_counter()
+        if trace_memory:
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str, rows: int = 0) -> Iterator[None]:
+        """Time a stage that processes `rows` rows, adding to the stage's previous runs if any"""
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            start_rss = get_rss_mb()
+        start = time.perf_counter()
+        yield
+        stage = self.stages.setdefault(name, {"seconds": 0.0, "rows": 0})
+        stage["seconds"] += time.perf_counter() - start
+        stage["rows"] += rows
+        # The peak RSS of the process so far, i.e., including all the stages before this one
+        stage["peak_rss_mb"] = get_peak_rss_mb()
+        self.timeline.append(
+            {
+                "stage": name,
+                "end_sec": time.perf_counter() - self.start,
+                "peak_rss_mb": stage["peak_rss_mb"],
+            }
+        )
+        if self.trace_memory:
+            rss = get_rss_mb()
+            _, heap_peak = get_heap_mb()
+            stage["rss_mb"] = max(stage.get("rss_mb", 0.0), rss)
+            stage["rss_growth_mb"] = stage.get("rss_growth_mb", 0.0) + rss - start_rss
+            stage["heap_peak_mb"] = max(stage.get("heap_peak_mb", 0.0), heap_peak)
+
+    def add_rows(self, name: str, rows: int) -> None:
+        """Count rows towards a stage that has already run, for stages that stream their rows"""
+        self.stages[name]["rows"] += rows
+
+    def to_dict(self, rows: int, **params: Any) -> JsonBlob:
+        stages = {}
+        for name, stage in self.stages.items():
+            rows_per_sec = None
+            if stage["rows"] and stage["seconds"]:
+                rows_per_sec = stage["rows"] / stage["seconds"]
+            stages[name] = {**stage, "rows_per_sec": rows_per_sec}
+        return {
+            "indexer": self.indexer,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "rows": rows,
+            "params": params,
+            "total_sec": time.perf_counter() - self.start,
+            "peak_rss_mb": get_peak_rss_mb(),
+            "trace_memory": self.trace_memory,
+            "stages": stages,
+            "timeline": self.timeline,
+        }
+
+    def write(self, path: Path, rows: int, **params: Any) -> None:
+        report = self.to_dict(rows, **params)
+        path.write_text(json.dumps(report, indent=2))
+        print(format_report(report))
+        print(f"Wrote ingest report to {path}")
+
+
+def format_report(report: JsonBlob) -> str:
+    trace_memory = report.get("trace_memory", False)
+    header = f"{'stage':>14} {'sec':>10} {'rows':>9} {'rows/s':>10} {'peak RSS MB':>12}"
+    if trace_memory:
+        header += f" {'RSS MB':>8} {'RSS +MB':>8} {'heap peak MB':>13}"
+    lines = [header]
+    for name, stage in report["stages"].items():
+        rows_per_sec = f"{stage['rows_per_sec']:.0f}" if stage["rows_per_sec"] else "-"
+        line = (
+            f"{name:>14} {stage['seconds']:>10.4f} {stage['rows'] or '-':>9} {rows_per_sec:>10} "
+            f"{stage['peak_rss_mb']:>12.0f}"
+        )
+        if trace_memory:
+            line += (
+                f" {stage['rss_mb']:>8.0f} {stage['rss_growth_mb']:>+8.0f} "
+                f"{stage['heap_peak_mb']:>13.1f}"
+            )
+        lines.append(line)
+    lines.append(
+        f"{'total':>14} {report['total_sec']:>10.4f} {report['rows']:>9} "
+        f"{report['rows'] / report['total_sec']:>10.0f} {report['peak_rss_mb']:>12.0f}"
+    )
+    return "\n".join(lines)
+
+
+def compare(
+    baseline: JsonBlob, current: JsonBlob, threshold: float, min_seconds: float
+) -> list[str]:
+    """Return a description of each stage that's slower (or of peak RSS that's higher) than in the
+    baseline by more than `threshold` (as a fraction of the baseline)"""
+    regressions = []
+    for name, base in baseline["stages"].items():
+        stage = current["stages"].get(name)
+        if stage is None:
+            continue
+        if stage["seconds"] - base["seconds"] < min_seconds:
+            # Ignore noise in stages that take a negligible time
+            continue
+        if base["rows_per_sec"] and stage["rows_per_sec"]:
+            # Compare throughput rather than time, in case the runs ingested different row counts
+            change = base["rows_per_sec"] / stage["rows_per_sec"] - 1
+            if change > threshold:
+                regressions.append(
+                    f"{name}: {stage['rows_per_sec']:.0f} rows/s vs. {base['rows_per_sec']:.0f} "
+                    f"rows/s in the baseline ({change:.1%} slower)"
+                )
+        else:
+            change = stage["seconds"] / base["seconds"] - 1
+            if change > threshold:
+                regressions.append(
+                    f"{name}: {stage['seconds']:.4f} sec vs. {base['seconds']:.4f} sec in the "
+                    f"baseline ({change:.1%} slower)"
+                )
+    change = current["peak_rss_mb"] / baseline["peak_rss_mb"] - 1
+    if change > threshold:
+        regressions.append(
+            f"peak RSS: {current['peak_rss_mb']:.0f} MB vs. {baseline['peak_rss_mb']:.0f} MB in "
+            f"the baseline ({change:.1%} higher)"
+        )
+    return regressions
+
+
+def over_budget(report: JsonBlob, max_rss_mb: float) -> list[str]:
+    """Return a description of the first run of a stage by the end of which the peak RSS was over
+    budget, i.e., the run in which the process went over budget"""
+    runs: dict[str, int] = {}
+    for run in report.get("timeline", []):
+        runs[run["stage"]] = runs.get(run["stage"], 0) + 1
+        if run["peak_rss_mb"] > max_rss_mb:
+            return [
+                f"{run['stage']}: peak RSS of {run['peak_rss_mb']:.0f} MB went over the budget of "
+                f"{max_rss_mb:.0f} MB in run {runs[run['stage']]} of this stage, "
+                f"{run['end_sec']:.1f} sec into the ingest"
+            ]
+    return []
+
+
+if __name__ == "__main__":
+    # fmt: off
+    parser = argparse.ArgumentParser("Compare an ingest report against a baseline report")
+    parser.add_argument("baseline", type=Path, help="Path of the baseline ingest report")
+    parser.add_argument("current", type=Path, nargs="?", default=Path("ingest_report.json"), help="Path of the ingest report to check")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown (or RSS increase) to flag as a regression")
+    parser.add_argument("--min-seconds", type=float, default=0.5, help="Ignore stages that are slower by fewer seconds than this")
+    parser.add_argument("--max-rss-mb", type=float, default=None, help="Memory budget: flag the stage in which the peak RSS went over this")
+    args = parser.parse_args()
+    # fmt: on
+
+    baseline = json.loads(args.baseline.read_text())
+    current = json.loads(args.current.read_text())
+    print(f"Baseline ({baseline['timestamp']}):\n{format_report(baseline)}\n")
+    print(f"Current ({current['timestamp']}):\n{format_report(current)}\n")
+    regressions = compare(baseline, current, args.threshold, args.min_seconds)
+    if args.max_rss_mb is not None:
+        regressions += over_budget(current, args.max_rss_mb)
+    if regressions:
+        print(f"Found {len(regressions)} regression(s):")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print(f"No regressions beyond {args.threshold:.0%}")
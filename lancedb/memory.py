@@ -0,0 +1,100 @@
+"""
+Measure the memory used by each component of a process, as the growth of its resident set size
+(RSS) and, when tracemalloc is tracing, of the Python heap between successive marks
+"""
+import os
+import resource
+import tracemalloc
+from typing import Any
+
+# Custom types
+JsonBlob = dict[str, Any]
+
+
+def get_rss_mb() -> float:
+    """Current RSS of this process (falls back to the peak RSS outside Linux)"""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError):
+        return get_peak_rss_mb()
+
+
+def get_peak_rss_mb() -> float:
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_heap_mb() -> tuple[float, float] | None:
+    """Current and peak size of the Python heap traced by tracemalloc, if it's tracing"""
+    if not tracemalloc.is_tracing():
+        return None
+    current, peak = tracemalloc.get_traced_memory()
+    return current / 2**20, peak / 2**20
+
+
+def get_top_allocations(size: int = 10) -> list[JsonBlob]:
+    """The source files that hold the most memory allocated on the Python heap"""
+    if not tracemalloc.is_tracing():
+        return []
+    statistics = tracemalloc.take_snapshot().statistics("filename")
+    return [
+        {"file": str(stat.traceback[0].filename), "mb": stat.size / 2**20, "blocks": stat.count}
+        for stat in statistics[:size]
+    ]
+
+
+def get_parameters_mb(model) -> float | None:
+    """Size of the weights of a torch model, such as a SentenceTransformer"""
+    if not hasattr(model, "parameters"):
+        return None
+    return sum(p.numel() * p.element_size() for p in model.parameters()) / 2**20
+
+
+class MemoryTracker:
+    "Collect the memory added by each component, as it's loaded one after the other"
+
+    def __init__(self) -> None:
+        self.components: list[tuple[str, float, float | None]] = []
+        self._last_rss = 0.0
+        self._last_heap = 0.0
+
+    def mark(self, component: str) -> None:
+        """Record the memory added since the previous mark as the memory used by `component`"""
+        rss = get_rss_mb()
+        heap = get_heap_mb()
+        heap_delta = None if heap is None else heap[0] - self._last_heap
+        self.components.append((component, rss - self._last_rss, heap_delta))
+        self._last_rss = rss
+        self._last_heap = 0.0 if heap is None else heap[0]
+
+    def snapshot(self, rest: str = "Serving") -> JsonBlob:
+        """The memory used by each component, where `rest` is what was added since the last mark"""
+        rss = get_rss_mb()
+        heap = get_heap_mb()
+        components = [
+            {"component": component, "rss_mb": rss_delta, "heap_mb": heap_delta}
+            for component, rss_delta, heap_delta in self.components
+        ]
+        components.append(
+            {
+                "component": rest,
+                "rss_mb": rss - self._last_rss,
+                "heap_mb": None if heap is None else heap[0] - self._last_heap,
+            }
+        )
+        return {
+            "rss_mb": rss,
+            "peak_rss_mb": get_peak_rss_mb(),
+            "heap_mb": None if heap is None else heap[0],
+            "heap_peak_mb": None if heap is None else heap[1],
+            "components": components,
+            "top_allocations": get_top_allocations(),
+        }
+
+    def report(self) -> str:
+        lines = ["Memory (RSS) by component:"]
+        lines += [f"  {component:<36}{rss:>9.1f} MB" for component, rss, _ in self.components]
+        lines.append(f"  {'total':<36}{self._last_rss:>9.1f} MB")
+        return "\n".join(lines)
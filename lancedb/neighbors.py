@@ -0,0 +1,108 @@
+"""
+Run this script to precompute the nearest neighbors of the most popular wines, which the app's
+`/similar` endpoints then serve without any vector search
+
+Neighbors are found by an exact search over all the vectors of the published table version, and
+stored in `<table>.neighbors.npz` keyed by that version, as the facets are. Popular wines are read
+from a file of ids (one per line), such as the most viewed detail pages, or default to the wines
+with the most points.
+"""
+import argparse
+import os
+from pathlib import Path
+
+import numpy as np
+from codetiming import Timer
+from flat_index import FlatIndex
+from table_version import get_published_version
+
+import lancedb
+
+
+def _neighbors_path(db_dir: str, table_name: str) -> Path:
+    return Path(db_dir) / f"{table_name}.neighbors.npz"
+
+
+def write_neighbors(
+    db_dir: str, table_name: str, version: int, ids: np.ndarray, neighbors: np.ndarray
+) -> None:
+    path = _neighbors_path(db_dir, table_name)
+    tmp_path = path.with_suffix(".tmp.npz")
+    np.savez(tmp_path, version=version, ids=ids, neighbors=neighbors)
+    os.replace(tmp_path, path)
+
+
+def read_neighbors(db_dir: str, table_name: str, version: int) -> dict[int, list[int]] | None:
+    """Return the neighbors of each precomputed id, or None if missing or for another version"""
+    try:
+        stored = np.load(_neighbors_path(db_dir, table_name))
+    except FileNotFoundError:
+        return None
+    if int(stored["version"]) != version:
+        return None
+    return dict(zip(stored["ids"].tolist(), stored["neighbors"].tolist()))
+
+
+def compute_neighbors(
+    flat_index: FlatIndex, ids: np.ndarray, k: int, batch_size: int = 1000
+) -> np.ndarray:
+    """The ids of the `k` nearest neighbors of each wine in `ids`, excluding the wine itself"""
+    positions = {wine_id: i for i, wine_id in enumerate(flat_index.ids.tolist())}
+    neighbors = []
+    for i in range(0, len(ids), batch_size):
+        batch = ids[i : i + batch_size]
+        vectors = flat_index.vectors[[positions[wine_id] for wine_id in batch.tolist()]]
+        # Fetch one more neighbor than needed, as each wine is its own nearest neighbor
+        found, _ = flat_index.search(vectors, k + 1)
+        for wine_id, row in zip(batch.tolist(), found.tolist()):
+            neighbors.append([neighbor for neighbor in row if neighbor != wine_id][:k])
+    return np.array(neighbors, dtype=np.int64)
+
+
+def get_popular_ids() -> np.ndarray:
+    if IDS_FILE:
+        ids = [int(line) for line in Path(IDS_FILE).read_text().split()]
+        return np.array(list(dict.fromkeys(ids)), dtype=np.int64)
+    data = tbl.to_lance().to_table(columns=["id", "points"])
+    top = data.sort_by([("points", "descending"), ("id", "ascending")]).slice(0, TOP)
+    return top["id"].to_numpy()
+
+
+def main():
+    version = get_published_version(DB_NAME, TABLE)
+    if version is not None:
+        tbl.checkout(version)
+    with Timer(name="Load vectors", text="Loaded and normalized vectors in {:.4f} sec"):
+        flat_index = FlatIndex.build(tbl.to_lance().to_table(columns=["id", "vector"]))
+    ids = get_popular_ids()
+    known = set(flat_index.ids.tolist())
+    missing = [wine_id for wine_id in ids.tolist() if wine_id not in known]
+    if missing:
+        print(f"Skipping {len(missing)} ids that aren't in the table, such as {missing[0]}")
+        ids = np.array([wine_id for wine_id in ids.tolist() if wine_id in known], dtype=np.int64)
+    with Timer(name="Compute neighbors", text="Computed neighbors in {:.4f} sec"):
+        neighbors = compute_neighbors(flat_index, ids, K)
+    write_neighbors(DB_NAME, TABLE, tbl.version, ids, neighbors)
+    print(f"Stored the {K} nearest neighbors of {len(ids)} wines for version {tbl.version}")
+
+
+if __name__ == "__main__":
+    # fmt: off
+    parser = argparse.ArgumentParser("Precompute the nearest neighbors of popular wines")
+    parser.add_argument("--ids-file", type=str, default=None, help="File of popular wine ids, one per line (defaults to the wines with the most points)")
+    parser.add_argument("--top", type=int, default=10000, help="Number of wines with the most points to use when no ids file is given")
+    parser.add_argument("--k", type=int, default=10, help="Number of neighbors to store for each wine")
+    args = parser.parse_args()
+    # fmt: on
+
+    IDS_FILE = args.ids_file
+    TOP = args.top
+    K = args.k
+
+    # Assumes that the table in the DB has already been created
+    DB_NAME = "./winemag"
+    TABLE = "wines"
+    db = lancedb.connect(DB_NAME)
+    tbl = db.open_table(TABLE)
+
+    main()
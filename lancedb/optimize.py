@@ -0,0 +1,86 @@
+"""
+Run this script to merge index segments and compact data files in the background
+
+Upserts (`python index.py --mode upsert`) add new rows to the existing ANN and FTS indexes
+incrementally, with new vectors indexed as delta segments. This script merges those segments into
+the main index and compacts the small data files that each upsert leaves behind, then publishes
+the optimized version for the FastAPI app to pick up. Run it once, or on an interval.
+"""
+import argparse
+import time
+from datetime import timedelta
+
+import numpy as np
+from codetiming import Timer
+from facets import read_facets, write_facets
+from neighbors import read_neighbors, write_neighbors
+from reduction import read_projection, write_projection
+from table_version import get_published_version, publish_version
+
+import lancedb
+from lancedb.table import Table
+
+
+def optimize(tbl: Table) -> None:
+    tbl.checkout_latest()
+    published = get_published_version(DB_NAME, TABLE)
+    if published is not None and published != tbl.version:
+        # A writer has committed versions that it hasn't published yet, i.e., it's still running
+        print(f"Skipping optimization: version {tbl.version} of table '{TABLE}' is unpublished")
+        return
+
+    dataset = tbl.to_lance()
+    with Timer(name="Compact files", text="Compacted data files in {:.4f} sec"):
+        dataset.optimize.compact_files()
+    with Timer(name="Merge index segments", text="Merged index segments in {:.4f} sec"):
+        dataset.optimize.optimize_indices(num_indices_to_merge=NUM_INDICES_TO_MERGE)
+    # The dataset follows its own commits, so this is the version that the merge produced
+    optimized = dataset.version
+    if CLEANUP_OLDER_THAN > 0:
+        tbl.cleanup_old_versions(older_than=timedelta(hours=CLEANUP_OLDER_THAN))
+
+    if published is None:
+        return
+    latest = dataset.latest_version
+    if latest != optimized:
+        # A writer committed while optimizing, so the latest version may hold its unfinished
+        # changes, and the next run will optimize once it has published them
+        print(f"Skipping publishing: version {latest} of table '{TABLE}' wasn't written here")
+        return
+    # Optimization doesn't change the data, so the facet counts, the projection of reduced
+    # vectors and the precomputed neighbors all carry over to the new version
+    facets = read_facets(DB_NAME, TABLE, published)
+    if facets is not None:
+        write_facets(DB_NAME, TABLE, optimized, facets)
+    projection = read_projection(DB_NAME, TABLE, published)
+    if projection is not None:
+        write_projection(DB_NAME, TABLE, optimized, projection)
+    neighbors = read_neighbors(DB_NAME, TABLE, published)
+    if neighbors is not None:
+        ids = np.array(list(neighbors), dtype=np.int64)
+        write_neighbors(DB_NAME, TABLE, optimized, ids, np.array(list(neighbors.values())))
+    publish_version(DB_NAME, TABLE, optimized)
+    print(f"Published version {optimized} of table '{TABLE}'")
+
+
+if __name__ == "__main__":
+    # fmt: off
+    parser = argparse.ArgumentParser("Merge index segments and compact data files of the wines table")
+    parser.add_argument("--interval", type=float, default=0, help="Seconds between optimizations (0 runs once and exits)")
+    parser.add_argument("--merge", type=int, default=8, help="Maximum number of index segments to merge into one")
+    parser.add_argument("--cleanup-older-than", type=float, default=0, help="Delete versions older than this many hours (0 keeps all versions)")
+    args = parser.parse_args()
+    # fmt: on
+
+    NUM_INDICES_TO_MERGE = args.merge
+    CLEANUP_OLDER_THAN = args.cleanup_older_than
+
+    DB_NAME = "./winemag"
+    TABLE = "wines"
+    db = lancedb.connect(DB_NAME)
+    tbl = db.open_table(TABLE)
+
+    optimize(tbl)
+    while args.interval > 0:
+        time.sleep(args.interval)
+        optimize(tbl)
@@ -0,0 +1,198 @@
+"""
+Opt-in request profiling: a sampled fraction of requests (or requests sent with a profiling
+header) are profiled by a statistical profiler, and their profiles are kept in a bounded ring
+buffer of files on disk, which the `/profiles` endpoints list and serve
+"""
+import asyncio
+import json
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any
+
+# Custom types
+JsonBlob = dict[str, Any]
+
+# Innermost frames of threads that are idle, which would otherwise dominate every profile
+IDLE_FRAMES = {("threading.py", "wait"), ("thread.py", "_worker")}
+
+
+class StackSampler:
+    """
+    Statistical profiler that samples the Python stacks of all threads every `interval` seconds,
+    while at least one profile is active. Stacks are recorded in the folded format (frames joined
+    by `;`, rooted at the thread name) used by flame graph tools such as speedscope.
+
+    Samples cover every thread, including the executor threads that encode queries, but they also
+    include the work of any other request that runs concurrently with a profiled one.
+    """
+
+    def __init__(self, interval: float = 0.001) -> None:
+        self.interval = interval
+        self._profiles: list[Counter] = []
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def start(self) -> Counter:
+        stacks: Counter = Counter()
+        with self._lock:
+            self._profiles.append(stacks)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+        return stacks
+
+    def stop(self, stacks: Counter) -> None:
+        with self._lock:
+            self._profiles.remove(stacks)
+
+    def _run(self) -> None:
+        while True:
+            sample = self._sample()
+            # Update profiles under the lock, so that none is updated after it's been stopped
+            with self._lock:
+                if not self._profiles:
+                    # Exit while holding the lock, so that `start` starts a new thread
+                    self._thread = None
+                    return
+                for stacks in self._profiles:
+                    stacks.update(sample)
+            time.sleep(self.interval)
+
+    def _sample(self) -> list[str]:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own_ident = threading.get_ident()
+        sample = []
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            if (Path(frame.f_code.co_filename).name, frame.f_code.co_name) in IDLE_FRAMES:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                frame = frame.f_back
+            sample.append(";".join([names.get(ident, str(ident)), *reversed(frames)]))
+        return sample
+
+
+class ProfileStore:
+    """Ring buffer of at most `max_files` profiles on disk, which drops the oldest first"""
+
+    def __init__(self, directory: str | Path, max_files: int = 200) -> None:
+        self.directory = Path(directory)
+        self.max_files = max_files
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def add(self, profile: JsonBlob) -> None:
+        # Zero-padded timestamps sort file names in the order that profiles were written
+        path = self.directory / f"{profile['id']}.json"
+        path.write_text(json.dumps(profile))
+        with self._lock:
+            paths = sorted(self.directory.glob("*.json"))
+            for old in paths[: max(0, len(paths) - self.max_files)]:
+                old.unlink(missing_ok=True)
+
+    def get(self, profile_id: str) -> JsonBlob | None:
+        path = self.directory / f"{Path(profile_id).name}.json"
+        if not path.is_file():
+            return None
+        return json.loads(path.read_text())
+
+    def slowest(self, limit: int = 20) -> list[JsonBlob]:
+        """Summaries of the slowest profiled requests in the buffer"""
+        profiles = []
+        for path in self.directory.glob("*.json"):
+            try:
+                profiles.append(json.loads(path.read_text()))
+            except (FileNotFoundError, json.JSONDecodeError):
+                # Dropped from the buffer, or still being written
+                continue
+        profiles.sort(key=lambda profile: profile["duration_ms"], reverse=True)
+        return [summarize(profile) for profile in profiles[:limit]]
+
+
+def summarize(profile: JsonBlob, size: int = 10) -> JsonBlob:
+    """Drop the full stacks of a profile, keeping the functions that most samples were in"""
+    own: Counter = Counter()
+    for stack, count in profile["stacks"].items():
+        own[stack.rsplit(";", 1)[-1]] += count
+    summary = {key: value for key, value in profile.items() if key != "stacks"}
+    summary["top_frames"] = [
+        {"frame": frame, "samples": count} for frame, count in own.most_common(size)
+    ]
+    return summary
+
+
+def to_folded(profile: JsonBlob) -> str:
+    """Render the stacks of a profile in the folded format, one `stack count` line each"""
+    return "\n".join(f"{stack} {count}" for stack, count in profile["stacks"].items()) + "\n"
+
+
+class ProfilingMiddleware:
+    """
+    Pure ASGI middleware that profiles a `sample_rate` fraction of HTTP requests, plus every
+    request sent with the `header` header, and writes each profile to a `ProfileStore`
+    """
+
+    def __init__(
+        self,
+        app,
+        store: ProfileStore,
+        sampler: StackSampler,
+        sample_rate: float = 0.01,
+        header: str = "x-profile",
+        exclude_prefix: str = "/profiles",
+    ) -> None:
+        self.app = app
+        self.store = store
+        self.sampler = sampler
+        self.sample_rate = sample_rate
+        self.header = header.lower().encode()
+        self.exclude_prefix = exclude_prefix
+
+    def should_profile(self, scope) -> bool:
+        if scope["type"] != "http" or scope["path"].startswith(self.exclude_prefix):
+            return False
+        if any(name == self.header for name, _ in scope["headers"]):
+            return True
+        return random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send) -> None:
+        if not self.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start_time = time.time()
+        start = time.perf_counter()
+        stacks = self.sampler.start()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.sampler.stop(stacks)
+            duration = time.perf_counter() - start
+            profile = {
+                "id": f"{time.time_ns():020d}",
+                "timestamp": start_time,
+                "method": scope["method"],
+                "path": scope["path"],
+                "query_string": scope["query_string"].decode("latin-1"),
+                "status": status,
+                "duration_ms": duration * 1000,
+                "samples": sum(stacks.values()),
+                "stacks": dict(stacks),
+            }
+            # Write the profile off the event loop, after the response has been sent
+            await asyncio.to_thread(self.store.add, profile)
@@ -0,0 +1,109 @@
+"""
+Project vectors down to fewer dimensions, for a smaller ANN index whose candidates are rescored
+with the full vectors
+
+Two projections are supported:
+
+* `pca`: Project onto the top principal components of the stored vectors, fitted at index time
+* `truncate`: Keep the first dimensions, which works for Matryoshka-style models whose leading
+  dimensions carry the most information by construction
+
+Reduced vectors are L2-normalized, so that cosine distances on them stay meaningful. The projection
+is stored next to the table, keyed by the table version it was fitted for, as the facets are.
+"""
+import os
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+REDUCED_VECTOR_COLUMN = "vector_reduced"
+REDUCED_VECTOR_INDEX = "vector_reduced_idx"
+
+
+class Projection:
+    "Linear projection of vectors onto `dim` dimensions"
+
+    def __init__(
+        self,
+        method: str,
+        dim: int,
+        mean: np.ndarray | None = None,
+        components: np.ndarray | None = None,
+    ) -> None:
+        self.method = method
+        self.dim = dim
+        self.mean = mean
+        self.components = components
+
+    @classmethod
+    def fit(cls, method: str, dim: int, vectors: np.ndarray) -> "Projection":
+        """Fit a projection on a sample of the stored vectors"""
+        if method == "truncate":
+            return cls(method, dim)
+        mean = vectors.mean(axis=0)
+        # The right singular vectors of the centered data are its principal components
+        _, _, vt = np.linalg.svd(vectors - mean, full_matrices=False)
+        return cls(method, dim, mean.astype(np.float32), vt[:dim].astype(np.float32))
+
+    def transform(self, vectors: np.ndarray) -> np.ndarray:
+        if self.method == "truncate":
+            reduced = vectors[..., : self.dim]
+        else:
+            reduced = (vectors - self.mean) @ self.components.T
+        norms = np.linalg.norm(reduced, axis=-1, keepdims=True)
+        return (reduced / np.maximum(norms, 1e-12)).astype(np.float32)
+
+    def transform_batch(self, batch: pa.RecordBatch) -> pa.RecordBatch:
+        """Compute the reduced vector column of a batch with a `vector` column"""
+        vectors = batch["vector"]
+        values = vectors.values.to_numpy(zero_copy_only=False).reshape(len(vectors), -1)
+        reduced = pa.FixedSizeListArray.from_arrays(self.transform(values).ravel(), self.dim)
+        return pa.RecordBatch.from_arrays([reduced], names=[REDUCED_VECTOR_COLUMN])
+
+
+def _projection_path(db_dir: str, table_name: str) -> Path:
+    return Path(db_dir) / f"{table_name}.projection.npz"
+
+
+def write_projection(db_dir: str, table_name: str, version: int, projection: Projection) -> None:
+    path = _projection_path(db_dir, table_name)
+    tmp_path = path.with_suffix(".tmp.npz")
+    arrays = {}
+    if projection.method == "pca":
+        arrays = {"mean": projection.mean, "components": projection.components}
+    np.savez(tmp_path, version=version, method=projection.method, dim=projection.dim, **arrays)
+    os.replace(tmp_path, path)
+
+
+def read_projection(db_dir: str, table_name: str, version: int | None = None) -> Projection | None:
+    """Return the stored projection, or None if it's missing or for another table version"""
+    try:
+        stored = np.load(_projection_path(db_dir, table_name))
+    except FileNotFoundError:
+        return None
+    if version is not None and int(stored["version"]) != version:
+        return None
+    method = str(stored["method"])
+    if method == "truncate":
+        return Projection(method, int(stored["dim"]))
+    return Projection(method, int(stored["dim"]), stored["mean"], stored["components"])
+
+
+def rescore(candidates: pa.Table, query_vector: np.ndarray, k: int) -> pa.Table:
+    """
+    Re-rank candidates by the exact cosine distances of their full vectors to the query, and return
+    the top k without their full vectors, which the results don't need
+    """
+    if candidates.num_rows == 0:
+        return candidates.drop_columns(["vector"])
+    vectors = candidates["vector"].combine_chunks()
+    vectors = vectors.values.to_numpy(zero_copy_only=False).reshape(len(vectors), -1)
+    similarities = (vectors @ query_vector) / (
+        np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector)
+    )
+    distances = pa.array(1 - similarities, type=pa.float32())
+    candidates = candidates.set_column(
+        candidates.schema.get_field_index("_distance"), "_distance", distances
+    )
+    return candidates.drop_columns(["vector"]).sort_by("_distance").slice(0, k)
@@ -113,3 +113,38 @@ class SearchResult(LanceModel):
     variety: Optional[str]
     price: Optional[float]
     points: Optional[int]
+
+
+class SimilarResult(BaseModel):
+    "Model to return the wines most similar to a wine, for batched similarity lookups"
+
+    id: int
+    similar: list[SearchResult]
+
+
+class FacetResult(BaseModel):
+    "Model to return facet counts, with the values of each field sorted by descending count"
+
+    model_config = ConfigDict(
+        json_schema_extra={
+            "example": {
+                "total": 129971,
+                "country": {"US": 54504, "France": 22093, "Italy": 19540},
+                "variety": {"Pinot Noir": 13272, "Chardonnay": 11753},
+                "taster_name": {"Roger Voss": 25514, "Michael Schachner": 15134},
+                "price": {
+                    "0-10": 1337,
+                    "10-25": 44926,
+                    "25-50": 46149,
+                    "50-100": 16838,
+                    "100+": 2771,
+                },
+            }
+        },
+    )
+
+    total: int
+    country: dict[str, int]
+    variety: dict[str, int]
+    taster_name: dict[str, int]
+    price: dict[str, int]
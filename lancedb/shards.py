@@ -0,0 +1,94 @@
+"""
+Sharded layout of the wines table: rows are split across N tables, each with its own ANN and FTS
+indexes, either by a hash of their `id` or by their `country`
+
+The layout is recorded in `<table>.shards.json` next to the shard tables, along with the version
+of each shard that was fully indexed. Like the published version of an unsharded table, the app
+only serves the shard versions listed there, so writing the layout is what publishes a rebuild.
+"""
+import json
+import os
+import zlib
+from pathlib import Path
+from typing import Any
+
+# Custom types
+JsonBlob = dict[str, Any]
+Layout = dict[str, Any]
+
+
+def _layout_path(db_dir: str, table_name: str) -> Path:
+    return Path(db_dir) / f"{table_name}.shards.json"
+
+
+def shard_table_name(table_name: str, shard: int) -> str:
+    return f"{table_name}_shard_{shard}"
+
+
+def hash_shard(wine_id: int, num_shards: int) -> int:
+    # crc32 is stable across processes, unlike the salted built-in hash of strings
+    return zlib.crc32(str(wine_id).encode()) % num_shards
+
+
+def assign_countries(counts: dict[str, int], num_shards: int) -> dict[str, int]:
+    """
+    Assign each country to a shard, placing the largest countries first on the shard with the
+    fewest rows so far, so that the shards end up as balanced as whole countries allow
+    """
+    sizes = [0] * num_shards
+    assignment = {}
+    for country, count in sorted(counts.items(), key=lambda item: -item[1]):
+        shard = sizes.index(min(sizes))
+        assignment[country] = shard
+        sizes[shard] += count
+    return assignment
+
+
+def partition(
+    data: list[JsonBlob], num_shards: int, partition_by: str
+) -> tuple[list[list[JsonBlob]], dict[str, int] | None]:
+    """Split validated rows into shards, returning the rows of each shard and, when partitioning
+    by country, the shard of each country"""
+    shards: list[list[JsonBlob]] = [[] for _ in range(num_shards)]
+    if partition_by == "hash":
+        for item in data:
+            shards[hash_shard(item["id"], num_shards)].append(item)
+        return shards, None
+    counts: dict[str, int] = {}
+    for item in data:
+        counts[item["country"]] = counts.get(item["country"], 0) + 1
+    countries = assign_countries(counts, num_shards)
+    for item in data:
+        shards[countries[item["country"]]].append(item)
+    return shards, countries
+
+
+def write_layout(db_dir: str, table_name: str, layout: Layout) -> None:
+    """Atomically record the shard tables (and their versions) that readers should serve"""
+    path = _layout_path(db_dir, table_name)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(layout))
+    os.replace(tmp_path, path)
+
+
+def read_layout(db_dir: str, table_name: str) -> Layout | None:
+    """Return the shard layout, or None if the table isn't sharded"""
+    try:
+        return json.loads(_layout_path(db_dir, table_name).read_text())
+    except FileNotFoundError:
+        return None
+
+
+def shards_for_country(layout: Layout, country: str | None) -> list[int]:
+    """Indices of the shards that can hold wines from `country` (all shards if it's None)"""
+    if country is None or layout["partition"] != "country":
+        return list(range(len(layout["shards"])))
+    shard = layout["countries"].get(country)
+    return [] if shard is None else [shard]
+
+
+def shards_for_ids(layout: Layout, ids: list[int]) -> list[int]:
+    """Indices of the shards that can hold wines with these ids"""
+    if layout["partition"] != "hash":
+        return list(range(len(layout["shards"])))
+    return sorted({hash_shard(wine_id, len(layout["shards"])) for wine_id in ids})
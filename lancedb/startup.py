@@ -0,0 +1,41 @@
+"""
+Record how long each phase of process startup takes, so that cold starts can be broken down into
+time spent importing modules, loading the embedding model and connecting to the database
+"""
+import os
+import time
+
+
+def _process_start_time() -> float:
+    """Wall-clock time at which this process started (falls back to now outside Linux)"""
+    try:
+        with open("/proc/self/stat") as f:
+            # The process name can contain spaces, so split on the closing parenthesis first
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        start_ticks = int(fields[19])
+        return time.time() - uptime + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+class StartupTimer:
+    "Collect the elapsed time between successive startup phases"
+
+    def __init__(self) -> None:
+        self.started = _process_start_time()
+        self.phases: list[tuple[str, float]] = []
+        self._last = self.started
+
+    def mark(self, phase: str) -> None:
+        """Record the time elapsed since the previous mark as the duration of `phase`"""
+        now = time.time()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def report(self) -> str:
+        lines = ["Startup time by phase:"]
+        lines += [f"  {phase:<36}{elapsed:.4f} sec" for phase, elapsed in self.phases]
+        lines.append(f"  {'total':<36}{self._last - self.started:.4f} sec")
+        return "\n".join(lines)
@@ -0,0 +1,30 @@
+"""
+Publish fully indexed table versions for the FastAPI app to pick up
+
+Writers (`index.py`) commit many intermediate versions while they load data and build indexes, so
+a version is only published once all of its data and indexes are in place. The app switches to
+the published version, which means it never serves a half-built table.
+"""
+import json
+import os
+from pathlib import Path
+
+
+def _marker_path(db_dir: str, table_name: str) -> Path:
+    return Path(db_dir) / f"{table_name}.published.json"
+
+
+def publish_version(db_dir: str, table_name: str, version: int) -> None:
+    """Atomically record `version` as the one that readers should serve"""
+    path = _marker_path(db_dir, table_name)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps({"version": version}))
+    os.replace(tmp_path, path)
+
+
+def get_published_version(db_dir: str, table_name: str) -> int | None:
+    """Return the published version, or None if the writer did not publish one"""
+    try:
+        return json.loads(_marker_path(db_dir, table_name).read_text())["version"]
+    except FileNotFoundError:
+        return None